@@ -0,0 +1,1666 @@
+import functools
+import json
+import math
+import os
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from fuzzywuzzy import fuzz, process
+
+# folium is imported by the stage that uses it, so runs without a map and processes that only import this
+# module start faster.
+from linear_model import COEFFICIENTS_FILE, LinearModel
+from util import (
+    NpEncoder,
+    get_closest,
+    colors_,
+    add_legend,
+    get_basemaps,
+)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from routing_common.adjacency import CountryGraph, canonical_codes, load_country_graph
+from routing_common.assignment import BPR, assign, round_flows
+from routing_common.clients import build_client
+from routing_common.columnar import TableWriter, wkb_linestring, wkb_point
+from routing_common.flows import FlowMatrix
+from routing_common.gazetteer import Gazetteer, load_gazetteer, read_country_keys
+from routing_common.geonames import DATA_DIR
+from routing_common.instrumentation import Tracer
+from routing_common.jobs import JobQueue, QueueClient, call_many
+from routing_common.local_backend import haversine_km
+from routing_common.movement import Movement, departure_curve, simulate, split_integers, travel_steps
+from routing_common.polyline_codec import decode_grid, drop_repeated, simplify
+from routing_common.refresh import FEATURE_FILES, artifact_path, load_feature_table, read_city_table
+from routing_common.route_store import RouteStore, build_route_store
+from routing_common.scheduler import Priority
+from routing_common.stage_cache import StageCache, file_fingerprint
+
+CITY_FILE = os.path.join(DATA_DIR, "cities15000.txt")
+
+# Top average speed of a trip in each travel mode, in km/h, and how far a border is taken to be from the nearest city
+# of a country, in km, for the estimated shortest trip to a haven (haven_duration_estimates)
+MAX_SPEEDS_KMH = {"driving": 150, "walking": 7, "bicycling": 45, "transit": 350}
+BORDER_MARGIN_KM = 100
+
+
+@functools.lru_cache(maxsize=None)
+def load_reference_data():
+    '''
+    Loads the country, city and model data every run needs. It is cached, so a long running service only loads
+    it once; callers must not modify the returned objects.
+    '''
+    with open(os.path.join(DATA_DIR, "country_border_data.json")) as country_border:
+        country_borders = json.load(country_border)
+
+    # Find Largest Cities
+    city_df = read_city_table(
+        CITY_FILE, columns=["name", "latitude", "longitude", "country code", "admin1 code", "population"]
+    )
+
+    # one row per country and year, built by python -m routing_common.refresh
+    return {
+        "country_borders": country_borders,
+        "population": load_feature_table("population"),
+        "democracy": load_feature_table("democracy"),
+        "gdp": load_feature_table("gdp"),
+        "cities": city_df,
+        # read in csv file with country names and codes.
+        "country_codes": pd.read_csv(os.path.join(DATA_DIR, "wikipedia-iso-country-codes.csv")),
+        # the coefficients exported from the statsmodels results by linear_model.py
+        "model": LinearModel.load(COEFFICIENTS_FILE),
+    }
+
+
+def reference_fingerprint():
+    '''
+    Fingerprint of the reference data files, so cached stages are recomputed when the data is refreshed.
+    '''
+    return file_fingerprint(
+        os.path.join(DATA_DIR, "country_border_data.json"),
+        os.path.join(DATA_DIR, "wikipedia-iso-country-codes.csv"),
+        CITY_FILE,
+        COEFFICIENTS_FILE,
+        *[os.path.join(DATA_DIR, file_name) for file_name in FEATURE_FILES.values()],
+        *[artifact_path(name) for name in list(FEATURE_FILES) + ["cities15000"]],
+    )
+
+
+MODE_STYLES = {
+    "driving": {"layer": "Driving", "text": "by car", "color": "#4A89F3"},
+    "walking": {"layer": "Walking", "text": "by walking", "color": "#2E8B57"},
+    "transit": {"layer": "Transit", "text": "by transit", "color": "#8E44AD"},
+    "bicycling": {"layer": "Bicycling", "text": "by bicycle", "color": "#E67E22"},
+}
+
+# Routes are simplified to this many degrees (about 10 m) before they are drawn
+MAP_TOLERANCE = 1e-4
+
+
+def get_flight_modes(config):
+    '''
+    `flight_mode` can be one mode, a comma separated string or a list of modes.
+    '''
+    flight_mode = config.get("flight_mode", "driving")
+    if isinstance(flight_mode, str):
+        flight_mode = flight_mode.split(",")
+    return [mode.strip() for mode in flight_mode]
+
+
+def min_max_scale(values):
+    '''
+    Scales values to the 0-1 range like sklearn's MinMaxScaler: NaN values are ignored and stay NaN, and a column
+    where every value is the same scales to 0.
+    '''
+    values = np.asarray(values, dtype=float)
+    lowest = np.nanmin(values)
+    value_range = np.nanmax(values) - lowest
+    if value_range == 0:
+        value_range = 1.0
+    # same order of operations as sklearn, so the normalized values match to the last bit
+    scale = 1.0 / value_range
+    return values * scale - lowest * scale
+
+
+def crossings_in_route(result, country):
+    # Every step that enters `country` is a crossing. Duration and distance are counted up to that step.
+    crossings = []
+    total_duration = 0
+    total_distance = 0
+    for idx, i in enumerate(result[0]['legs'][0]['steps']):
+        total_duration = total_duration + i["duration"]["value"]
+        total_distance = total_distance + i["distance"]["value"]
+        instr = i['html_instructions']
+        if 'Entering' in instr:
+            country_split = instr.split('Entering')[1].split("<")[0]
+            ratio = fuzz.token_set_ratio(country_split, country)
+            if ratio > 80:
+                crossings.append({"final_ind": idx,
+                                  "final_duration": total_duration,
+                                  "final_distance": total_distance,
+                                  "destination_country": country,
+                                  "result": result})
+    return crossings
+
+
+def route_pairs(pairs, camps, flight_mode, gmaps, gazetteer=None, failures=None):
+    '''
+    Gets directions for every (conflict city row, haven country) pair and returns the border crossings on each.
+    This is the most compute time.
+
+    The directions of all pairs are requested as one batch with `call_many`, then those of the pairs without any
+    directions to the largest cities of the haven country, so a job queue client spreads them over its workers.
+
+    Directions are requested between coordinates, so the routing service does not geocode names on every call.
+    A haven country is located at its largest city in the `gazetteer` (by default the one of CITY_FILE); a
+    country that is not in it is still sent by name.
+
+    A call that fails (after the retries of the client) is reported and its pair gets no crossings from it. The
+    error is also appended to `failures` when that list is given, so a caller can tell the result is incomplete.
+    '''
+    # check if a country is missing a crossing
+    def get_camp_city(country, ind):
+        city_data = camps[camps['country'] == country].iloc[ind][["#name", "country", "latitude", "longitude"]]
+        return city_data
+
+    def report(error):
+        print(error)
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+    if gazetteer is None:
+        gazetteer = load_gazetteer(CITY_FILE)
+    havens = {}
+    for _, country in pairs:
+        if country not in havens:
+            haven = gazetteer.country_point(country)
+            havens[country] = country if haven is None else haven[:2]
+
+    origins = [(conflict["latitude"], conflict["longitude"]) for conflict, _ in pairs]
+    found = [[] for _ in pairs]
+
+    results = call_many(
+        gmaps,
+        "directions",
+        [((origin, havens[country]), {"mode": flight_mode}) for origin, (_, country) in zip(origins, pairs)],
+    )
+    missing = []
+    for index, result in enumerate(results):
+        try:
+            if isinstance(result, Exception):
+                if failures is not None:
+                    failures.append(result)
+                raise result
+            if result:
+                found[index] = crossings_in_route(result, pairs[index][1])
+            else:
+                missing.append(index)
+        except Exception as e:
+            report(e)
+
+    for index_v in range(2):
+        # get largest border and conflict cities for directions.
+        fallbacks = []
+        for index in missing:
+            try:
+                largest_border_country_city = get_camp_city(pairs[index][1], index_v)
+            except Exception as e:
+                report(e)
+                continue
+            fallbacks.append((
+                index,
+                (largest_border_country_city["latitude"], largest_border_country_city["longitude"]),
+            ))
+        results = call_many(
+            gmaps,
+            "directions",
+            [
+                ((origins[index], destination), {"mode": flight_mode, "priority": Priority.FALLBACK})
+                for index, destination in fallbacks
+            ],
+        )
+        missing = []
+        for (index, _), directions in zip(fallbacks, results):
+            try:
+                if isinstance(directions, Exception):
+                    if failures is not None:
+                        failures.append(directions)
+                    raise directions
+                print('done with directions')
+                if directions:
+                    found[index].extend(crossings_in_route(directions, pairs[index][1]))
+                elif directions is None:
+                    missing.append(index)
+            except Exception as e:
+                report(e)
+
+    return found
+
+
+def find_crossings(conflicts, camps, touching_list, flight_mode, gmaps, gazetteer=None, failures=None):
+    '''
+    Gets directions from every conflict city to every haven country and returns the border crossings on them, as
+    {conflict city: crossing} items. Failed calls are appended to `failures` (see route_pairs).
+    '''
+    pairs = [(conflict, country) for kk, conflict in conflicts.iterrows() for country in touching_list]
+    found = route_pairs(pairs, camps, flight_mode, gmaps, gazetteer, failures)
+    return [{pairs[index][0]["#name"]: crossing} for index in range(len(pairs)) for crossing in found[index]]
+
+
+def haven_duration_estimates(conflicts, touching_list, country_codes, flight_mode):
+    '''
+    An estimate of the shortest duration, in seconds, from every conflict city (rows) to the border of every haven
+    country (columns): the great circle distance to the nearest city of the haven country, less BORDER_MARGIN_KM,
+    at the top speed of the travel mode. It is 0 for a mode without a top speed and for a country without cities.
+
+    This is not a lower bound: a border can be more than BORDER_MARGIN_KM from every listed city of the country.
+    '''
+    estimates = np.zeros((len(conflicts), len(touching_list)))
+    if flight_mode not in MAX_SPEEDS_KMH:
+        return estimates
+    city_df = load_reference_data()["cities"]
+    latitudes = conflicts["latitude"].to_numpy(dtype=float)[:, None]
+    longitudes = conflicts["longitude"].to_numpy(dtype=float)[:, None]
+    for column, country in enumerate(touching_list):
+        cities = city_df[city_df["country code"] == country_codes.get(country)]
+        if cities.empty:
+            continue
+        distances = haversine_km(
+            latitudes, longitudes, cities["latitude"].to_numpy(dtype=float), cities["longitude"].to_numpy(dtype=float)
+        ).min(axis=1)
+        estimates[:, column] = np.maximum(distances - BORDER_MARGIN_KM, 0) / MAX_SPEEDS_KMH[flight_mode] * 3600
+    return estimates
+
+
+def find_crossings_within_hops(conflicts, camps, touching_list, haven_hops, attractions, attraction_weight,
+                               flight_mode, gmaps, gazetteer=None, failures=None):
+    '''
+    find_crossings for havens more than one border away, which leaves out the pairs whose haven is not expected
+    to be chosen by select_crossings. Returns the crossings and {"pairs", "routed", "pruned"} counts of the far
+    pairs. The crossings are in the same order as find_crossings gives them, and failed calls are appended to
+    `failures`.
+
+    The havens are routed one hop level at a time, the neighbours (and added countries) of the conflict first. A
+    far haven is left out for a conflict city when a crossing already found for the city has no worse an
+    attraction score and a better score than the haven at its estimated duration (haven_duration_estimates).
+    Durations are scaled by the longest duration, which only grows as more is routed, so the haven would lose to
+    that crossing at any later scale. This is a heuristic and not the same as routing every pair: the estimate
+    is not a lower bound, and the routes left out do not count towards the longest duration, which can change
+    which of the routed crossings is chosen.
+    '''
+    pairs = [(conflict, country) for kk, conflict in conflicts.iterrows() for country in touching_list]
+    found = [None] * len(pairs)
+    shares = dict(zip(attractions["country"], attractions["predicted_shares"]))
+    country_codes = dict(zip(attractions["country"], attractions["country_code"]))
+    estimates = haven_duration_estimates(conflicts, touching_list, country_codes, flight_mode).reshape(-1)
+
+    def attraction_score(country):
+        share = shares.get(country, 0)
+        return 1 / math.sqrt(share) * attraction_weight if share > 0 else math.inf
+
+    def beaten(index, options, scale):
+        # some routed crossing scores better now and its attraction score is no worse, so it does at any scale
+        duration_score = estimates[index] * (1 - attraction_weight)
+        score = attraction_score(pairs[index][1])
+        return any(
+            attraction <= score and (duration_score - duration * (1 - attraction_weight)) / scale + score > attraction
+            for duration, attraction in options
+        )
+
+    far = [index for index, (_, country) in enumerate(pairs) if haven_hops.get(country, 1) > 1]
+    for level in sorted({max(haven_hops.get(country, 1), 1) for country in touching_list}):
+        crossings = [
+            {pairs[index][0]["#name"]: crossing} for index in range(len(pairs)) for crossing in found[index] or []
+        ]
+        longest = longest_durations(conflicts, crossings)
+        options = {}
+        for item in crossings:
+            for name, crossing in item.items():
+                options.setdefault(name, []).append(
+                    (crossing["final_duration"], attraction_score(crossing["destination_country"]))
+                )
+
+        batch = []
+        for index, (conflict, country) in enumerate(pairs):
+            if max(haven_hops.get(country, 1), 1) != level:
+                continue
+            name = conflict["#name"]
+            if level > 1 and longest.get(name) and beaten(index, options.get(name, []), longest[name]):
+                continue
+            batch.append(index)
+        routes = route_pairs([pairs[index] for index in batch], camps, flight_mode, gmaps, gazetteer, failures)
+        for index, crossings in zip(batch, routes):
+            found[index] = crossings
+
+    routed = sum(found[index] is not None for index in far)
+    return (
+        [{pairs[index][0]["#name"]: crossing} for index in range(len(pairs)) for crossing in found[index] or []],
+        {"pairs": len(far), "routed": routed, "pruned": len(far) - routed},
+    )
+
+
+def longest_durations(conflicts, conflict_city_to_haven_crossings):
+    '''
+    The longest crossing duration of every conflict city and the cities before it, which its durations are
+    scaled by.
+    '''
+    conflicts_longest_duration_values = {}
+    longest_duration = 0
+    for kk, conflict in conflicts.iterrows():
+
+        for vv in conflict_city_to_haven_crossings:
+            key = vv.keys()
+            if conflict["#name"] in key:
+                duration = vv[conflict["#name"]]['final_duration']
+                if duration > longest_duration:
+                    longest_duration = duration
+            else:
+                pass
+        conflicts_longest_duration_values[conflict["#name"]] = longest_duration
+    return conflicts_longest_duration_values
+
+
+def select_crossings(conflicts, conflict_city_to_haven_crossings, attractions, attraction_weight, origins=None):
+    '''
+    Picks the crossing each conflict city goes to, weighing the trip duration against the attraction score of
+    the haven country. Returns the longest durations used to normalize durations and the chosen crossings.
+    When `origins` is given only those conflict cities get a crossing chosen.
+    '''
+    conflicts_longest_duration_values = longest_durations(conflicts, conflict_city_to_haven_crossings)
+
+    all_directions = {}
+
+    for kk, conflict in conflicts.iterrows():
+        if origins is not None and conflict["#name"] not in origins:
+            continue
+        try:
+            shortest_seconds = 100000000000
+            final_index_=None
+            for kk, vv in enumerate(conflict_city_to_haven_crossings):
+                key = vv.keys()
+                if conflict["#name"] in key:
+                    duration = vv[conflict["#name"]]['final_duration']
+                    country_ = vv[conflict["#name"]]['destination_country']
+
+                    country, ratio, idx = process.extractOne(country_, attractions["country"])
+
+                    attraction = attractions[
+                        attractions["country"] == country
+                    ].predicted_shares.iloc[0]
+
+                    seconds = (duration / conflicts_longest_duration_values[conflict["#name"]]) * (
+                                1 - attraction_weight) + (1 / math.sqrt(attraction)) * attraction_weight
+                    if seconds < shortest_seconds:
+                        shortest_seconds = seconds
+                        final_index_ = kk
+
+                else:
+                    pass
+
+            all_directions[conflict['#name']] = conflict_city_to_haven_crossings[final_index_][conflict["#name"]]
+        except Exception as e:
+            traceback.print_exc()
+            print(e)
+
+    return conflicts_longest_duration_values, all_directions
+
+
+def exit_routes(origins, all_directions):
+    '''
+    Returns the destination country and the latitude and longitude of the border crossing of the route chosen for
+    every origin city, as three lists. Cities without a route get None.
+    '''
+    destinations, latitudes, longitudes = [], [], []
+    for origin in origins:
+        crossing = all_directions.get(origin)
+        if crossing is None or not crossing["result"] or crossing["result"][0] is None:
+            destinations.append(None)
+            latitudes.append(None)
+            longitudes.append(None)
+            continue
+        end_location = crossing["result"][0]["legs"][0]["steps"][crossing["final_ind"]]["end_location"]
+        destinations.append(crossing["destination_country"])
+        latitudes.append(end_location["lat"])
+        longitudes.append(end_location["lng"])
+    return destinations, latitudes, longitudes
+
+
+def flow_matrix(refugees):
+    '''
+    The estimated refugees as a sparse origin city x border crossing matrix. A crossing is labelled
+    (destination country, latitude, longitude); cities without a route are left out.
+    '''
+    crossings = [
+        None if pd.isna(country) else (country, latitude, longitude)
+        for country, latitude, longitude in zip(
+            refugees["destination country"], refugees["latitude"], refugees["longitude"]
+        )
+    ]
+    return FlowMatrix.from_records(refugees["origin city"], crossings, refugees["total refugees"].to_numpy())
+
+
+def estimate_refugees(
+        conflicts,
+        all_directions,
+        flight_mode,
+        conflict_country_historic_pop,
+        percent_of_pop_leaving,
+        conflict_start_year,
+):
+    # Calculate Recipient Country Refugee Counts
+    conflicts = conflicts.copy()
+    destinations, latitudes, longitudes = exit_routes(conflicts["#name"], all_directions)
+    conflicts[f"{flight_mode}_destination"] = destinations
+    conflicts["latitude"] = latitudes
+    conflicts["longitude"] = longitudes
+
+    conflict_country_historic_pop = int(conflict_country_historic_pop)
+    conflicts["pop_percent_of_conflict_cities"] = (
+        conflicts["population"] / conflicts["population"].sum()
+    )
+    conflicts[f"refugee_estimated_leaving_via_{flight_mode}"] = conflicts[
+        "pop_percent_of_conflict_cities"
+    ] * (conflict_country_historic_pop * percent_of_pop_leaving)
+    conflicts['conflict_year'] = conflict_start_year
+
+    # reduce size of output file
+    COL = ["#name", "country", "conflict_year", f"{flight_mode}_destination", "latitude", "longitude",
+           f"refugee_estimated_leaving_via_{flight_mode}"]
+    reduced_conflicts = conflicts[COL]
+    reduced_conflicts = reduced_conflicts.rename(columns={"#name": "origin city", "country": "origin country",
+                                                          f"{flight_mode}_destination": "destination country",
+                                                          f"refugee_estimated_leaving_via_{flight_mode}": "total refugees"})
+    reduced_conflicts['total refugees'] = reduced_conflicts['total refugees'].astype('int')
+
+    return reduced_conflicts, refugees_by_country(reduced_conflicts)
+
+
+def refugees_by_country(refugees):
+    by_country = flow_matrix(refugees).crossing_totals(lambda crossing: crossing[0]).sort_index()
+    return pd.DataFrame({"country": by_country.index, "total refugees": by_country.values})
+
+
+def crossing_options(refugees, conflict_city_to_haven_crossings, attractions, attraction_weight,
+                     conflicts_longest_duration_values):
+    '''
+    Returns every crossing found for the origin cities of `refugees` that have a route, as a table of options
+    sorted by origin with the origin index, the destination country, latitude and longitude of the crossing and
+    its base cost in seconds.
+
+    The base cost is the trip duration plus the attraction term of select_crossings scaled to seconds, so the
+    cheapest option of an origin is the crossing select_crossings chooses.
+    '''
+    if attraction_weight >= 1:
+        raise ValueError("Crossing capacities need an attraction_weight below 1, the trip duration has no weight at 1")
+    origin_index = {
+        origin: index for index, (origin, country) in enumerate(
+            zip(refugees["origin city"], refugees["destination country"])
+        ) if not pd.isna(country)
+    }
+    attraction_of = {}
+    options = []
+    for vv in conflict_city_to_haven_crossings:
+        for origin, crossing in vv.items():
+            if origin not in origin_index:
+                continue
+            country_ = crossing["destination_country"]
+            if country_ not in attraction_of:
+                country, ratio, idx = process.extractOne(country_, attractions["country"])
+                attraction_of[country_] = attractions[attractions["country"] == country].predicted_shares.iloc[0]
+            end_location = crossing["result"][0]["legs"][0]["steps"][crossing["final_ind"]]["end_location"]
+            options.append((
+                origin_index[origin],
+                country_,
+                end_location["lat"],
+                end_location["lng"],
+                crossing["final_duration"] + (1 / math.sqrt(attraction_of[country_])) * attraction_weight
+                * conflicts_longest_duration_values[origin] / (1 - attraction_weight),
+            ))
+    options = pd.DataFrame(options, columns=["origin", "destination country", "latitude", "longitude", "cost"])
+    return options.sort_values("origin", kind="stable", ignore_index=True)
+
+
+def crossing_capacities(crossings, crossing_capacity):
+    '''
+    Returns the capacity of every crossing, (destination country, latitude, longitude). `crossing_capacity` has a
+    "default" capacity (unlimited without one) and "crossings", a list of {"latitude", "longitude", "radius_km",
+    "country", "capacity"} with the capacity of the crossings within radius_km (10 by default) of the point, and
+    of that country only when "country" is given. The first entry that matches a crossing is used.
+    '''
+    capacities = np.full(len(crossings), float(crossing_capacity.get("default") or np.inf))
+    for index, (country, latitude, longitude) in enumerate(crossings):
+        for limit in crossing_capacity.get("crossings", []):
+            if limit.get("country") and process.extractOne(limit["country"], [country])[1] <= 89:
+                continue
+            if haversine_km(latitude, longitude, limit["latitude"], limit["longitude"]) <= limit.get("radius_km", 10):
+                capacities[index] = limit["capacity"]
+                break
+    return capacities
+
+
+def assign_refugees(refugees, conflict_city_to_haven_crossings, attractions, attraction_weight,
+                    conflicts_longest_duration_values, crossing_capacity):
+    '''
+    Spreads the refugees of every origin city over its crossings when crossings have a limited capacity, instead
+    of sending all of them to the crossing select_crossings chose. Past its capacity the wait at a crossing grows
+    quickly (a BPR function, `wait_hours_at_capacity` at capacity, 12 by default, with exponent `beta`, 4 by
+    default), and the refugees are assigned until no one would reach a haven sooner through another crossing
+    (routing_common.assignment, with `method` "frank-wolfe" or "msa").
+
+    Crossings less than about a kilometre apart share their capacity. Returns the refugees with one row per origin
+    city and crossing used, the totals per country and the load of every crossing.
+    '''
+    options = crossing_options(
+        refugees, conflict_city_to_haven_crossings, attractions, attraction_weight, conflicts_longest_duration_values
+    )
+    crossing_ids = list(zip(
+        options["destination country"], options["latitude"].round(2), options["longitude"].round(2)
+    ))
+    crossing_index, crossings = pd.factorize(pd.Series(crossing_ids, dtype=object))
+    capacities = crossing_capacities(crossings, crossing_capacity)
+
+    routed = refugees["destination country"].notna().to_numpy()
+    # origins are numbered by their row in `refugees`, assign numbers them by routed origin
+    routed_index = np.cumsum(routed) - 1
+    origins = routed_index[options["origin"].to_numpy()]
+    demands = refugees["total refugees"].to_numpy()[routed]
+    result = assign(
+        options["cost"].to_numpy(),
+        origins,
+        crossing_index,
+        demands,
+        BPR(capacities, crossing_capacity.get("wait_hours_at_capacity", 12) * 3600, crossing_capacity.get("beta", 4)),
+        method=crossing_capacity.get("method", "frank-wolfe"),
+    )
+    print(f"assigned refugees to {len(crossings)} crossings in {result.iterations} iterations, "
+          f"relative gap {result.relative_gap:.2g}")
+    if not result.converged:
+        print("crossing assignment did not converge, using the last iteration")
+    flows = round_flows(result.flows, origins, demands)
+
+    used = options[flows > 0]
+    assigned = refugees.iloc[used["origin"]].reset_index(drop=True)
+    assigned["destination country"] = used["destination country"].to_numpy()
+    assigned["latitude"] = used["latitude"].to_numpy()
+    assigned["longitude"] = used["longitude"].to_numpy()
+    assigned["total refugees"] = flows[flows > 0]
+    # origins without a route keep their row, in the order of `refugees`
+    order = np.concatenate([used["origin"].to_numpy(), np.flatnonzero(~routed)])
+    assigned = pd.concat([assigned, refugees[~routed]], ignore_index=True)
+    assigned = assigned.iloc[np.argsort(order, kind="stable")].reset_index(drop=True)
+
+    loads = np.bincount(crossing_index, weights=flows, minlength=len(crossings)).astype(np.int64)
+    crossing_loads = pd.DataFrame({
+        "destination country": [crossing[0] for crossing in crossings],
+        "latitude": [crossing[1] for crossing in crossings],
+        "longitude": [crossing[2] for crossing in crossings],
+        "capacity": capacities,
+        "total refugees": loads,
+        "wait hours": np.round(result.waits / 3600, 2),
+    })
+    crossing_loads = crossing_loads.sort_values("total refugees", ascending=False, kind="stable", ignore_index=True)
+    return assigned, refugees_by_country(assigned), crossing_loads
+
+
+def crossings_by_key(conflict_city_to_haven_crossings):
+    '''
+    The crossings found for every conflict city by (conflict city, destination country, latitude, longitude), the
+    key of a crossing in the refugees tables.
+    '''
+    crossings = {}
+    for vv in conflict_city_to_haven_crossings:
+        for origin, crossing in vv.items():
+            end_location = crossing["result"][0]["legs"][0]["steps"][crossing["final_ind"]]["end_location"]
+            crossings.setdefault(
+                (origin, crossing["destination_country"], end_location["lat"], end_location["lng"]), crossing
+            )
+    return crossings
+
+
+def refugee_routes(refugees, conflict_city_to_haven_crossings):
+    '''
+    The route of every row of `refugees` with a crossing, and its refugees, as {route id: crossing}, {route id:
+    refugees} and {route id: conflict city}. The route id is the conflict city when all its refugees take one
+    route; with crossing capacities, a city whose refugees are spread over several crossings has one route to each,
+    named after the city and the crossing.
+    '''
+    crossings_of = crossings_by_key(conflict_city_to_haven_crossings)
+    refugees = refugees[refugees["destination country"].notna()]
+    rows_of = refugees["origin city"].value_counts()
+    routes, flows, origins = {}, {}, {}
+    for key, total in zip(
+        zip(refugees["origin city"], refugees["destination country"], refugees["latitude"], refugees["longitude"]),
+        refugees["total refugees"],
+    ):
+        origin, country, latitude, longitude = key
+        route_id = origin if rows_of[origin] == 1 else f"{origin} to {country} ({latitude:.4f}, {longitude:.4f})"
+        routes[route_id] = crossings_of[key]
+        flows[route_id] = total
+        origins[route_id] = origin
+    return routes, flows, origins
+
+
+def simulate_arrivals(refugees, conflict_city_to_haven_crossings, simulation):
+    '''
+    Simulates the refugees of every origin city leaving over time and travelling to their crossing, and returns
+    the people who left, are on the way, got to the crossing, crossed and are waiting there on every day, per
+    crossing and per destination country (routing_common.movement).
+
+    `simulation` has the number of `days` (60 by default), the `departure_curve` ("exponential" by default, with
+    `half_life_days` 7, "uniform" over `departure_days` 14, or a weight per day), the `step_hours` of the
+    simulation (1), the `travel_hours_per_day` (24) and `crossing_throughput`, the people per day each crossing
+    takes, with a "default" and "crossings" like crossing_capacity (unlimited by default). The route to a crossing
+    is the steps of its directions up to the crossing, with their cumulative durations.
+    '''
+    days = simulation.get("days", 60)
+    step_hours = simulation.get("step_hours", 1)
+    shares = departure_curve(
+        simulation.get("departure_curve", "exponential"),
+        days,
+        departure_days=simulation.get("departure_days", 14),
+        half_life_days=simulation.get("half_life_days", 7),
+    )
+
+    refugees = refugees[refugees["destination country"].notna() & (refugees["total refugees"] > 0)]
+    crossings_of = crossings_by_key(conflict_city_to_haven_crossings)
+    durations = []
+    keys = zip(refugees["origin city"], refugees["destination country"], refugees["latitude"], refugees["longitude"])
+    for key in keys:
+        steps = crossings_of[key]["result"][0]["legs"][0]["steps"][:crossings_of[key]["final_ind"] + 1]
+        durations.append(np.cumsum([step["duration"]["value"] for step in steps]))
+    indptr = np.cumsum([0] + [len(steps) for steps in durations])
+    cumulative_durations = np.concatenate(durations) if durations else np.zeros(0)
+
+    crossing_ids = list(zip(
+        refugees["destination country"],
+        refugees["latitude"].astype(float).round(2),
+        refugees["longitude"].astype(float).round(2),
+    ))
+    crossing_index, crossings = pd.factorize(pd.Series(crossing_ids, dtype=object))
+    throughputs = crossing_capacities(crossings, simulation.get("crossing_throughput") or {})
+    movement = simulate(
+        indptr,
+        cumulative_durations,
+        crossing_index,
+        refugees["total refugees"].to_numpy(),
+        throughputs,
+        shares,
+        step_hours=step_hours,
+        travel_hours_per_day=simulation.get("travel_hours_per_day", 24),
+    )
+
+    by_crossing = pd.DataFrame({
+        "destination country": np.repeat([crossing[0] for crossing in crossings], movement.days),
+        "latitude": np.repeat([crossing[1] for crossing in crossings], movement.days),
+        "longitude": np.repeat([crossing[2] for crossing in crossings], movement.days),
+        "day": np.tile(np.arange(movement.days), len(crossings)),
+        "departed": movement.departed.ravel(),
+        "en route": movement.en_route.ravel(),
+        "arrived": movement.arrived.ravel(),
+        "crossed": movement.crossed.ravel(),
+        "waiting": movement.waiting.ravel(),
+    })
+    by_country = by_crossing.drop(columns=["latitude", "longitude"]).groupby(
+        ["destination country", "day"], sort=False, as_index=False
+    ).sum()
+    by_country["total crossed"] = by_country.groupby("destination country", sort=False)["crossed"].cumsum()
+    return by_crossing, by_country
+
+
+def nearest_haven_cities(crossings, camps):
+    '''
+    Returns the haven city nearest to each crossing, (destination country, latitude, longitude), among the cities
+    of its destination country in `camps`, as a (city, country) pair or None.
+    '''
+    havens = {}
+    for country, cities in camps.groupby("country"):
+        havens[country] = (
+            cities["#name"].tolist(), cities["latitude"].to_numpy(float), cities["longitude"].to_numpy(float)
+        )
+    nearest = []
+    for country, latitude, longitude in crossings:
+        if country not in havens:
+            nearest.append(None)
+            continue
+        names, latitudes, longitudes = havens[country]
+        distances = haversine_km(latitude, longitude, latitudes, longitudes)
+        nearest.append((names[int(np.argmin(distances))], country))
+    return nearest
+
+
+def refugee_breakdowns(refugees, conflicts, camps):
+    '''
+    Breaks the estimated refugees of a travel mode down by border crossing, by admin region (GeoNames admin1, as
+    "UA.12") of the origin city and destination country, and by haven city, the largest city of the destination country
+    nearest to the crossing. Every breakdown is an aggregation of the origin x crossing flow matrix.
+    '''
+    flows = flow_matrix(refugees)
+    haven_cities = nearest_haven_cities(flows.crossings, camps)
+
+    by_crossing = flows.crossing_totals()
+    crossings = pd.DataFrame({
+        "destination country": [crossing[0] for crossing in flows.crossings],
+        "latitude": [crossing[1] for crossing in flows.crossings],
+        "longitude": [crossing[2] for crossing in flows.crossings],
+        "haven city": [None if haven is None else haven[0] for haven in haven_cities],
+        "total refugees": by_crossing.values,
+    })
+
+    admin_regions = {
+        # cities without an admin1 code are counted under their country code
+        name: country_code if pd.isna(admin1) else f"{country_code}.{admin1}"
+        for name, country_code, admin1 in zip(conflicts["#name"], conflicts["country code"], conflicts["admin1 code"])
+    }
+    by_admin = flows.aggregate(admin_regions, lambda crossing: crossing[0]).to_frame(
+        "admin region", "destination country", "total refugees"
+    )
+
+    by_haven = flows.crossing_totals(haven_cities)
+    havens = pd.DataFrame({
+        "haven city": [haven[0] for haven in by_haven.index],
+        "country": [haven[1] for haven in by_haven.index],
+        "total refugees": by_haven.values,
+    })
+
+    return {
+        "by_crossing": crossings.sort_values("total refugees", ascending=False, kind="stable", ignore_index=True),
+        "by_admin_region": by_admin.sort_values(
+            ["admin region", "destination country"], kind="stable", ignore_index=True
+        ),
+        "by_haven_city": havens.sort_values("total refugees", ascending=False, kind="stable", ignore_index=True),
+    }
+
+
+def draw_map(conflicts, touching_list, mode_results):
+    '''
+    Draws the conflict cities and, with one layer per travel mode, the crossings and the chosen routes. Returns
+    the map as HTML. Routes are drawn from each mode's route store, so a road shared by several routes is drawn
+    once.
+    '''
+    # mapping and shape utils
+    import folium
+    from folium import plugins
+
+    c_desc = conflicts.population.describe()
+
+    def bucket_population( population):
+        if population <= c_desc["25%"]:
+            stroke = 2.5
+        elif population <= c_desc["50%"]:
+            stroke = 5
+        elif population <= c_desc["75%"]:
+            stroke = 7.5
+        else:
+            stroke = 10
+        return stroke
+
+    conflicts = conflicts.copy()
+    conflicts["stroke"] = conflicts["population"].apply(
+        lambda x: bucket_population(x)
+    )
+    country_colors = {}
+    for i, c in enumerate(touching_list):
+        # havens further away than the neighbours can outnumber the colors
+        country_colors[c] = colors_[i % len(colors_)]
+    map = folium.Map(location=[conflicts.latitude.mean(), conflicts.longitude.mean()], zoom_start=6)
+
+    # Plot conflict starting points
+    for kk, start in conflicts.iterrows():
+        start_m = folium.Marker(
+            [start.latitude, start.longitude],
+            popup=start["#name"],
+            icon=folium.Icon(icon="glyphicon glyphicon-fire", color="darkred"),
+        )
+        start_m.add_to(map)
+
+    for flight_mode, result in mode_results.items():
+        style = MODE_STYLES.get(flight_mode, {"layer": flight_mode.title(), "text": f"by {flight_mode}", "color": "#4A89F3"})
+        fg = folium.FeatureGroup(style["layer"])
+
+        # plot crossings
+        for kk, conflict in conflicts.iterrows():
+            for crossing in result["crossings"]:
+
+                key = crossing.keys()
+                if conflict["#name"] in key:
+                    lat = crossing[conflict["#name"]]["result"][0]['legs'][0]['steps'][
+                        crossing[conflict["#name"]]["final_ind"]]['end_location']['lat']
+                    lng = crossing[conflict["#name"]]["result"][0]['legs'][0]['steps'][
+                        crossing[conflict["#name"]]["final_ind"]]['end_location']['lng']
+                    crossing_m = folium.Marker(
+                        [lat, lng],
+                        popup=f'{crossing[conflict["#name"]]["destination_country"]}_crossing',
+                        icon=folium.Icon(
+                            icon="glyphicon glyphicon-road",
+                            color=country_colors[crossing[conflict["#name"]]['destination_country']],
+                        ),
+                    )
+                    crossing_m.add_to(fg)
+
+        # plot exit routes, one line per road segment
+        route_store = result["route_store"]
+        tooltips = {}
+        strokes = {}
+        for kk, route in route_store.properties.items():
+            origin = route['origin_city']
+            stroke = float(conflicts[conflicts['#name'] == origin]['stroke'].iloc[0])
+            population = "{:,}".format(int(conflicts[conflicts['#name'] == origin]['population'].iloc[0]))
+            distance = route['distance_meters']
+            duration = route['duration_seconds']
+            end_location = route['destination_country']
+
+            end_country = end_location
+            tooltips[kk] = f"Travel between <b>{origin}</b> and <b>{end_location}, {end_country}</b> {style['text']} is <b>" \
+                           f"{distance}</b> and takes <b>{duration}</b>.</br></br>" \
+                           f"<b>{population}</b> people are effected by this conflict."
+            strokes[kk] = stroke
+        segment_ids = list(route_store.segments)
+        lines = [route_store.segments[segment_id]["coordinates"] for segment_id in segment_ids]
+        coordinates, offsets = simplify(
+            np.concatenate(lines) if lines else np.zeros((0, 2)),
+            np.concatenate(([0], np.cumsum([len(line) for line in lines]))).astype(np.int64),
+            MAP_TOLERANCE,
+        )
+        for segment_id, start, end in zip(segment_ids, offsets[:-1], offsets[1:]):
+            routes = route_store.segments[segment_id]["routes"]
+            if len(routes) == 1:
+                tooltip = tooltips[routes[0]]
+            else:
+                tooltip = f"<b>{len(routes)}</b> routes {style['text']} share this road: <b>{', '.join(routes)}</b>." \
+                          f"</br></br><b>{int(result['segment_flows'][segment_id]):,}</b> refugees take it."
+            polyline_m = folium.PolyLine(
+                coordinates[start:end].tolist(),
+                color=style["color"],
+                tooltip=tooltip,
+                weight=max(strokes[kk] for kk in routes),
+            )
+            polyline_m.add_to(fg)
+        fg.add_to(map)
+
+    basemaps = get_basemaps()
+    basemaps["Google Satellite Hybrid"].add_to(map)
+    # basemaps['Esri Satellite'].add_to(map)
+    # basemaps['Google Satellite'].add_to(map)
+    basemaps["Google Maps"].add_to(map)
+
+    # Add a layer control panel to the map when there are several travel modes to switch between.
+    if len(mode_results) > 1:
+        map.add_child(folium.LayerControl())
+    plugins.Fullscreen().add_to(map)
+
+    map = add_legend(map)
+    return map.get_root().render()
+
+
+def year_rows(table, year):
+    '''
+    The rows of a country-year table for `year`, or for the closest year it has (the earlier one on a tie),
+    numbered from 0 in the order of the table.
+    '''
+    years = np.unique(table["year"])
+    closest = years[np.argmin(np.abs(years - int(year)))]
+    return table[table["year"] == closest].reset_index(drop=True)
+
+
+def country_features(conflict_start):
+    '''
+    The population, liberal democracy and GDP of every country that has all three for `conflict_start`, by ISO
+    alpha-2 code. Population and GDP are matched by their ISO alpha-3 code, democracy by its country name.
+    '''
+    reference = load_reference_data()
+    _, country_codes = read_country_keys()
+    population = year_rows(reference["population"], conflict_start)
+    gdp = year_rows(reference["gdp"], conflict_start)
+    democracy = reference["democracy"]
+    democracy = democracy[democracy["year"] == int(conflict_start)]
+
+    populations = {
+        country_codes.get(str(code).lower()): value
+        for code, value in zip(population["country_code"], population["population"])
+    }
+    gdps = {country_codes.get(str(code).lower()): value for code, value in zip(gdp["country_code"], gdp["gdp"])}
+    features = {}
+    for code, libdem in zip(canonical_codes(democracy["country_name"]), democracy["v2x_libdem"]):
+        if code in populations and code in gdps and code not in features:
+            features[code] = {"population": populations[code], "v2x_libdem": libdem, "gdp": gdps[code]}
+    return features
+
+
+def build_features(conflict_country, conflict_start, excluded_countries, added_countries, haven_hops=1):
+    '''
+    Finds the haven countries of the conflict and collects their population, liberal democracy and normalized
+    GDP features for the year before the conflict.
+
+    With `haven_hops` above 1 the havens are every country up to that many borders away, not only the
+    neighbours. The returned "haven_hops" gives the number of borders to each haven (1 for added countries).
+    '''
+    reference = load_reference_data()
+    # read in country border data
+    countries_that_border = reference["country_borders"]
+    # get list of touching countries
+    touching_list = []
+    touching_list = list(countries_that_border[conflict_country])
+    hops_away = {}
+    # features of the havens past the neighbours, which are looked up by country code
+    far_havens = {}
+    if haven_hops > 1:
+        country_graph = load_country_graph()
+        hops_away = dict(country_graph.within(conflict_country, haven_hops))
+        features_by_code = country_features(conflict_start)
+        no_data = []
+        for country, hops in hops_away.items():
+            if hops < 2:
+                continue
+            code = country_graph.codes[country_graph.index(country)]
+            if code in features_by_code:
+                far_havens[country] = features_by_code[code]
+                touching_list.append(country)
+            else:
+                no_data.append(country)
+        if no_data:
+            print(f"Havens without population, democracy or GDP data are left out: {', '.join(no_data)}")
+
+    # remove any countries that are to be excluded
+    indexed_list = {}
+    for i, c in enumerate(touching_list):
+        indexed_list[i] = c
+
+    if len(excluded_countries) > 0:
+        if "," in excluded_countries:
+            excluded_countries = excluded_countries.split(',')
+        else:
+            excluded_countries = [excluded_countries]
+        for i, ex in enumerate(excluded_countries):
+            country, value, ind = process.extractOne(ex, indexed_list)
+            if value > 89:
+                touching_list.pop(ind)
+                indexed_list = {}
+                for i, c in enumerate(touching_list):
+                    indexed_list[i] = c
+
+    if len(added_countries) > 0:
+        if ',' in added_countries:
+            added_countries = added_countries.split(',')
+        else:
+            added_countries = [added_countries]
+
+        if len(added_countries) > 3:
+            added_countries = added_countries[0:3]
+            print(f'Model run has too many added countries. We will only use: {added_countries}')
+        # add any countries
+        for country_v in added_countries:
+            if haven_hops > 1 and country_graph.index(country_v) in {country_graph.index(c) for c in touching_list}:
+                continue
+            touching_list.append(country_v)
+
+    # convert to a df
+    touching_df = pd.DataFrame(touching_list, columns=["bording_countries"])
+    touching_df["conflict"] = conflict_country
+
+    # start collecting data for these countries
+    # collect historic pop
+    historic_pop = year_rows(reference["population"], conflict_start)
+
+    options = historic_pop["country_name"]
+    touching_df["historic_pop"] = None
+
+    for kk, border in touching_df.iterrows():
+        if border["bording_countries"] in far_havens:
+            touching_df.loc[kk, "historic_pop"] = far_havens[border["bording_countries"]]["population"]
+            continue
+        country, ratio, ind = process.extractOne(
+            border["bording_countries"], options
+        )
+        touching_df.loc[kk, "historic_pop"] = historic_pop.at[ind, "population"]
+
+    # get historic pop of conflict country for later use
+    country, ratio, ind = process.extractOne(conflict_country, options)
+    conflict_country_historic_pop = int(historic_pop.at[ind, "population"])
+
+    # read in liberal democracy data
+    country_dem = reference["democracy"]
+
+    touching_df["v2x_libdem"] = None
+
+    options = country_dem["country_name"].unique()
+
+    for kk, row in touching_df.iterrows():
+        if row["bording_countries"] in far_havens:
+            touching_df.loc[kk, "v2x_libdem"] = far_havens[row["bording_countries"]]["v2x_libdem"]
+            continue
+        country, ratio = process.extractOne(row["bording_countries"], options)
+        lib = country_dem.loc[
+            (country_dem["country_name"] == country)
+            & (country_dem["year"] == int(conflict_start))
+        ]["v2x_libdem"]
+
+        touching_df.loc[kk, "v2x_libdem"] = lib.to_list()[0]
+
+    # historic GDP
+    historic_GDP = year_rows(reference["gdp"], conflict_start)
+    options = historic_GDP["country_name"]
+    touching_df["historic_GDP"] = None
+
+    for kk, border in touching_df.iterrows():
+        if border["bording_countries"] in far_havens:
+            touching_df.loc[kk, "historic_GDP"] = far_havens[border["bording_countries"]]["gdp"]
+            continue
+        country, ratio, ind = process.extractOne(
+            border["bording_countries"], options
+        )
+        touching_df.loc[kk, "historic_GDP"] = historic_GDP.at[ind, "gdp"]
+
+    # normalize the GDP data
+    cols_to_scale = ["historic_GDP"]
+    touching_df = touching_df.rename(columns={"bording_countries": "country"})
+
+    for col in cols_to_scale:
+        normed = []
+
+        for y, x in touching_df.groupby("conflict"):
+            norm_ = list(min_max_scale(x[col].values))
+            countries = x["country"]
+            conflict_ = x["conflict"]
+            res = pd.DataFrame(
+                tuple(zip(countries, conflict_, norm_)),
+                columns=["country", "conflict", f"{col}_norm"],
+            )
+            normed.append(res)
+        normalized_data = pd.merge(
+            touching_df,
+            pd.concat(normed),
+            left_on=["country", "conflict"],
+            right_on=["country", "conflict"],
+            how="right",
+        )
+
+    return {
+        "touching_list": touching_list,
+        "haven_hops": {country: hops_away.get(country, 1) for country in touching_list},
+        "normalized_data": normalized_data,
+        "conflict_country_historic_pop": conflict_country_historic_pop,
+    }
+
+
+def predict_shares(normalized_data, drop_missing_data):
+    '''
+    Predicts the attraction score (share of refugees) of every haven country with the trained model.
+    '''
+    reference = load_reference_data()
+    # modeling
+    # read in model
+    trained_Model = reference["model"]
+    features_cols = [
+        "historic_GDP_norm",
+        "v2x_libdem",
+    ]
+    # missing data set to 0.
+    if drop_missing_data == True:
+        normalized_data = normalized_data.dropna()
+    else:
+        normalized_data = normalized_data.fillna(0)
+
+    features_to_predict = normalized_data[features_cols]
+    shares = trained_Model.predict(features_to_predict)
+    normalized_data["predicted_shares"] = shares
+    return normalized_data[
+        [
+            "country",
+            "conflict",
+            "historic_pop",
+            "historic_GDP_norm",
+            "v2x_libdem",
+            "predicted_shares",
+        ]
+    ]
+
+
+def select_locations(border_countries_results, conflict_country, number_conflict_cities, number_haven_cities):
+    '''
+    Picks the largest cities of the conflict country and of every haven country. Returns the haven countries with
+    their country codes and the locations.
+    '''
+    reference = load_reference_data()
+    city_df = reference["cities"]
+
+    # read in csv file with country names and codes.
+    codes = reference["country_codes"]
+
+    # Get country codes for each have country
+    border_countries_results = border_countries_results.copy()
+    options = codes["English short name lower case"]
+
+    for kk, border in border_countries_results.iterrows():
+        country, ratio, ind = process.extractOne(border["country"], options)
+        border_countries_results.loc[kk, "country_code"] = codes.at[
+            ind, "Alpha-2 code"
+        ]
+
+    # get conflict country country code
+    country, ratio, ind = process.extractOne(
+        border_countries_results["conflict"][0], options
+    )
+    conflict_code = codes.at[ind, "Alpha-2 code"]
+
+    # Filter cites by country code and population
+    filtered_df = city_df[city_df["country code"] == conflict_code]
+    filtered_df = filtered_df.sort_values(by="population", ascending=False)
+    largest_conflict_cities = filtered_df[0:number_conflict_cities].copy()
+    largest_conflict_cities["country"] = conflict_country
+    largest_conflict_cities["location_type"] = "conflict_zone"
+
+    # Do the same for camp/haven countries. These will help create more routes to find crossings.
+    largest_camp_cities = []
+    for kk, border in border_countries_results.iterrows():
+        filtered_df = city_df[city_df["country code"] == border["country_code"]].copy()
+        filtered_df["country"] = border["country"]
+        filtered_df = filtered_df.sort_values(by="population", ascending=False)
+        largest_camp_cities.append(filtered_df[0:number_haven_cities])
+    if largest_camp_cities:
+        largest_camp_cities = pd.concat(largest_camp_cities)
+    else:
+        largest_camp_cities = pd.DataFrame(columns=list(city_df.columns) + ["country"])
+    largest_camp_cities["location_type"] = "camp"
+
+    # merge these two df together. Concatenating whole frames keeps the column types, so the locations do not
+    # have to be written out and read back to get numeric columns.
+    largest_conflict_cities = pd.concat([largest_conflict_cities, largest_camp_cities])
+
+    # change column name
+    locations = largest_conflict_cities.rename(columns={"name": "#name"}).infer_objects()
+
+    return border_countries_results, locations
+
+
+def write_segments_geojson(path, route_store, segment_flows):
+    '''
+    Writes the road segments of a route store with the routes and number of refugees that use them as GeoJSON.
+    '''
+    features = []
+    for segment_id, segment in route_store.segments.items():
+        features.append({
+            "type": "Feature",
+            "id": segment_id,
+            # GeoJSON coordinates are (longitude, latitude)
+            "geometry": {"type": "LineString", "coordinates": segment["coordinates"][:, ::-1].tolist()},
+            "properties": {
+                "routes": segment["routes"],
+                "refugees": int(segment_flows[segment_id]),
+                "length_meters": round(segment["length_meters"], 1),
+            },
+        })
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+
+def write_parquet_outputs(output_prefix, conflicts, mode_results, row_group_size=10000):
+    '''
+    Writes the origins, candidate crossings, chosen routes, road segments and refugee flows of every travel mode
+    as Parquet tables (GeoParquet for the tables with a geometry) next to the CSV and JSON outputs. Returns their
+    paths.
+    '''
+    paths = {
+        table: f"{output_prefix}_{table}.parquet" for table in ("origins", "crossings", "routes", "segments", "flows")
+    }
+
+    with TableWriter(paths["origins"], "origins", row_group_size) as origins:
+        for kk, conflict in conflicts.iterrows():
+            origins.add(
+                origin_city=conflict["#name"],
+                origin_country=conflict["country"],
+                population=int(conflict["population"]),
+                latitude=float(conflict["latitude"]),
+                longitude=float(conflict["longitude"]),
+                geometry=wkb_point(conflict["latitude"], conflict["longitude"]),
+            )
+
+    def crossing_id(crossing):
+        return crossing["destination_country"], crossing["final_ind"], crossing["final_duration"]
+
+    with TableWriter(paths["crossings"], "crossings", row_group_size) as crossings, \
+            TableWriter(paths["routes"], "routes", row_group_size) as routes:
+        for flight_mode, result in mode_results.items():
+            all_directions = result["all_directions"]
+            for vv in result["crossings"]:
+                for origin, crossing in vv.items():
+                    end_location = crossing["result"][0]["legs"][0]["steps"][crossing["final_ind"]]["end_location"]
+                    chosen = all_directions.get(origin)
+                    crossings.add(
+                        travel_mode=flight_mode,
+                        origin_city=origin,
+                        destination_country=crossing["destination_country"],
+                        step_index=crossing["final_ind"],
+                        duration_seconds=crossing["final_duration"],
+                        distance_meters=crossing["final_distance"],
+                        latitude=end_location["lat"],
+                        longitude=end_location["lng"],
+                        selected=chosen is not None and crossing_id(chosen) == crossing_id(crossing),
+                        geometry=wkb_point(end_location["lat"], end_location["lng"]),
+                    )
+
+            route_store = result["route_store"]
+            for route_id, route in route_store.properties.items():
+                routes.add(
+                    travel_mode=flight_mode,
+                    origin=route["origin_city"],
+                    destination=route["destination_country"],
+                    duration_seconds=route["duration_seconds"],
+                    distance_meters=route["distance_meters"],
+                    geometry=wkb_linestring(route_store.route_coordinates(route_id)),
+                )
+
+    with TableWriter(paths["segments"], "segments", row_group_size) as segments:
+        for flight_mode, result in mode_results.items():
+            for segment_id, segment in result["route_store"].segments.items():
+                segments.add(
+                    travel_mode=flight_mode,
+                    segment_id=segment_id,
+                    routes=segment["routes"],
+                    refugees=int(result["segment_flows"][segment_id]),
+                    length_meters=segment["length_meters"],
+                    geometry=wkb_linestring(segment["coordinates"]),
+                )
+
+    with TableWriter(paths["flows"], "flows", row_group_size) as flows:
+        for flight_mode, result in mode_results.items():
+            for kk, flow in result["refugees"].iterrows():
+                flows.add(
+                    travel_mode=flight_mode,
+                    origin_city=flow["origin city"],
+                    origin_country=flow["origin country"],
+                    conflict_year=int(flow["conflict_year"]),
+                    destination_country=flow["destination country"],
+                    crossing_latitude=None if pd.isna(flow["latitude"]) else float(flow["latitude"]),
+                    crossing_longitude=None if pd.isna(flow["longitude"]) else float(flow["longitude"]),
+                    refugees=int(flow["total refugees"]),
+                )
+
+    return paths
+
+
+def run_ensemble(config, gmaps=None, tracer=None, output_dir="."):
+    '''
+    Runs the Ensemble Attraction Routing model for one config and returns its result tables.
+
+    Outputs are written under `output_dir` in the inputs/, outputs/ and maps/ folders. `gmaps` can be any routing
+    client with the googlemaps interface; by default one is built from the config.
+
+    The run is split in stages (features, predictions, locations, then crossings, selection, aggregation and the
+    road segments of the chosen routes per travel mode, and the map). Each stage's result is cached under
+    `stage_cache_dir`, keyed by its code, its config values and the stages it depends on, so a rerun only
+    computes the stages whose inputs changed. Set `use_stage_cache` to false to always compute everything.
+
+    With `output_format` "parquet" the origins, crossings, routes, road segments and flows are also written as
+    Parquet tables.
+
+    With `job_queue`, the path of a routing_common.jobs queue file, the directions are not requested by the run but
+    queued as jobs for the workers of that queue (under `job_run`, which resumes a run when it is given again).
+
+    With `crossing_capacity` the refugees of each conflict city are spread over its crossings by assign_refugees.
+
+    With `haven_hops` above 1 the havens are the countries up to that many borders away, and routes to the ones
+    past the neighbours are only requested when they are expected to be chosen (find_crossings_within_hops).
+
+    With `simulation` the refugees are also moved to their crossings day by day and the daily arrivals are written
+    per crossing and per country (simulate_arrivals).
+    '''
+    if tracer is None:
+        tracer = Tracer("ensemble")
+    for folder in ("inputs", "outputs", "maps"):
+        os.makedirs(os.path.join(output_dir, folder), exist_ok=True)
+
+    conflict_country = config.get("conflict_country", None)
+    excluded_countries = config.get("excluded_countries", "")
+    added_countries = config.get("added_countries", "")
+    if excluded_countries =="None":
+        excluded_countries=""
+    if added_countries =="None":
+        added_countries=""
+    conflict_start_year = config.get("conflict_start", 2021)
+    conflict_start = config.get("conflict_start", 2021)
+    if conflict_start >2021:
+        conflict_start=2021
+    conflict_start=conflict_start-1
+    drop_missing_data = config.get("drop_missing_data", False)
+    flight_modes = get_flight_modes(config)
+    # files shared by every travel mode of the run are named after all of them
+    mode_label = "_".join(flight_modes)
+    number_haven_cities = config.get("number_haven_cities", 5)
+    number_conflict_cities = config.get("number_conflict_cities", 20)
+    percent_of_pop_leaving = config.get("percent_of_pop_leaving", 0.1)
+    attraction_weight=config.get("attraction_weight",.5)
+    crossing_capacity = config.get("crossing_capacity")
+    haven_hops = config.get("haven_hops", 1)
+    simulation = config.get("simulation")
+    render_map = config.get("render_map", True)
+    output_format = config.get("output_format", "csv")
+    routing_backend = config.get("routing_backend", "google")
+
+    cache = StageCache(
+        config.get("stage_cache_dir") or os.path.join(output_dir, "stage_cache"),
+        enabled=config.get("use_stage_cache", True),
+        tracer=tracer,
+    )
+
+    with tracer.stage("features"):
+        features_key, features = cache.run(
+            "features",
+            build_features,
+            conflict_country,
+            conflict_start,
+            excluded_countries,
+            added_countries,
+            haven_hops,
+            code=(min_max_scale, year_rows, country_features, CountryGraph, canonical_codes),
+            inputs={
+                "conflict_country": conflict_country,
+                "conflict_start": conflict_start,
+                "excluded_countries": excluded_countries,
+                "added_countries": added_countries,
+                "haven_hops": haven_hops,
+                "reference": reference_fingerprint(),
+            },
+        )
+        touching_list = features["touching_list"]
+        conflict_country_historic_pop = features["conflict_country_historic_pop"]
+
+    with tracer.stage("predictions"):
+        predictions_key, border_countries_results = cache.run(
+            "predictions",
+            predict_shares,
+            features["normalized_data"],
+            drop_missing_data,
+            inputs={"drop_missing_data": drop_missing_data},
+            upstream=(features_key,),
+        )
+        border_countries_results.to_csv(
+            f"{output_dir}/outputs/{conflict_country}_{mode_label}_output_results.csv", index=False
+        )
+        tracer.wrote(f"{output_dir}/outputs/{conflict_country}_{mode_label}_output_results.csv")
+
+    with tracer.stage("locations"):
+        locations_key, (border_countries_results, locations) = cache.run(
+            "locations",
+            select_locations,
+            border_countries_results,
+            conflict_country,
+            number_conflict_cities,
+            number_haven_cities,
+            # the city columns read by load_reference_data end up in the locations
+            code=(load_reference_data,),
+            inputs={
+                "number_conflict_cities": number_conflict_cities,
+                "number_haven_cities": number_haven_cities,
+            },
+            upstream=(predictions_key,),
+        )
+
+        # save locations
+        locations.to_csv(
+            f"{output_dir}/inputs/{conflict_country}_{mode_label}_locations.csv", index=False
+        )
+        tracer.wrote(f"{output_dir}/inputs/{conflict_country}_{mode_label}_locations.csv")
+
+    # The routing client is only built when a crossings stage is not cached. Modes run on several threads.
+    client_lock = threading.Lock()
+    clients = [gmaps]
+
+    def get_client():
+        with client_lock:
+            if clients[0] is None and config.get("job_queue"):
+                # the directions are made by the workers of the job queue, with their own keys and rate limits
+                clients[0] = QueueClient(
+                    JobQueue(config["job_queue"]), run=config.get("job_run"), timeout=config.get("job_timeout")
+                )
+            if clients[0] is None:
+                clients[0] = build_client(
+                    routing_backend,
+                    tracer=tracer,
+                    api_limits=config.get("api_limits"),
+                    daily_budget=config.get("daily_budget"),
+                    quota_state_file=config.get("quota_state_file"),
+                )
+            return clients[0]
+
+    conflicts = locations[locations["location_type"] == "conflict_zone"]
+    camps = locations[locations["location_type"] == "camp"]
+    attractions = border_countries_results.copy()
+
+    def run_mode(flight_mode):
+        with tracer.stage(f"mode:{flight_mode}"):
+            with tracer.stage("crossings"):
+                # a result with failed calls is not cached, so a later run routes again instead of replaying it
+                failures = []
+                if haven_hops > 1:
+                    crossings_key, (conflict_city_to_haven_crossings, pruning) = cache.run(
+                        f"crossings:{flight_mode}",
+                        lambda: find_crossings_within_hops(
+                            conflicts, camps, touching_list, features["haven_hops"], attractions, attraction_weight,
+                            flight_mode, get_client(), failures=failures,
+                        ),
+                        code=(
+                            find_crossings_within_hops, route_pairs, haven_duration_estimates, longest_durations,
+                            crossings_in_route, Gazetteer,
+                        ),
+                        inputs={
+                            "flight_mode": flight_mode,
+                            "routing_backend": routing_backend,
+                            "attraction_weight": attraction_weight,
+                            "speeds": MAX_SPEEDS_KMH,
+                            "border_margin_km": BORDER_MARGIN_KM,
+                        },
+                        upstream=(features_key, locations_key),
+                        complete=lambda: not failures,
+                    )
+                    print(
+                        f"{flight_mode}: routed {pruning['routed']} of {pruning['pairs']} conflict city to far haven "
+                        f"pairs, left out {pruning['pruned']} not expected to be chosen"
+                    )
+                else:
+                    crossings_key, conflict_city_to_haven_crossings = cache.run(
+                        f"crossings:{flight_mode}",
+                        lambda: find_crossings(
+                            conflicts, camps, touching_list, flight_mode, get_client(), failures=failures
+                        ),
+                        code=(find_crossings, route_pairs, crossings_in_route, Gazetteer),
+                        inputs={"flight_mode": flight_mode, "routing_backend": routing_backend},
+                        upstream=(features_key, locations_key),
+                        complete=lambda: not failures,
+                    )
+                if failures:
+                    print(f"{flight_mode}: {len(failures)} routing calls failed, the crossings are incomplete")
+
+                with open(
+                    f"{output_dir}/outputs/{conflict_country}_conflict_city_to_haven_crossing_via_{flight_mode}.json",
+                    "w",
+                ) as f:
+                    json.dump(conflict_city_to_haven_crossings, f)
+                tracer.wrote(f"{output_dir}/outputs/{conflict_country}_conflict_city_to_haven_crossing_via_{flight_mode}.json")
+
+            with tracer.stage("selection"):
+                selection_key, (conflicts_longest_duration_values, all_directions) = cache.run(
+                    f"selection:{flight_mode}",
+                    select_crossings,
+                    conflicts,
+                    conflict_city_to_haven_crossings,
+                    attractions,
+                    attraction_weight,
+                    code=(longest_durations,),
+                    inputs={"attraction_weight": attraction_weight},
+                    upstream=(crossings_key, locations_key),
+                )
+
+                with open(
+                        f"{output_dir}/outputs/{conflict_country}_longest_duration_to_haven_crossing_via_{flight_mode}.json",
+                        "w",
+                ) as f:
+                    json.dump(conflicts_longest_duration_values, f)
+                tracer.wrote(f"{output_dir}/outputs/{conflict_country}_longest_duration_to_haven_crossing_via_{flight_mode}.json")
+
+                with open(
+                    f"{output_dir}/outputs/{conflict_country}_border_crossing_directions_{flight_mode}.json",
+                    "w",
+                ) as f:
+                    json.dump(all_directions, f)
+                tracer.wrote(f"{output_dir}/outputs/{conflict_country}_border_crossing_directions_{flight_mode}.json")
+
+            with tracer.stage("aggregation"):
+                aggregation_key, (reduced_conflicts, country_level_refugee) = cache.run(
+                    f"aggregation:{flight_mode}",
+                    estimate_refugees,
+                    conflicts,
+                    all_directions,
+                    flight_mode,
+                    conflict_country_historic_pop,
+                    percent_of_pop_leaving,
+                    conflict_start_year,
+                    code=(exit_routes, flow_matrix, refugees_by_country, FlowMatrix),
+                    inputs={"percent_of_pop_leaving": percent_of_pop_leaving, "conflict_start_year": conflict_start_year},
+                    upstream=(selection_key, features_key),
+                )
+                if crossing_capacity:
+                    # the stages below use the assigned refugees
+                    aggregation_key, (reduced_conflicts, country_level_refugee, crossing_loads) = cache.run(
+                        f"assignment:{flight_mode}",
+                        assign_refugees,
+                        reduced_conflicts,
+                        conflict_city_to_haven_crossings,
+                        attractions,
+                        attraction_weight,
+                        conflicts_longest_duration_values,
+                        crossing_capacity,
+                        code=(crossing_options, crossing_capacities, refugees_by_country, assign, BPR, round_flows),
+                        inputs={"crossing_capacity": crossing_capacity, "attraction_weight": attraction_weight},
+                        upstream=(aggregation_key, selection_key, crossings_key, locations_key),
+                    )
+                    crossing_loads.to_csv(f'{output_dir}/outputs/{conflict_country}_{flight_mode}_crossing_loads.csv', index=False)
+                    tracer.wrote(f'{output_dir}/outputs/{conflict_country}_{flight_mode}_crossing_loads.csv')
+                # save df
+                reduced_conflicts.to_csv(f'{output_dir}/outputs/{conflict_country}_{flight_mode}_total_refugees.csv', index=False)
+                tracer.wrote(f'{output_dir}/outputs/{conflict_country}_{flight_mode}_total_refugees.csv')
+
+                country_level_refugee.to_csv(f'{output_dir}/outputs/{conflict_country}_{flight_mode}_total_refugees_by_country.csv', index=True)
+                tracer.wrote(f'{output_dir}/outputs/{conflict_country}_{flight_mode}_total_refugees_by_country.csv')
+
+            with tracer.stage("breakdowns"):
+                breakdowns_key, breakdowns = cache.run(
+                    f"breakdowns:{flight_mode}",
+                    refugee_breakdowns,
+                    reduced_conflicts,
+                    conflicts,
+                    camps,
+                    code=(flow_matrix, FlowMatrix, nearest_haven_cities),
+                    upstream=(aggregation_key, locations_key),
+                )
+                for name, table in breakdowns.items():
+                    path = f"{output_dir}/outputs/{conflict_country}_{flight_mode}_total_refugees_{name}.csv"
+                    table.to_csv(path, index=False)
+                    tracer.wrote(path)
+
+            arrivals = None
+            if simulation:
+                with tracer.stage("simulation"):
+                    simulation_key, arrivals = cache.run(
+                        f"simulation:{flight_mode}",
+                        simulate_arrivals,
+                        reduced_conflicts,
+                        conflict_city_to_haven_crossings,
+                        simulation,
+                        code=(departure_curve, split_integers, travel_steps, simulate, Movement, crossing_capacities),
+                        inputs={"simulation": simulation},
+                        upstream=(aggregation_key, crossings_key),
+                    )
+                    for name, table in zip(("crossing", "country"), arrivals):
+                        path = f"{output_dir}/outputs/{conflict_country}_{flight_mode}_daily_arrivals_by_{name}.csv"
+                        table.to_csv(path, index=False)
+                        tracer.wrote(path)
+
+            with tracer.stage("segments"):
+                # the routes refugees take, with crossing capacities one per origin city and crossing used
+                routes, route_flows, route_origins = refugee_routes(reduced_conflicts, conflict_city_to_haven_crossings)
+                segments_key, route_store = cache.run(
+                    f"segments:{flight_mode}",
+                    build_route_store,
+                    routes,
+                    route_origins,
+                    code=(RouteStore, decode_grid, drop_repeated, refugee_routes, crossings_by_key),
+                    upstream=(aggregation_key, crossings_key),
+                )
+                segment_flows = route_store.segment_flows(route_flows)
+                write_segments_geojson(
+                    f'{output_dir}/outputs/{conflict_country}_{flight_mode}_route_segments.geojson',
+                    route_store,
+                    segment_flows,
+                )
+                tracer.wrote(f'{output_dir}/outputs/{conflict_country}_{flight_mode}_route_segments.geojson')
+
+        return (segments_key, aggregation_key), {
+            "crossings": conflict_city_to_haven_crossings,
+            "all_directions": all_directions,
+            "route_store": route_store,
+            "segment_flows": segment_flows,
+            "refugees": reduced_conflicts,
+            "refugees_by_country": country_level_refugee,
+            "refugee_breakdowns": breakdowns,
+            "daily_arrivals": arrivals,
+        }
+
+    # The routing of each travel mode runs concurrently, everything above is shared between them.
+    print('starting processing routes')
+    with ThreadPoolExecutor(max_workers=len(flight_modes)) as executor:
+        futures = {
+            flight_mode: executor.submit(tracer.bind(run_mode), flight_mode)
+            for flight_mode in flight_modes
+        }
+        mode_keys = {}
+        mode_results = {}
+        for flight_mode, future in futures.items():
+            mode_keys[flight_mode], mode_results[flight_mode] = future.result()
+
+    if render_map:
+        with tracer.stage("map"):
+            map_key, map_html = cache.run(
+                "map",
+                draw_map,
+                conflicts,
+                touching_list,
+                {
+                    flight_mode: {key: result[key] for key in ("crossings", "route_store", "segment_flows")}
+                    for flight_mode, result in mode_results.items()
+                },
+                code=(add_legend, get_basemaps, simplify),
+                inputs={"styles": MODE_STYLES, "modes": flight_modes, "tolerance": MAP_TOLERANCE},
+                upstream=[features_key, locations_key] + [key for flight_mode in flight_modes for key in mode_keys[flight_mode]],
+            )
+            with open(f"{output_dir}/maps/Map.html", "wb") as f:
+                f.write(map_html.encode("utf8"))
+            tracer.wrote(f"{output_dir}/maps/Map.html")
+
+    refugees_by_mode = pd.concat(
+        [
+            result["refugees"].assign(**{"travel mode": flight_mode})
+            for flight_mode, result in mode_results.items()
+        ],
+        ignore_index=True,
+    )[["origin city", "origin country", "conflict_year", "travel mode", "destination country", "latitude",
+       "longitude", "total refugees"]]
+    if len(flight_modes) > 1:
+        refugees_by_mode.to_csv(f"{output_dir}/outputs/{conflict_country}_{mode_label}_refugees_by_mode.csv", index=False)
+        tracer.wrote(f"{output_dir}/outputs/{conflict_country}_{mode_label}_refugees_by_mode.csv")
+
+    if output_format == "parquet":
+        with tracer.stage("columnar"):
+            for path in write_parquet_outputs(
+                    f"{output_dir}/outputs/{conflict_country}_{mode_label}", conflicts, mode_results
+            ).values():
+                tracer.wrote(path)
+
+    return {
+        "border_countries": border_countries_results,
+        "locations": locations,
+        "modes": mode_results,
+        "refugees_by_mode": refugees_by_mode,
+    }
@@ -0,0 +1,169 @@
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model")
+MODEL_FILE = os.path.join(MODEL_DIR, "refugee_model_results.pickle")
+COEFFICIENTS_FILE = os.path.join(MODEL_DIR, "refugee_model_coefficients.json")
+
+FORMAT_VERSION = 1
+
+
+class LinearModel:
+    '''
+    A fitted linear regression kept as its coefficients, so predicting needs only NumPy.
+
+    Predictions are `features @ params` with the features in the order of `feature_names`, the same as the
+    statsmodels results the coefficients were exported from.
+    '''
+
+    def __init__(self, feature_names, params, cov_params=None, scale=None, nobs=None, df_resid=None):
+        self.feature_names = list(feature_names)
+        self.params = np.asarray(params, dtype=float)
+        self.cov_params = None if cov_params is None else np.asarray(cov_params, dtype=float)
+        self.scale = scale
+        self.nobs = nobs
+        self.df_resid = df_resid
+        if self.params.shape != (len(self.feature_names),):
+            raise ValueError("The model needs one coefficient per feature")
+
+    @classmethod
+    def load(cls, path=COEFFICIENTS_FILE):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported coefficients file version {data.get('format_version')} in {path}")
+        return cls(
+            data["feature_names"],
+            data["params"],
+            data.get("cov_params"),
+            data.get("scale"),
+            data.get("nobs"),
+            data.get("df_resid"),
+        )
+
+    @classmethod
+    def from_results(cls, results):
+        '''
+        Takes the coefficients of fitted statsmodels regression results.
+        '''
+        return cls(
+            results.model.exog_names,
+            np.asarray(results.params),
+            np.asarray(results.cov_params()),
+            float(results.scale),
+            int(results.nobs),
+            float(results.df_resid),
+        )
+
+    def _exog(self, features):
+        # like statsmodels, the columns are used in order and not matched by name
+        exog = np.asarray(features, dtype=float)
+        if exog.ndim == 1:
+            exog = exog.reshape(1, -1)
+        if exog.shape[1] != len(self.feature_names):
+            raise ValueError(f"Expected {len(self.feature_names)} feature columns, got {exog.shape[1]}")
+        return exog
+
+    def predict(self, features):
+        '''
+        Predicts for every row of `features`. A DataFrame gives a Series with the same index.
+        '''
+        predicted = np.dot(self._exog(features), self.params)
+        if isinstance(features, pd.DataFrame):
+            return pd.Series(predicted, index=features.index)
+        return predicted
+
+    def standard_errors(self, features):
+        '''
+        Standard error of the predicted mean of every row of `features`, from the coefficient covariance.
+        '''
+        if self.cov_params is None:
+            raise ValueError("The coefficients file has no covariance")
+        exog = self._exog(features)
+        return np.sqrt(np.einsum("ij,jk,ik->i", exog, self.cov_params, exog))
+
+    def to_dict(self):
+        return {
+            "format_version": FORMAT_VERSION,
+            "model": "OLS",
+            "feature_names": self.feature_names,
+            "params": self.params.tolist(),
+            "cov_params": None if self.cov_params is None else self.cov_params.tolist(),
+            "scale": self.scale,
+            "nobs": self.nobs,
+            "df_resid": self.df_resid,
+        }
+
+
+def load_results(path=MODEL_FILE):
+    from statsmodels.iolib.smpickle import load_pickle
+
+    return load_pickle(path)
+
+
+def export_coefficients(model_file=MODEL_FILE, coefficients_file=COEFFICIENTS_FILE):
+    '''
+    Writes the coefficients of the pickled statsmodels results to a JSON file. Needs statsmodels, but runs
+    that load the JSON file do not.
+    '''
+    model = LinearModel.from_results(load_results(model_file))
+    data = model.to_dict()
+    with open(model_file, "rb") as f:
+        data["source"] = {
+            "file": os.path.basename(model_file),
+            "sha256": hashlib.sha256(f.read()).hexdigest(),
+        }
+    with open(coefficients_file, "w") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+    return model
+
+
+def check_parity(model_file=MODEL_FILE, coefficients_file=COEFFICIENTS_FILE, samples=1000):
+    '''
+    Compares the predictions of the coefficients file with the pickled results, on the training data and on
+    random features. Returns the largest difference and raises if they do not match.
+    '''
+    results = load_results(model_file)
+    model = LinearModel.load(coefficients_file)
+    if model.feature_names != list(results.model.exog_names):
+        raise ValueError(f"Feature order {model.feature_names} does not match {results.model.exog_names}")
+    features = np.vstack(
+        (results.model.exog, np.random.default_rng(0).uniform(0, 1, (samples, len(model.feature_names))))
+    )
+    expected = np.asarray(results.predict(features))
+    predicted = model.predict(features)
+    difference = float(np.max(np.abs(predicted - expected)))
+    if not np.allclose(predicted, expected, rtol=0, atol=1e-12):
+        raise ValueError(f"Predictions differ from the pickled model by up to {difference}")
+    expected_errors = np.sqrt(np.einsum("ij,jk,ik->i", features, np.asarray(results.cov_params()), features))
+    if not np.allclose(model.standard_errors(features), expected_errors, rtol=1e-12, atol=0):
+        raise ValueError("Standard errors differ from the pickled model")
+    return difference
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the coefficients of the refugee share model so runs do not need statsmodels."
+    )
+    parser.add_argument("--model-file", default=MODEL_FILE, help="Pickled statsmodels results")
+    parser.add_argument("--coefficients-file", default=COEFFICIENTS_FILE, help="JSON file to write or check")
+    parser.add_argument(
+        "--check", action="store_true", help="Only compare the coefficients file with the pickled model"
+    )
+    args = parser.parse_args()
+
+    if not args.check:
+        model = export_coefficients(args.model_file, args.coefficients_file)
+        print(f"Wrote {len(model.params)} coefficients to {args.coefficients_file}")
+    difference = check_parity(args.model_file, args.coefficients_file)
+    print(f"Predictions match the pickled model (max difference {difference:.3g})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+import argparse
+import json
+import os
+import sys
+import traceback
+
+import pandas as pd
+from fuzzywuzzy import process
+
+from ensemble import (
+    assign_refugees,
+    build_features,
+    estimate_refugees,
+    find_crossings,
+    get_flight_modes,
+    predict_shares,
+    select_crossings,
+    select_locations,
+)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from routing_common.clients import build_client
+from routing_common.instrumentation import Tracer
+from routing_common.local_backend import haversine_km
+
+
+def _country_list(countries):
+    if not countries or countries == "None":
+        return []
+    if isinstance(countries, str):
+        countries = countries.split(",")
+    return [country.strip() for country in countries if country.strip()]
+
+
+def _match(name, options, threshold=89):
+    # same fuzzy matching the model uses for excluded countries
+    if not options:
+        return None
+    country, ratio = process.extractOne(name, options)[:2]
+    return country if ratio > threshold else None
+
+
+def crossing_point(crossing):
+    step = crossing["result"][0]["legs"][0]["steps"][crossing["final_ind"]]
+    return step["end_location"]["lat"], step["end_location"]["lng"]
+
+
+def _choice(crossing):
+    if crossing is None:
+        return None
+    return crossing["destination_country"], crossing_point(crossing)
+
+
+def load_baseline(config, output_dir="."):
+    '''
+    Reads the locations, attraction scores and crossings of every flight mode written by a run of `config`
+    under `output_dir`.
+    '''
+    conflict_country = config.get("conflict_country")
+    flight_modes = get_flight_modes(config)
+    mode_label = "_".join(flight_modes)
+
+    locations = pd.read_csv(f"{output_dir}/inputs/{conflict_country}_{mode_label}_locations.csv")
+    attractions = pd.read_csv(f"{output_dir}/outputs/{conflict_country}_{mode_label}_output_results.csv")
+    modes = {}
+    for flight_mode in flight_modes:
+        with open(f"{output_dir}/outputs/{conflict_country}_conflict_city_to_haven_crossing_via_{flight_mode}.json") as f:
+            crossings = json.load(f)
+        with open(f"{output_dir}/outputs/{conflict_country}_border_crossing_directions_{flight_mode}.json") as f:
+            all_directions = json.load(f)
+        modes[flight_mode] = {"crossings": crossings, "all_directions": all_directions}
+
+    return {
+        "config": config,
+        "locations": locations,
+        "attractions": attractions,
+        "modes": modes,
+    }
+
+
+def scenario_countries(config, havens, remove_havens, add_havens):
+    '''
+    Turns the havens removed and added by a scenario into the excluded and added countries of the config.
+    Returns (excluded countries, added countries, removed havens, added havens).
+    '''
+    excluded = _country_list(config.get("excluded_countries", ""))
+    added = _country_list(config.get("added_countries", ""))
+
+    removed_havens = []
+    for name in remove_havens:
+        haven = _match(name, havens)
+        if haven is None:
+            print(f"{name} is not a haven country of the baseline, ignoring it")
+            continue
+        removed_havens.append(haven)
+        # added countries are appended after the exclusions, so those have to be dropped from the added list
+        match = _match(haven, added)
+        if match is not None:
+            added.remove(match)
+        else:
+            excluded.append(haven)
+
+    new_havens = []
+    for name in add_havens:
+        if _match(name, havens) is not None:
+            print(f"{name} is already a haven country of the baseline, ignoring it")
+            continue
+        new_havens.append(name)
+        match = _match(name, excluded)
+        if match is not None:
+            excluded.remove(match)
+        else:
+            added.append(name)
+
+    return ",".join(excluded), ",".join(added), removed_havens, new_havens
+
+
+def evaluate_scenario(baseline, scenario, gmaps=None, tracer=None):
+    '''
+    Re-evaluates a baseline run with havens removed or added and border crossings closed, without routing the
+    baseline again.
+
+    `scenario` has optional "remove_havens" and "add_havens" (lists of countries) and "closed_crossings" (a list
+    of {"latitude", "longitude", "radius_km", "country"} points, radius_km defaults to 10 and country is
+    optional). Closed crossings and removed havens drop the candidate crossings of the baseline; only the
+    conflict cities whose choice can change are selected again. Added havens are routed from every conflict
+    city, but only to the new havens. When the set of havens changes the attraction scores are predicted
+    again, since they are normalized over the havens of the conflict. With a `crossing_capacity` in the config the
+    refugees are assigned to the crossings by assign_refugees, before and after, as the baseline run does.
+
+    Returns the refugee totals per country before and after, and per flight mode the new crossings, the chosen
+    crossings, the refugee estimates, the crossing loads (None without capacities) and the conflict cities whose
+    destination changed.
+    '''
+    if tracer is None:
+        tracer = Tracer("scenario")
+    config = baseline["config"]
+    conflict_country = config.get("conflict_country")
+    conflict_start_year = config.get("conflict_start", 2021)
+    conflict_start = min(conflict_start_year, 2021) - 1
+    percent_of_pop_leaving = config.get("percent_of_pop_leaving", 0.1)
+    attraction_weight = config.get("attraction_weight", .5)
+    crossing_capacity = config.get("crossing_capacity")
+
+    locations = baseline["locations"]
+    conflicts = locations[locations["location_type"] == "conflict_zone"]
+    attractions = baseline_attractions = baseline["attractions"]
+    havens = list(attractions["country"])
+
+    excluded_countries, added_countries, removed_havens, new_havens = scenario_countries(
+        config, havens, scenario.get("remove_havens", []), scenario.get("add_havens", [])
+    )
+    closed_crossings = scenario.get("closed_crossings", [])
+    attractions_changed = bool(removed_havens or new_havens)
+
+    with tracer.stage("features"):
+        features = build_features(
+            conflict_country, conflict_start, excluded_countries, added_countries, config.get("haven_hops", 1)
+        )
+        predicted = predict_shares(features["normalized_data"], config.get("drop_missing_data", False))
+        # the havens kept from the baseline have to be havens of the scenario too, and without changes the two
+        # sets are the same; otherwise the baseline was run with another config
+        kept = set(havens) - set(removed_havens)
+        found = set(predicted["country"])
+        if not kept <= found or (not attractions_changed and found != kept):
+            raise ValueError(
+                f"The havens of the scenario ({', '.join(sorted(found))}) do not match those of the baseline "
+                f"({', '.join(sorted(kept))}), was the baseline run with another config?"
+            )
+        if attractions_changed:
+            attractions = predicted
+
+    camps = None
+    if new_havens:
+        with tracer.stage("locations"):
+            _, new_locations = select_locations(
+                attractions,
+                conflict_country,
+                config.get("number_conflict_cities", 20),
+                config.get("number_haven_cities", 5),
+            )
+            camps = new_locations[new_locations["location_type"] == "camp"]
+
+        # only added havens need routing
+        if gmaps is None:
+            gmaps = build_client(
+                config.get("routing_backend", "google"),
+                tracer=tracer,
+                api_limits=config.get("api_limits"),
+                daily_budget=config.get("daily_budget"),
+                quota_state_file=config.get("quota_state_file"),
+            )
+
+    def is_closed(crossing):
+        if crossing["destination_country"] in removed_havens:
+            return True
+        lat, lng = crossing_point(crossing)
+        for closed in closed_crossings:
+            if closed.get("country") and _match(closed["country"], [crossing["destination_country"]]) is None:
+                continue
+            if haversine_km(lat, lng, closed["latitude"], closed["longitude"]) <= closed.get("radius_km", 10):
+                return True
+        return False
+
+    modes = {}
+    baseline_totals = []
+    scenario_totals = []
+    conflict_country_historic_pop = features["conflict_country_historic_pop"]
+    for flight_mode, mode_baseline in baseline["modes"].items():
+        with tracer.stage(f"mode:{flight_mode}"):
+            crossings = [
+                crossing for crossing in mode_baseline["crossings"]
+                if not is_closed(list(crossing.values())[0])
+            ]
+            new_crossings = []
+            if new_havens:
+                with tracer.stage("crossings"):
+                    new_crossings = find_crossings(conflicts, camps, new_havens, flight_mode, gmaps)
+                crossings = crossings + new_crossings
+
+            with tracer.stage("selection"):
+                baseline_longest, _ = select_crossings(
+                    conflicts, mode_baseline["crossings"], attractions, attraction_weight, origins=set()
+                )
+                longest, _ = select_crossings(conflicts, crossings, attractions, attraction_weight, origins=set())
+                # a conflict city only has to choose again when its crossing closed or when the values its
+                # choice is weighed with changed
+                if attractions_changed or new_crossings:
+                    affected = set(conflicts["#name"])
+                else:
+                    affected = {
+                        name for name in conflicts["#name"]
+                        if name not in mode_baseline["all_directions"]
+                        or is_closed(mode_baseline["all_directions"][name])
+                        or longest[name] != baseline_longest[name]
+                    }
+                all_directions = {
+                    name: crossing for name, crossing in mode_baseline["all_directions"].items()
+                    if name not in affected
+                }
+                if affected:
+                    _, reselected = select_crossings(
+                        conflicts, crossings, attractions, attraction_weight, origins=affected
+                    )
+                    all_directions.update(reselected)
+
+            with tracer.stage("aggregation"):
+                baseline_refugees, baseline_by_country = estimate_refugees(
+                    conflicts,
+                    mode_baseline["all_directions"],
+                    flight_mode,
+                    conflict_country_historic_pop,
+                    percent_of_pop_leaving,
+                    conflict_start_year,
+                )
+                refugees, refugees_by_country = estimate_refugees(
+                    conflicts,
+                    all_directions,
+                    flight_mode,
+                    conflict_country_historic_pop,
+                    percent_of_pop_leaving,
+                    conflict_start_year,
+                )
+                crossing_loads = None
+                if crossing_capacity:
+                    _, baseline_by_country, _ = assign_refugees(
+                        baseline_refugees,
+                        mode_baseline["crossings"],
+                        baseline_attractions,
+                        attraction_weight,
+                        baseline_longest,
+                        crossing_capacity,
+                    )
+                    refugees, refugees_by_country, crossing_loads = assign_refugees(
+                        refugees, crossings, attractions, attraction_weight, longest, crossing_capacity
+                    )
+
+        modes[flight_mode] = {
+            "new_crossings": new_crossings,
+            "all_directions": all_directions,
+            "refugees": refugees,
+            "refugees_by_country": refugees_by_country,
+            "crossing_loads": crossing_loads,
+            "reselected": sorted(affected),
+            "changed": [
+                name for name in conflicts["#name"]
+                if _choice(mode_baseline["all_directions"].get(name)) != _choice(all_directions.get(name))
+            ],
+        }
+        baseline_totals.append(baseline_by_country.assign(**{"travel mode": flight_mode}))
+        scenario_totals.append(refugees_by_country.assign(**{"travel mode": flight_mode}))
+
+    by_country = pd.merge(
+        pd.concat(baseline_totals).rename(columns={"total refugees": "baseline refugees"}),
+        pd.concat(scenario_totals).rename(columns={"total refugees": "scenario refugees"}),
+        on=["travel mode", "country"],
+        how="outer",
+    ).fillna(0)
+    by_country[["baseline refugees", "scenario refugees"]] = by_country[
+        ["baseline refugees", "scenario refugees"]
+    ].astype("int")
+    by_country["change"] = by_country["scenario refugees"] - by_country["baseline refugees"]
+
+    return {
+        "name": scenario.get("name", "scenario"),
+        "removed_havens": removed_havens,
+        "added_havens": new_havens,
+        "attractions": attractions,
+        "refugees_by_country": by_country[
+            ["travel mode", "country", "baseline refugees", "scenario refugees", "change"]
+        ],
+        "modes": modes,
+    }
+
+
+if __name__ == "__main__":
+    description = """
+    Evaluates what-if scenarios (closed border crossings, removed or added haven countries) against the outputs
+    of a finished Ensemble Attraction Routing run, without routing the run again.
+
+    The scenario file is a JSON object or a list of them, e.g.
+    [{"name": "no_hungary", "remove_havens": ["Hungary"]},
+     {"name": "close_medyka", "closed_crossings": [{"latitude": 49.8, "longitude": 23.0, "radius_km": 10}]},
+     {"name": "add_germany", "add_havens": ["Germany"]}]
+    """
+    arg_parser = argparse.ArgumentParser(
+        description=description, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument(
+        "--config_file",
+        type=str,
+        help="Path to the json config file of the baseline run. (E.g.: config.json)",
+    )
+    arg_parser.add_argument(
+        "--scenario_file",
+        type=str,
+        help="Path to the json file with the scenarios",
+    )
+    arg_parser.add_argument(
+        "--baseline_dir",
+        type=str,
+        help="Folder the baseline run wrote its inputs/ and outputs/ folders to",
+        default=".",
+    )
+    args = arg_parser.parse_args()
+    config: dict = json.load(open(args.config_file))
+    googlemaps_key = config.pop("GOOGLEMAPS_KEY", None)
+    if googlemaps_key:
+        os.environ["GOOGLEMAPS_KEY"] = googlemaps_key
+    scenarios = json.load(open(args.scenario_file))
+    if isinstance(scenarios, dict):
+        scenarios = [scenarios]
+
+    baseline = load_baseline(config, args.baseline_dir)
+    conflict_country = config.get("conflict_country")
+    scenario_dir = os.path.join(args.baseline_dir, "outputs", "scenarios")
+    os.makedirs(scenario_dir, exist_ok=True)
+
+    tracer = Tracer("scenarios")
+    try:
+        for i, scenario in enumerate(scenarios):
+            name = scenario.get("name", f"scenario_{i}")
+            with tracer.stage(f"scenario:{name}"):
+                result = evaluate_scenario(baseline, dict(scenario, name=name), tracer=tracer)
+            print(f"{name}:")
+            print(result["refugees_by_country"].to_string(index=False))
+
+            result["refugees_by_country"].to_csv(
+                f"{scenario_dir}/{conflict_country}_{name}_refugees_by_country.csv", index=False
+            )
+            tracer.wrote(f"{scenario_dir}/{conflict_country}_{name}_refugees_by_country.csv")
+            for flight_mode, mode_result in result["modes"].items():
+                mode_result["refugees"].to_csv(
+                    f"{scenario_dir}/{conflict_country}_{name}_{flight_mode}_total_refugees.csv", index=False
+                )
+                tracer.wrote(f"{scenario_dir}/{conflict_country}_{name}_{flight_mode}_total_refugees.csv")
+    except Exception as e:
+        traceback.print_exc()
+    finally:
+        tracer.save(f"{scenario_dir}/{conflict_country}_scenarios_trace.json")
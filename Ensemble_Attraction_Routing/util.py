@@ -1,6 +1,5 @@
 import json
 import numpy as np
-import folium
 import math
 from fuzzywuzzy import fuzz, process
 
@@ -16,43 +15,49 @@ class NpEncoder(json.JSONEncoder):
         return super(NpEncoder, self).default(obj)
 
 
-basemaps = {
-    "Google Maps": folium.TileLayer(
-        tiles="https://mt1.google.com/vt/lyrs=m&x={x}&y={y}&z={z}",
-        attr="Google",
-        name="Google Maps",
-        overlay=True,
-        control=True,
-    ),
-    "Google Satellite": folium.TileLayer(
-        tiles="https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}",
-        attr="Google",
-        name="Google Satellite",
-        overlay=True,
-        control=True,
-    ),
-    "Google Terrain": folium.TileLayer(
-        tiles="https://mt1.google.com/vt/lyrs=p&x={x}&y={y}&z={z}",
-        attr="Google",
-        name="Google Terrain",
-        overlay=True,
-        control=True,
-    ),
-    "Google Satellite Hybrid": folium.TileLayer(
-        tiles="https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}",
-        attr="Google",
-        name="Google Satellite",
-        overlay=True,
-        control=True,
-    ),
-    "Esri Satellite": folium.TileLayer(
-        tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
-        attr="Esri",
-        name="Esri Satellite",
-        overlay=True,
-        control=True,
-    ),
-}
+def get_basemaps():
+    '''
+    Returns new tile layers for a map. A tile layer can only be added to one map, so every map gets its own.
+    '''
+    import folium
+
+    return {
+        "Google Maps": folium.TileLayer(
+            tiles="https://mt1.google.com/vt/lyrs=m&x={x}&y={y}&z={z}",
+            attr="Google",
+            name="Google Maps",
+            overlay=True,
+            control=True,
+        ),
+        "Google Satellite": folium.TileLayer(
+            tiles="https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}",
+            attr="Google",
+            name="Google Satellite",
+            overlay=True,
+            control=True,
+        ),
+        "Google Terrain": folium.TileLayer(
+            tiles="https://mt1.google.com/vt/lyrs=p&x={x}&y={y}&z={z}",
+            attr="Google",
+            name="Google Terrain",
+            overlay=True,
+            control=True,
+        ),
+        "Google Satellite Hybrid": folium.TileLayer(
+            tiles="https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}",
+            attr="Google",
+            name="Google Satellite",
+            overlay=True,
+            control=True,
+        ),
+        "Esri Satellite": folium.TileLayer(
+            tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+            attr="Esri",
+            name="Esri Satellite",
+            overlay=True,
+            control=True,
+        ),
+    }
 
 
 def get_closest(loc_lat, loc_lon, targets, mode, attraction_weight, attractions, gmaps):
@@ -155,22 +160,7 @@ def add_legend(map):
 
 
       </div> """.format(title="Legend html")
+    import folium
+
     map.get_root().html.add_child(folium.Element(legend_html))
     return map
-
-
-def get_exit_route(row, mode, all_directions):
-    lat=None
-    lng=None
-    dest=None
-    try:
-        dest = all_directions[row['#name']]['destination_country']
-        lat = all_directions[row['#name']]["result"][0]['legs'][0]['steps'][all_directions[row['#name']]["final_ind"]]['end_location']['lat']
-        lng = all_directions[row['#name']]["result"][0]['legs'][0]['steps'][all_directions[row['#name']]["final_ind"]]['end_location']['lng']
-    except Exception as e:
-        print(e)
-        dest = None
-    row[f'{mode}_destination'] = dest
-    row[f'latitude'] = lat
-    row[f'longitude'] = lng
-    return row
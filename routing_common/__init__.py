@@ -0,0 +1,3 @@
+'''
+Helpers shared by the simple refugee route model and the Ensemble Attraction Routing model.
+'''
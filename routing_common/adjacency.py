@@ -0,0 +1,150 @@
+import functools
+import json
+import os
+
+import numpy as np
+
+from routing_common.gazetteer import COUNTRY_CODES_FILE, normalize_name, read_country_keys
+from routing_common.geonames import DATA_DIR
+
+BORDER_FILE = os.path.join(DATA_DIR, "country_border_data.json")
+
+# words left out when the names of the border file are matched to the ISO names ("Moldova (the Republic of)" and
+# "Moldova, Republic of")
+_FILLER_WORDS = {"the", "of", "and"}
+
+
+def _words(key):
+    return frozenset(key.split()) - _FILLER_WORDS
+
+
+def canonical_codes(names, country_codes_file=COUNTRY_CODES_FILE):
+    '''
+    The ISO alpha-2 code of every country name, found once when the graph is built instead of by fuzzy matching
+    on every run. A name that is not an ISO name (or alias) matches the ISO name with the same words, or else the
+    longest ISO name of two or more words it contains ("United States of America" is "United States"). A name
+    without a match keeps its normalized name as its code.
+    '''
+    country_names, _ = read_country_keys(country_codes_file)
+    by_words = {}
+    for key, code in country_names.items():
+        by_words.setdefault(_words(key), code)
+    codes = []
+    for name in names:
+        key = normalize_name(name)
+        code = country_names.get(key) or by_words.get(_words(key))
+        if code is None:
+            contained = [words for words in by_words if len(words) > 1 and words <= _words(key)]
+            code = by_words[max(contained, key=len)] if contained else key
+        codes.append(code)
+    return codes
+
+
+class CountryGraph:
+    '''
+    The land borders between countries as a sparse graph in CSR form: the neighbours of country i are
+    indices[indptr[i]:indptr[i + 1]], in the order of the border file. Countries are the names of the border
+    file, each with its canonical ISO alpha-2 code, and can be looked up by name, by any name or alias of their
+    code, or by code.
+
+    The number of borders to cross between every two countries (-1 when there is no land route) is found once,
+    by a breadth first search from all countries at the same time, so the countries within k hops of a country
+    are a row of that matrix.
+    '''
+
+    def __init__(self, names, codes, indptr, indices, country_names=None, country_codes=None):
+        self.names = list(names)
+        self.codes = list(codes)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+
+        self._index = {}
+        for index, (name, code) in enumerate(zip(self.names, self.codes)):
+            self._index.setdefault(normalize_name(name), index)
+            self._index.setdefault(code, index)
+        for key, code in dict(country_names or {}, **(country_codes or {})).items():
+            if code in self._index:
+                self._index.setdefault(key, self._index[code])
+
+        size = len(self.names)
+        adjacency = np.zeros((size, size), dtype=np.int32)
+        adjacency[np.repeat(np.arange(size), np.diff(self.indptr)), self.indices] = 1
+        self.hops = np.full((size, size), -1, dtype=np.int16)
+        np.fill_diagonal(self.hops, 0)
+        frontier = np.eye(size, dtype=np.int32)
+        level = 0
+        while frontier.any():
+            level += 1
+            reached = (frontier @ adjacency > 0) & (self.hops < 0)
+            self.hops[reached] = level
+            frontier = reached.astype(np.int32)
+
+    @classmethod
+    def from_border_data(cls, border_file=BORDER_FILE, country_codes_file=COUNTRY_CODES_FILE):
+        '''
+        The graph of a {country: [neighbouring countries]} file. Borders are taken both ways, even when the file
+        only lists one of them.
+        '''
+        with open(border_file) as f:
+            borders = json.load(f)
+        names = list(borders)
+        for neighbours in borders.values():
+            names.extend(name for name in neighbours if name not in borders)
+        names = list(dict.fromkeys(names))
+        index = {name: i for i, name in enumerate(names)}
+
+        neighbours = [[] for _ in names]
+        for country, touching in borders.items():
+            for name in touching:
+                for a, b in ((country, name), (name, country)):
+                    if index[b] not in neighbours[index[a]] and a != b:
+                        neighbours[index[a]].append(index[b])
+        indptr = np.cumsum([0] + [len(row) for row in neighbours])
+        indices = [i for row in neighbours for i in row]
+        country_names, country_codes = read_country_keys(country_codes_file)
+        return cls(
+            names, canonical_codes(names, country_codes_file), indptr, indices, country_names, country_codes
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def index(self, country):
+        '''
+        The index of a country name or code, or None.
+        '''
+        key = normalize_name(country)
+        index = self._index.get(key)
+        if index is None:
+            index = self._index.get(country)
+        return index
+
+    def neighbours(self, country):
+        '''
+        The names of the countries bordering `country`.
+        '''
+        index = self.index(country)
+        if index is None:
+            return []
+        return [self.names[i] for i in self.indices[self.indptr[index]:self.indptr[index + 1]]]
+
+    def within(self, country, hops):
+        '''
+        The countries one to `hops` borders away from `country` as (name, hops) pairs, nearest first, then in the
+        order of the border file.
+        '''
+        index = self.index(country)
+        if index is None:
+            return []
+        row = self.hops[index]
+        found = np.flatnonzero((row > 0) & (row <= hops))
+        found = found[np.argsort(row[found], kind="stable")]
+        return [(self.names[i], int(row[i])) for i in found]
+
+
+@functools.lru_cache(maxsize=4)
+def load_country_graph(border_file=BORDER_FILE):
+    '''
+    The country graph of a border file, built once per process.
+    '''
+    return CountryGraph.from_border_data(border_file)
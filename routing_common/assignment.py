@@ -0,0 +1,165 @@
+import numpy as np
+
+METHODS = ["frank-wolfe", "msa"]
+
+# keeps some of the new all-or-nothing target in every conjugate direction
+_MAX_CONJUGATE_WEIGHT = 0.99
+
+
+class BPR:
+    '''
+    Congestion at crossings as a BPR (Bureau of Public Roads) delay function: the wait at a crossing that handles
+    `volume` people is delay * (volume / capacity) ** beta, so `delay` is the wait when the crossing is used at
+    its capacity. A crossing with an infinite capacity has no wait.
+    '''
+
+    def __init__(self, capacities, delay, beta=4.0):
+        self.capacities = np.asarray(capacities, dtype=float)
+        if (self.capacities <= 0).any():
+            raise ValueError("Crossing capacities must be positive")
+        self.delay = float(delay)
+        self.beta = float(beta)
+
+    def cost(self, volumes):
+        return self.delay * (np.asarray(volumes, dtype=float) / self.capacities) ** self.beta
+
+    def derivative(self, volumes):
+        ratio = np.asarray(volumes, dtype=float) / self.capacities
+        return self.delay * self.beta * ratio ** (self.beta - 1) / self.capacities
+
+
+class Assignment:
+    '''
+    The result of `assign`: the flow on every option, the volume and wait of every crossing, the number of
+    iterations and the relative gap reached.
+    '''
+
+    def __init__(self, flows, volumes, waits, iterations, relative_gap, converged):
+        self.flows = flows
+        self.volumes = volumes
+        self.waits = waits
+        self.iterations = iterations
+        self.relative_gap = relative_gap
+        self.converged = converged
+
+
+def _cheapest(costs, origins, starts):
+    # the option with the lowest cost of every origin, the first one on ties (options are sorted by origin)
+    lowest = np.minimum.reduceat(costs, starts)
+    candidates = np.flatnonzero(costs <= lowest[origins])
+    first = np.r_[True, origins[candidates][1:] != origins[candidates][:-1]]
+    return candidates[first], lowest
+
+
+def _line_search(base_direction, volumes, direction, congestion, steps=30):
+    # the step minimizing the Beckmann objective along the direction, where its (increasing) derivative is zero
+    def slope(step):
+        return base_direction + congestion.cost(volumes + step * direction) @ direction
+
+    if slope(1.0) <= 0:
+        return 1.0
+    low, high = 0.0, 1.0
+    for _ in range(steps):
+        middle = (low + high) / 2
+        if slope(middle) > 0:
+            high = middle
+        else:
+            low = middle
+    return (low + high) / 2
+
+
+def assign(base_costs, origins, crossings, demands, congestion, method="frank-wolfe", max_iterations=500,
+           tolerance=1e-4):
+    '''
+    Spreads the demand of every origin over its crossings until no one can get a lower cost by going elsewhere
+    (a Wardrop equilibrium), when the cost of an option is its base cost plus the wait at its crossing, which
+    grows with the number of people using that crossing.
+
+    The options are parallel arrays: the origin index (options of an origin must be next to each other), the
+    crossing index and the base cost of each. `demands` has one value per origin, with at least one option for
+    every origin, and `congestion` maps crossing volumes to waits (a `BPR`). Starting from every origin on its
+    cheapest option, each iteration moves flow towards the cheapest options at the current waits: with
+    "frank-wolfe" along a conjugate direction (conjugate Frank-Wolfe), by the step that minimizes the Beckmann
+    objective, with "msa" (the method of successive averages) by 1 / (iteration + 1). It stops when the relative gap, the share of the total cost that could still be saved
+    by moving everyone to their cheapest option, is below `tolerance`.
+    '''
+    if method not in METHODS:
+        raise ValueError(f"Unknown assignment method {method}, use one of {', '.join(METHODS)}")
+    base_costs = np.asarray(base_costs, dtype=float)
+    origins = np.asarray(origins, dtype=np.int64)
+    crossings = np.asarray(crossings, dtype=np.int64)
+    demands = np.asarray(demands, dtype=float)
+    if len(origins) and (np.diff(origins) < 0).any():
+        raise ValueError("The options of an origin must be next to each other, sorted by origin")
+    starts = np.flatnonzero(np.r_[True, np.diff(origins) != 0]) if len(origins) else np.zeros(0, dtype=np.int64)
+    if len(starts) != len(demands):
+        raise ValueError("Every origin needs at least one option")
+    size = len(congestion.capacities)
+
+    if not len(origins):
+        return Assignment(np.zeros(0), np.zeros(size), np.zeros(size), 0, 0.0, True)
+
+    # Every all-or-nothing target is kept as the option chosen by each origin, and the flows as the weight of
+    # each target, so an iteration only works on the origins and crossings and the flows are added up at the end.
+    chosen, _ = _cheapest(base_costs, origins, starts)
+    targets = [chosen]
+    weights = np.ones(1)
+    volumes = np.bincount(crossings[chosen], weights=demands, minlength=size)
+    base_total = base_costs[chosen] @ demands
+    iteration = 0
+    while True:
+        waits = congestion.cost(volumes)
+        chosen, lowest = _cheapest(base_costs + waits[crossings], origins, starts)
+        total = base_total + waits @ volumes
+        relative_gap = (total - lowest @ demands) / total if total > 0 else 0.0
+        if relative_gap <= tolerance or iteration >= max_iterations:
+            break
+        iteration += 1
+
+        targets.append(chosen)
+        weights = np.r_[weights, 0.0]
+        target_weights = np.zeros(len(targets))
+        target_weights[-1] = 1.0
+        target_volumes = np.bincount(crossings[chosen], weights=demands, minlength=size)
+        target_base = base_costs[chosen] @ demands
+        if method == "msa":
+            step = 1 / (iteration + 1)
+        else:
+            if iteration > 1:
+                # conjugate Frank-Wolfe: the target is mixed with the previous one so that the two directions are
+                # conjugate for the Hessian of the objective, which is diagonal in the crossing volumes
+                slopes = congestion.derivative(volumes)
+                previous = conjugate_volumes - volumes
+                numerator = previous @ (slopes * (target_volumes - volumes))
+                denominator = previous @ (slopes * (target_volumes - conjugate_volumes))
+                weight = min(max(numerator / denominator, 0.0), _MAX_CONJUGATE_WEIGHT) if denominator else 0.0
+                target_weights = weight * np.r_[conjugate_weights, 0.0] + (1 - weight) * target_weights
+                target_volumes = weight * conjugate_volumes + (1 - weight) * target_volumes
+                target_base = weight * conjugate_base + (1 - weight) * target_base
+            conjugate_weights, conjugate_volumes, conjugate_base = target_weights, target_volumes, target_base
+            step = _line_search(target_base - base_total, volumes, target_volumes - volumes, congestion)
+        weights += step * (target_weights - weights)
+        volumes += step * (target_volumes - volumes)
+        base_total += step * (target_base - base_total)
+
+    flows = np.zeros(len(origins))
+    for target, weight in zip(targets, weights):
+        flows[target] += weight * demands
+    return Assignment(flows, volumes, waits, iteration, float(relative_gap), bool(relative_gap <= tolerance))
+
+
+def round_flows(flows, origins, demands):
+    '''
+    Rounds the flows of every origin to integers that still add up to its (integer) demand, giving the people
+    left over by rounding down to the options with the largest remainders.
+    '''
+    flows = np.asarray(flows, dtype=float)
+    origins = np.asarray(origins, dtype=np.int64)
+    rounded = np.floor(flows + 1e-9).astype(np.int64)
+    left = np.asarray(demands, dtype=np.int64) - np.bincount(origins, weights=rounded, minlength=len(demands))
+    # options by origin, largest remainder first; the first `left` options of every origin get one more
+    order = np.lexsort((-(flows - rounded), origins))
+    starts = np.searchsorted(origins[order], np.arange(len(demands)))
+    rank = np.arange(len(order)) - starts[origins[order]]
+    rounded[order[rank < left[origins[order]]]] += 1
+    return rounded
@@ -0,0 +1,57 @@
+import os
+
+from routing_common.geonames import DATA_DIR
+from routing_common.instrumentation import TracedClient
+from routing_common.scheduler import QuotaScheduler
+
+
+ROUTING_BACKENDS = ["google", "local"]
+
+DEFAULT_PLACES_FILE = os.path.join(DATA_DIR, "cities15000.txt")
+
+
+def build_client(
+        routing_backend="google",
+        googlemaps_key=None,
+        tracer=None,
+        api_limits=None,
+        daily_budget=None,
+        quota_state_file=None,
+        places_file=None,
+        http_pool_size=10,
+):
+    '''
+    Builds the routing client used by both models.
+
+    The "google" backend is a googlemaps client behind a `QuotaScheduler`. The "local" backend is the offline
+    `LocalRoutingClient`, which needs no key and no rate limiting. Either is wrapped in a `TracedClient` when a
+    tracer is given.
+
+    Google calls share one requests session with up to `http_pool_size` keep-alive connections. Calls from more
+    threads than that wait for a free connection instead of opening (and then dropping) extra ones.
+    '''
+    if routing_backend == "local":
+        from routing_common.local_backend import LocalRoutingClient
+
+        client = LocalRoutingClient.from_geonames(places_file or DEFAULT_PLACES_FILE)
+        return TracedClient(client, tracer) if tracer is not None else client
+    if routing_backend != "google":
+        raise ValueError(f"Unknown routing backend {routing_backend}, expected one of {', '.join(ROUTING_BACKENDS)}")
+
+    import googlemaps
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    if googlemaps_key is None:
+        googlemaps_key = os.environ.get("GOOGLEMAPS_KEY")
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=http_pool_size, pool_block=True))
+    client = googlemaps.Client(key=googlemaps_key, retry_over_query_limit=False, requests_session=session)
+    if tracer is not None:
+        client = TracedClient(client, tracer)
+    return QuotaScheduler(
+        client,
+        limits=api_limits,
+        daily_budget=daily_budget,
+        state_file=quota_state_file,
+    )
@@ -0,0 +1,179 @@
+import json
+import struct
+
+import numpy as np
+
+OUTPUT_FORMATS = ["csv", "parquet"]
+
+# WKB geometry type codes
+WKB_POINT = 1
+WKB_LINESTRING = 2
+
+
+def wkb_point(lat, lng):
+    '''
+    Little endian WKB of a point. Coordinates are stored (longitude, latitude) like GeoJSON.
+    '''
+    return struct.pack("<BIdd", 1, WKB_POINT, lng, lat)
+
+
+def wkb_linestring(points):
+    '''
+    Little endian WKB of a line through `points`, (lat, lng) pairs as a sequence or an (n, 2) array.
+    '''
+    coords = np.asarray(points, dtype="<f8").reshape(-1, 2)[:, ::-1]
+    return struct.pack("<BII", 1, WKB_LINESTRING, len(coords)) + np.ascontiguousarray(coords).tobytes()
+
+
+def _field(name, kind):
+    import pyarrow as pa
+
+    types = {
+        "string": pa.string(),
+        "int32": pa.int32(),
+        "int64": pa.int64(),
+        "float64": pa.float64(),
+        "bool": pa.bool_(),
+        "string_list": pa.list_(pa.string()),
+        "date": pa.date32(),
+        "geometry": pa.binary(),
+    }
+    return pa.field(name, types[kind])
+
+
+# Table layouts of the Parquet outputs: (column, type) pairs. The "geometry" column holds WKB.
+SCHEMAS = {
+    "origins": [
+        ("origin_city", "string"),
+        ("origin_country", "string"),
+        ("population", "int64"),
+        ("latitude", "float64"),
+        ("longitude", "float64"),
+        ("geometry", "geometry"),
+    ],
+    "crossings": [
+        ("travel_mode", "string"),
+        ("origin_city", "string"),
+        ("destination_country", "string"),
+        ("step_index", "int32"),
+        ("duration_seconds", "int64"),
+        ("distance_meters", "int64"),
+        ("latitude", "float64"),
+        ("longitude", "float64"),
+        ("selected", "bool"),
+        ("geometry", "geometry"),
+    ],
+    "routes": [
+        ("travel_mode", "string"),
+        ("origin", "string"),
+        ("destination", "string"),
+        ("rank", "int32"),
+        ("duration_seconds", "int64"),
+        ("distance_meters", "int64"),
+        ("geometry", "geometry"),
+    ],
+    "segments": [
+        ("travel_mode", "string"),
+        ("segment_id", "string"),
+        ("routes", "string_list"),
+        ("refugees", "int64"),
+        ("length_meters", "float64"),
+        ("geometry", "geometry"),
+    ],
+    "flows": [
+        ("travel_mode", "string"),
+        ("origin_city", "string"),
+        ("origin_country", "string"),
+        ("conflict_year", "int32"),
+        ("destination_country", "string"),
+        ("crossing_latitude", "float64"),
+        ("crossing_longitude", "float64"),
+        ("refugees", "int64"),
+    ],
+    "destinations": [
+        ("date", "date"),
+        ("travel_mode", "string"),
+        ("name", "string"),
+        ("address", "string"),
+        ("latitude", "float64"),
+        ("longitude", "float64"),
+        ("duration_seconds", "int64"),
+        ("distance_meters", "int64"),
+        ("geometry", "geometry"),
+    ],
+}
+
+GEOMETRY_TYPES = {
+    "origins": "Point",
+    "crossings": "Point",
+    "routes": "LineString",
+    "segments": "LineString",
+    "destinations": "Point",
+}
+
+
+def table_schema(table):
+    '''
+    Returns the pyarrow schema of one of the output tables, with GeoParquet metadata when it has a geometry.
+    '''
+    import pyarrow as pa
+
+    schema = pa.schema([_field(name, kind) for name, kind in SCHEMAS[table]])
+    if table in GEOMETRY_TYPES:
+        geo = {
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            # without a "crs" the coordinates are longitude/latitude on WGS84 (OGC:CRS84)
+            "columns": {"geometry": {"encoding": "WKB", "geometry_types": [GEOMETRY_TYPES[table]]}},
+        }
+        schema = schema.with_metadata({"geo": json.dumps(geo)})
+    return schema
+
+
+class TableWriter:
+    '''
+    Streams rows of one of the output tables to a Parquet file, one row group every `row_group_size` rows, so
+    large runs never hold the whole table in memory. Use as a context manager, or call `close()`.
+    '''
+
+    def __init__(self, path, table, row_group_size=10000):
+        import pyarrow.parquet as pq
+
+        self.path = path
+        self.table = table
+        self.schema = table_schema(table)
+        self.row_group_size = row_group_size
+        self.rows = 0
+        self._columns = {name: [] for name in self.schema.names}
+        self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+
+    def add(self, **row):
+        for name, values in self._columns.items():
+            values.append(row.get(name))
+        if len(self._columns[self.schema.names[0]]) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        import pyarrow as pa
+
+        count = len(self._columns[self.schema.names[0]])
+        if not count:
+            return
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(self._columns[field.name], type=field.type) for field in self.schema],
+            schema=self.schema,
+        )
+        self._writer.write_batch(batch)
+        self.rows += count
+        for values in self._columns.values():
+            values.clear()
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
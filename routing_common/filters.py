@@ -0,0 +1,264 @@
+import ast
+import operator
+import re
+
+import numpy as np
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+_AST_COMPARISONS = {
+    ast.Eq: "==",
+    ast.NotEq: "!=",
+    ast.Lt: "<",
+    ast.LtE: "<=",
+    ast.Gt: ">",
+    ast.GtE: ">=",
+    ast.In: "in",
+    ast.NotIn: "not in",
+}
+
+# the comparison with its sides swapped, for "1000 < population"
+_FLIPPED = {"==": "==", "!=": "!=", "<": ">", "<=": ">=", ">": "<", ">=": "<="}
+
+_UNBOUNDED = (-np.inf, np.inf)
+
+
+class Comparison:
+    '''
+    `column op value`, where op is one of COMPARISONS, "in", "not in" or "between" (value is [low, high]).
+    '''
+
+    def __init__(self, column, op, value):
+        if op not in COMPARISONS and op not in ("in", "not in", "between"):
+            raise ValueError(f"Unsupported filter operator: {op}")
+        if op in ("in", "not in", "between") and not isinstance(value, (list, tuple)):
+            raise ValueError(f"The value of a \"{op}\" filter must be a list")
+        if op == "between" and len(value) != 2:
+            raise ValueError("The value of a \"between\" filter must be [low, high]")
+        # like DataFrame.query, comparing to a list is a membership test
+        if op in ("==", "!=") and isinstance(value, (list, tuple)):
+            op = "in" if op == "==" else "not in"
+        self.column = column
+        self.op = op
+        self.value = value
+
+    def columns(self):
+        return {self.column}
+
+    def mask(self, columns, size):
+        values = columns[self.column]
+        if self.op in ("in", "not in"):
+            mask = np.isin(values, list(self.value))
+            return ~mask if self.op == "not in" else mask
+        if self.op == "between":
+            low, high = self.value
+            return (values >= low) & (values <= high)
+        return np.asarray(COMPARISONS[self.op](values, self.value), dtype=bool)
+
+    def bounds(self, column):
+        if column != self.column:
+            return _UNBOUNDED
+        if self.op == "between":
+            return tuple(self.value)
+        if self.op in ("<", "<="):
+            return -np.inf, self.value
+        if self.op in (">", ">="):
+            return self.value, np.inf
+        if self.op == "==":
+            return self.value, self.value
+        return _UNBOUNDED
+
+
+class All:
+    def __init__(self, parts):
+        self.parts = list(parts)
+
+    def columns(self):
+        return set().union(*(part.columns() for part in self.parts))
+
+    def mask(self, columns, size):
+        mask = np.ones(size, dtype=bool)
+        for part in self.parts:
+            mask &= part.mask(columns, size)
+        return mask
+
+    def bounds(self, column):
+        low, high = _UNBOUNDED
+        for part in self.parts:
+            part_low, part_high = part.bounds(column)
+            low, high = max(low, part_low), min(high, part_high)
+        return low, high
+
+
+class Any:
+    def __init__(self, parts):
+        self.parts = list(parts)
+
+    def columns(self):
+        return set().union(*(part.columns() for part in self.parts))
+
+    def mask(self, columns, size):
+        mask = np.zeros(size, dtype=bool)
+        for part in self.parts:
+            mask |= part.mask(columns, size)
+        return mask
+
+    def bounds(self, column):
+        if not self.parts:
+            return _UNBOUNDED
+        bounds = [part.bounds(column) for part in self.parts]
+        return min(low for low, _ in bounds), max(high for _, high in bounds)
+
+
+class Not:
+    def __init__(self, part):
+        self.part = part
+
+    def columns(self):
+        return self.part.columns()
+
+    def mask(self, columns, size):
+        return ~self.part.mask(columns, size)
+
+    def bounds(self, column):
+        return _UNBOUNDED
+
+
+def _literal(node, text):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise ValueError(f"Unsupported value in filter: {text}")
+
+
+def _from_ast(node, names, text):
+    if isinstance(node, ast.BoolOp):
+        parts = [_from_ast(value, names, text) for value in node.values]
+        return All(parts) if isinstance(node.op, ast.And) else Any(parts)
+    # DataFrame.query style "&", "|" and "~"
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+        parts = [_from_ast(node.left, names, text), _from_ast(node.right, names, text)]
+        return All(parts) if isinstance(node.op, ast.BitAnd) else Any(parts)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Not, ast.Invert)):
+        return Not(_from_ast(node.operand, names, text))
+    if isinstance(node, ast.Compare):
+        parts = []
+        operands = [node.left] + node.comparators
+        for left, op, right in zip(operands[:-1], node.ops, operands[1:]):
+            op = _AST_COMPARISONS.get(type(op))
+            if op is None:
+                raise ValueError(f"Unsupported comparison in filter: {text}")
+            if isinstance(left, ast.Name):
+                parts.append(Comparison(names.get(left.id, left.id), op, _literal(right, text)))
+            elif isinstance(right, ast.Name) and op in _FLIPPED:
+                parts.append(Comparison(names.get(right.id, right.id), _FLIPPED[op], _literal(left, text)))
+            else:
+                raise ValueError(f"A comparison must be between a column and a value: {text}")
+        return parts[0] if len(parts) == 1 else All(parts)
+    raise ValueError(f"Unsupported filter expression: {text}")
+
+
+def parse_expression(text):
+    '''
+    Parses a DataFrame.query style expression such as "population > 10000 and `country code` != 'RU'".
+
+    Only comparisons of a column with literal values, "in"/"not in" lists and and/or/not (or &, |, ~) are
+    allowed; anything else, such as function calls or attribute access, is rejected instead of evaluated.
+    '''
+    names = {}
+
+    def quote(match):
+        placeholder = f"_column_{len(names)}"
+        names[placeholder] = match.group(1)
+        return placeholder
+
+    try:
+        tree = ast.parse(re.sub(r"`([^`]*)`", quote, text).strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid filter expression {text!r}: {e.msg}")
+    return _from_ast(tree.body, names, text)
+
+
+def parse_filter(spec):
+    '''
+    Parses one filter: an expression string (see `parse_expression`) or a structured filter, one of
+    {"column": ..., "op": ..., "value": ...}, {"all": [filters]}, {"any": [filters]} and {"not": filter}.
+    '''
+    if isinstance(spec, str):
+        return parse_expression(spec)
+    if isinstance(spec, dict):
+        if "all" in spec:
+            return All(parse_filter(part) for part in spec["all"])
+        if "any" in spec:
+            return Any(parse_filter(part) for part in spec["any"])
+        if "not" in spec:
+            return Not(parse_filter(spec["not"]))
+        if "column" in spec:
+            return Comparison(spec["column"], spec.get("op", "=="), spec["value"])
+    raise ValueError(f"Invalid filter: {spec!r}")
+
+
+def compile_filters(filters):
+    '''
+    Combines a list of filters into one filter that keeps the rows every filter keeps.
+    '''
+    return All(parse_filter(spec) for spec in filters)
+
+
+class CityStore:
+    '''
+    Column arrays of a destination table sorted by latitude, so the rows in a latitude band are a slice found
+    by binary search instead of a scan of the whole table.
+    '''
+
+    def __init__(self, table, latitude_col, longitude_col):
+        self._order = np.argsort(table[latitude_col].to_numpy(), kind="stable")
+        self.table = table.iloc[self._order]
+        self.latitude_col = latitude_col
+        self.longitude_col = longitude_col
+        self.columns = {name: self.table[name].to_numpy() for name in self.table.columns}
+
+    def __len__(self):
+        return len(self.table)
+
+    def select(self, row_filter, derived=None):
+        '''
+        Returns the rows that pass `row_filter`, in the order of the original table, and the values of the
+        `derived` columns for them.
+
+        Only the rows in the latitude band the filter allows are evaluated. `derived` maps the names of computed
+        columns, such as a distance, to functions of the column arrays; they are computed after the parts of the
+        filter that do not use them, only for the rows that are left.
+        '''
+        derived = derived or {}
+        unknown = row_filter.columns() - set(self.columns) - set(derived)
+        if unknown:
+            raise ValueError(f"Unknown column(s) in filter: {', '.join(sorted(unknown))}")
+
+        south, north = row_filter.bounds(self.latitude_col)
+        # rows without a latitude are sorted last, they are only in an unbounded band
+        start = 0 if south == -np.inf else np.searchsorted(self.columns[self.latitude_col], south, side="left")
+        stop = len(self) if north == np.inf else np.searchsorted(self.columns[self.latitude_col], north, side="right")
+
+        parts = row_filter.parts if isinstance(row_filter, All) else [row_filter]
+        direct = All(part for part in parts if not part.columns() & set(derived))
+        computed = All(part for part in parts if part.columns() & set(derived))
+
+        columns = {name: values[start:stop] for name, values in self.columns.items()}
+        rows = np.flatnonzero(direct.mask(columns, stop - start)) + start
+        columns = {name: values[rows] for name, values in self.columns.items()}
+        derived_values = {name: function(columns) for name, function in derived.items()}
+        if computed.parts:
+            keep = computed.mask(dict(columns, **derived_values), len(rows))
+            rows = rows[keep]
+            derived_values = {name: values[keep] for name, values in derived_values.items()}
+        original_order = np.argsort(self._order[rows], kind="stable")
+        derived_values = {name: values[original_order] for name, values in derived_values.items()}
+        return self.table.iloc[rows[original_order]], derived_values
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+
+
+def _factorize(labels):
+    # an object array keeps tuple labels whole
+    labels = list(labels)
+    array = np.empty(len(labels), dtype=object)
+    array[:] = labels
+    codes, uniques = pd.factorize(array, sort=False)
+    return codes, list(uniques)
+
+
+def _sum(index, values, size):
+    # np.bincount sums in float64, integer flows are cast back (exact below 2 ** 53)
+    totals = np.bincount(index, weights=values, minlength=size)
+    if np.issubdtype(values.dtype, np.integer):
+        totals = totals.astype(values.dtype)
+    return totals
+
+
+class FlowMatrix:
+    '''
+    Flows from origins to crossings as a sparse origins x crossings matrix in COO form: parallel arrays of row
+    (origin) indices, column (crossing) indices and values, with the origin and crossing labels.
+
+    Aggregating flows is a product with 0/1 indicator matrices, P.T @ F @ Q, where P maps origins to origin groups
+    (such as admin regions) and Q maps crossings to crossing groups (such as destination countries or haven
+    cities). As every row of an indicator matrix has a single 1, the product is computed by relabelling the row
+    and column indices and summing the values that land on the same cell, which is linear in the number of flows.
+    '''
+
+    def __init__(self, origins, crossings, rows, cols, values):
+        self.origins = list(origins)
+        self.crossings = list(crossings)
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.values = np.asarray(values)
+        if not len(self.rows) == len(self.cols) == len(self.values):
+            raise ValueError("rows, cols and values must have the same length")
+
+    @classmethod
+    def from_records(cls, origins, crossings, values):
+        '''
+        Builds the matrix from one (origin, crossing, value) triple per flow. Labels can be any hashable values;
+        rows and columns are numbered in the order the labels first appear. Flows without an origin or a crossing
+        (None or NaN) are left out.
+        '''
+        rows, origin_labels = _factorize(origins)
+        cols, crossing_labels = _factorize(crossings)
+        kept = (rows >= 0) & (cols >= 0)
+        return cls(origin_labels, crossing_labels, rows[kept], cols[kept], np.asarray(values)[kept])
+
+    @property
+    def shape(self):
+        return len(self.origins), len(self.crossings)
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    def total(self):
+        return self.values.sum()
+
+    def _group_index(self, labels, groups):
+        if groups is None:
+            return np.arange(len(labels)), labels
+        if callable(groups):
+            group_of = [groups(label) for label in labels]
+        elif isinstance(groups, (dict, pd.Series)):
+            group_of = [groups.get(label) for label in labels]
+        else:
+            group_of = list(groups)
+            if len(group_of) != len(labels):
+                raise ValueError("A list of groups needs one group per label")
+        # labels without a group (None or NaN) are dropped from the aggregate, like DataFrame.groupby does
+        return _factorize(group_of)
+
+    def aggregate(self, origin_groups=None, crossing_groups=None):
+        '''
+        Returns the matrix of flows between groups of origins and groups of crossings.
+
+        A grouping is a {label: group} dict or Series, a function of the label or a list with the group of every
+        label, in the order of `origins` or `crossings`. Without a grouping the origins (or crossings) are kept.
+        '''
+        origin_index, origin_labels = self._group_index(self.origins, origin_groups)
+        crossing_index, crossing_labels = self._group_index(self.crossings, crossing_groups)
+        rows, cols = origin_index[self.rows], crossing_index[self.cols]
+        kept = (rows >= 0) & (cols >= 0)
+        cells = rows[kept] * len(crossing_labels) + cols[kept]
+        unique_cells, cell_index = np.unique(cells, return_inverse=True)
+        return FlowMatrix(
+            origin_labels,
+            crossing_labels,
+            unique_cells // max(len(crossing_labels), 1),
+            unique_cells % max(len(crossing_labels), 1),
+            _sum(cell_index.reshape(-1), self.values[kept], len(unique_cells)),
+        )
+
+    def origin_totals(self, groups=None):
+        '''
+        Total flow out of every origin (or origin group), F @ 1, as a Series.
+        '''
+        index, labels = self._group_index(self.origins, groups)
+        rows = index[self.rows]
+        kept = rows >= 0
+        return pd.Series(_sum(rows[kept], self.values[kept], len(labels)), index=pd.Index(labels, dtype=object))
+
+    def crossing_totals(self, groups=None):
+        '''
+        Total flow into every crossing (or crossing group), F.T @ 1, as a Series.
+        '''
+        index, labels = self._group_index(self.crossings, groups)
+        cols = index[self.cols]
+        kept = cols >= 0
+        return pd.Series(_sum(cols[kept], self.values[kept], len(labels)), index=pd.Index(labels, dtype=object))
+
+    def to_dense(self):
+        dense = np.zeros(self.shape, dtype=self.values.dtype if self.nnz else float)
+        np.add.at(dense, (self.rows, self.cols), self.values)
+        return dense
+
+    def to_frame(self, origin_name="origin", crossing_name="crossing", value_name="flow"):
+        '''
+        Returns the non zero cells as a long table.
+        '''
+        return pd.DataFrame({
+            origin_name: pd.Series([self.origins[row] for row in self.rows], dtype=object),
+            crossing_name: pd.Series([self.crossings[col] for col in self.cols], dtype=object),
+            value_name: self.values,
+        })
@@ -0,0 +1,259 @@
+import functools
+import os
+import re
+import threading
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+from routing_common.geonames import DATA_DIR
+from routing_common.refresh import artifact_path, load_artifact, read_city_table
+
+GAZETTEER_FILE = os.path.join(DATA_DIR, "cities15000.txt")
+
+COUNTRY_CODES_FILE = os.path.join(DATA_DIR, "wikipedia-iso-country-codes.csv")
+
+GAZETTEER_COLUMNS = ["name", "asciiname", "alternatenames", "latitude", "longitude", "country code", "population"]
+
+_NOT_WORD = re.compile(r"[\W_]+")
+
+# sorts after every character of a key, so the keys starting with a prefix sort before prefix + _LAST
+_LAST = "\U0010ffff"
+
+
+def normalize_name(text):
+    '''
+    The key a place name is looked up by: case folded words without accents, so "Kijów" and "KIJOW" match, in any
+    script ("Київ" is a key too).
+    '''
+    text = str(text)
+    # most names are ASCII already and skip the unicode decomposition
+    if not text.isascii():
+        text = "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+    return _NOT_WORD.sub(" ", text.casefold()).strip()
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def read_country_keys(country_codes_file=COUNTRY_CODES_FILE):
+    '''
+    Returns {normalized country name: ISO alpha-2 code} and {normalized ISO alpha-2 or alpha-3 code: alpha-2 code}.
+    The names include the spellings of the country_aliases artifact when it is built.
+    '''
+    codes = pd.read_csv(country_codes_file, keep_default_na=False, dtype=str)
+    alpha2_of = dict(zip(codes["Alpha-3 code"], codes["Alpha-2 code"]))
+    names = {
+        normalize_name(name): code for name, code in zip(codes["English short name lower case"], codes["Alpha-2 code"])
+    }
+    if os.path.exists(artifact_path("country_aliases")):
+        aliases = load_artifact("country_aliases")
+        for alias, iso3 in zip(aliases["alias"], aliases["iso3"]):
+            if iso3 in alpha2_of and len(alias) > 3:
+                names.setdefault(alias, alpha2_of[iso3])
+    country_codes = {code.lower(): code for code in codes["Alpha-2 code"]}
+    country_codes.update({code.lower(): alpha2_of[code] for code in codes["Alpha-3 code"]})
+    return names, country_codes
+
+
+class Gazetteer:
+    '''
+    Offline geocoder over a GeoNames table, so place names are turned into coordinates without an API call.
+
+    Every name, ASCII name and alternate name of a place is normalized and kept in a sorted array of keys, each
+    with the places that have it, largest first. An exact name is a dict lookup and a prefix a binary search over
+    the keys. Misspelled names are matched on the trigrams they share with the keys; that index is built the first
+    time it is needed. Matches are ranked by how well they match, then by population.
+    '''
+
+    def __init__(self, places, country_names=None, country_codes=None):
+        places = places.assign(population=places["population"].fillna(0).astype(np.int64))
+        places = places.sort_values("population", ascending=False, kind="stable").reset_index(drop=True)
+        self.latitudes = places["latitude"].to_numpy(dtype=float)
+        self.longitudes = places["longitude"].to_numpy(dtype=float)
+        self.countries = places["country code"].to_numpy(dtype=object)
+        self.populations = places["population"].to_numpy()
+        self.names = places["name"].to_numpy(dtype=object)
+        self.country_names = dict(country_names or {})
+        self.country_codes = dict(country_codes or {})
+
+        raw = [places["name"]]
+        if "asciiname" in places:
+            raw.append(places["asciiname"])
+        if "alternatenames" in places:
+            raw.append(places["alternatenames"].str.split(",").explode())
+        raw = pd.concat(raw).dropna()
+        # the same spelling comes back for many places, each is normalized once
+        unique_names, inverse = np.unique(raw.to_numpy(dtype=str), return_inverse=True)
+        keys = np.array([normalize_name(name) for name in unique_names], dtype=object)[inverse.reshape(-1)]
+        pairs = pd.DataFrame({"key": keys, "row": raw.index.to_numpy()})
+        pairs = pairs[pairs["key"] != ""].drop_duplicates().sort_values(["key", "row"], kind="stable")
+
+        # keys sorted for prefix search, with the rows of each key (largest place first) as one flat array
+        self.keys, key_ids = np.unique(pairs["key"].to_numpy(dtype=object), return_inverse=True)
+        self._rows = pairs["row"].to_numpy()
+        self._starts = np.searchsorted(key_ids.reshape(-1), np.arange(len(self.keys) + 1))
+        self._key_lengths = np.array([len(key) for key in self.keys])
+        self._key_ids = {key: index for index, key in enumerate(self.keys)}
+
+        self._largest = {}
+        for row, country in enumerate(self.countries):
+            self._largest.setdefault(country, row)
+
+        self._lock = threading.Lock()
+        self._trigram_postings = None
+
+    @classmethod
+    def from_geonames(cls, file_path=GAZETTEER_FILE, country_codes_file=COUNTRY_CODES_FILE):
+        country_names, country_codes = read_country_keys(country_codes_file)
+        return cls(read_city_table(file_path, columns=GAZETTEER_COLUMNS), country_names, country_codes)
+
+    def __len__(self):
+        return len(self.names)
+
+    def country_code(self, country, codes=True):
+        '''
+        The ISO alpha-2 code of a country name (or, with `codes`, of an alpha-2 or alpha-3 code), or None.
+        '''
+        key = normalize_name(country)
+        code = self.country_names.get(key)
+        if code is None and codes:
+            code = self.country_codes.get(key)
+        return code
+
+    def country_point(self, country):
+        '''
+        (lat, lng, country code) of the largest place of a country, or None.
+        '''
+        row = self._largest.get(self.country_code(country))
+        return None if row is None else self._point(row)
+
+    def _point(self, row):
+        return float(self.latitudes[row]), float(self.longitudes[row]), self.countries[row]
+
+    def _build_trigrams(self):
+        with self._lock:
+            if self._trigram_postings is None:
+                postings = {}
+                for key_id, key in enumerate(self.keys):
+                    for gram in trigrams(key):
+                        postings.setdefault(gram, []).append(key_id)
+                self._trigram_counts = np.array([len(trigrams(key)) for key in self.keys])
+                self._trigram_postings = {gram: np.array(ids) for gram, ids in postings.items()}
+        return self._trigram_postings
+
+    def _fuzzy_keys(self, key, min_similarity):
+        postings = self._build_trigrams()
+        grams = trigrams(key)
+        hits = [postings[gram] for gram in grams if gram in postings]
+        if not hits:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        shared = np.bincount(np.concatenate(hits), minlength=len(self.keys))
+        candidates = np.flatnonzero(shared)
+        # Dice coefficient of the trigram sets
+        similarity = 2 * shared[candidates] / (len(grams) + self._trigram_counts[candidates])
+        keep = similarity >= min_similarity
+        return candidates[keep], similarity[keep]
+
+    def _matches(self, key_ids, scores, kind, code):
+        counts = self._starts[key_ids + 1] - self._starts[key_ids]
+        positions = np.repeat(self._starts[key_ids] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        rows, row_scores = self._rows[positions], np.repeat(scores, counts)
+        if code is not None:
+            in_country = self.countries[rows] == code
+            rows, row_scores = rows[in_country], row_scores[in_country]
+        # best score first, then the largest place (rows are sorted by population); each place once
+        order = np.lexsort((rows, -row_scores))
+        rows, row_scores = rows[order], row_scores[order]
+        _, first = np.unique(rows, return_index=True)
+        first = np.sort(first)
+        return [(int(row), kind, float(score)) for row, score in zip(rows[first], row_scores[first])]
+
+    def search(self, name, country=None, limit=5, min_similarity=0.5):
+        '''
+        Returns the places named `name`, at most `limit`, as dicts with the name, coordinates, country code and
+        population, how they matched ("exact", "prefix" or "fuzzy") and a score between 0 and 1.
+
+        Exact matches are returned if there are any, then names that start with `name`, then names sharing
+        enough trigrams with it. `country`, a name or code, keeps only the places of that country.
+        '''
+        key = normalize_name(name)
+        code = None if country is None else self.country_code(country)
+        if not key or (country is not None and code is None):
+            return []
+        matches = []
+        if key in self._key_ids:
+            matches = self._matches(np.array([self._key_ids[key]]), np.ones(1), "exact", code)
+        if not matches:
+            start = np.searchsorted(self.keys, key, side="left")
+            stop = np.searchsorted(self.keys, key + _LAST, side="left")
+            key_ids = np.arange(start, stop)
+            matches = self._matches(key_ids, len(key) / self._key_lengths[key_ids], "prefix", code)
+        if not matches:
+            matches = self._matches(*self._fuzzy_keys(key, min_similarity), "fuzzy", code)
+        return [
+            {
+                "name": self.names[row],
+                "latitude": float(self.latitudes[row]),
+                "longitude": float(self.longitudes[row]),
+                "country code": self.countries[row],
+                "population": int(self.populations[row]),
+                "match": kind,
+                "score": score,
+            }
+            for row, kind, score in matches[:limit]
+        ]
+
+    def locate(self, text):
+        '''
+        Returns (lat, lng, country code) for "City, Country", "City", "Country" or "lat,lng", or None when the
+        place is not in the gazetteer. A country on its own is located at its largest place.
+
+        Only a name that is exactly in the gazetteer (in the country, when one is given) is located. Anything else,
+        such as "Paris, Texas" or a misspelling, gives None, so it is geocoded by the routing service instead of
+        being taken for a different place; `search` finds prefixes and misspellings for interactive lookups.
+        '''
+        parts = [part.strip() for part in str(text).split(",")]
+        try:
+            lat, lng = float(parts[0]), float(parts[1])
+            return lat, lng, None
+        except (ValueError, IndexError):
+            pass
+
+        # country names can have commas, such as "Moldova, Republic of"
+        if self.country_code(text, codes=False) is not None:
+            return self.country_point(text)
+        code = None
+        if len(parts) > 1 and self.country_code(parts[-1]) is not None:
+            code = self.country_code(parts[-1])
+            parts = parts[:-1]
+        key_id = self._key_ids.get(normalize_name(", ".join(parts)))
+        if key_id is None:
+            return None
+        matches = self._matches(np.array([key_id]), np.ones(1), "exact", code)
+        return self._point(matches[0][0]) if matches else None
+
+    def geocode(self, address):
+        '''
+        `locate` with the result in the shape of a googlemaps geocode response: a list with one place, or empty.
+        '''
+        place = self.locate(address)
+        if place is None:
+            return []
+        lat, lng, country = place
+        return [{
+            "formatted_address": str(address),
+            "geometry": {"location": {"lat": lat, "lng": lng}},
+            "address_components": [{"short_name": country, "types": ["country"]}] if country else [],
+        }]
+
+
+@functools.lru_cache(maxsize=4)
+def load_gazetteer(file_path=GAZETTEER_FILE):
+    '''
+    The gazetteer of a GeoNames file, built once per process.
+    '''
+    return Gazetteer.from_geonames(file_path)
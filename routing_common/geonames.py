@@ -0,0 +1,208 @@
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+GEONAMES_COLUMNS = [
+    "geonameid",
+    "name",
+    "asciiname",
+    "alternatenames",
+    "latitude",
+    "longitude",
+    "feature class",
+    "feature code",
+    "country code",
+    "cc2",
+    "admin1 code",
+    "admin2 code",
+    "admin3 code",
+    "admin4 code",
+    "population",
+    "elevation",
+    "dem",
+    "timezone",
+    "modification date",
+]
+
+
+# Types of the numeric GeoNames columns when they are read in blocks, so every block has the same dtypes. All
+# other columns are text, codes such as "01" keep their leading zeros.
+GEONAMES_DTYPES = {
+    "geonameid": np.int64,
+    "latitude": np.float64,
+    "longitude": np.float64,
+    "population": np.int64,
+    "dem": np.int64,
+}
+
+# Columns the filters of iter_geonames are evaluated on
+_PREDICATE_COLUMNS = ["latitude", "longitude", "feature class", "population"]
+
+BLOCK_SIZE = 64 * 1024 * 1024
+
+
+def read_geonames_file(file_path, columns=None, bbox=None, feature_classes=None, min_population=None, **kwargs):
+    '''
+    Reads a GeoNames dump (cities5000.txt, cities15000.txt, ...). GeoNames files have no header row.
+
+    With any of the filters of `geonames_mask` the file is streamed with `iter_geonames` (which takes the other
+    keyword arguments) and only the matching rows are read.
+    '''
+    if bbox is not None or feature_classes is not None or min_population is not None:
+        chunks = list(iter_geonames(
+            file_path,
+            columns=columns,
+            bbox=bbox,
+            feature_classes=feature_classes,
+            min_population=min_population,
+            **kwargs
+        ))
+        if not chunks:
+            return _parse_rows(b"", columns)
+        return pd.concat(chunks)
+    return pd.read_csv(
+        file_path,
+        sep="\t",
+        header=None,
+        names=GEONAMES_COLUMNS,
+        usecols=columns,
+        dtype={name: str for name in GEONAMES_COLUMNS if name not in GEONAMES_DTYPES},
+        quoting=3,
+        keep_default_na=False,
+        na_values={"population": [""], "latitude": [""], "longitude": [""]},
+        low_memory=False,
+    )
+
+
+def _parse_rows(data, columns):
+    names = GEONAMES_COLUMNS if columns is None else [name for name in GEONAMES_COLUMNS if name in columns]
+    dtypes = {name: GEONAMES_DTYPES.get(name, str) for name in names}
+    if not data:
+        return pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in dtypes.items()})
+    return pd.read_csv(
+        io.BytesIO(data),
+        sep="\t",
+        header=None,
+        names=GEONAMES_COLUMNS,
+        usecols=names,
+        dtype=dtypes,
+        quoting=3,
+        keep_default_na=False,
+    )
+
+
+def geonames_mask(table, bbox=None, feature_classes=None, min_population=None):
+    '''
+    Boolean mask of the rows of a GeoNames table inside `bbox` (south, west, north, east), of one of
+    `feature_classes` (e.g. "P" for populated places) and with at least `min_population` people. A bbox whose
+    west is east of its east crosses the antimeridian.
+    '''
+    mask = np.ones(len(table), dtype=bool)
+    if bbox is not None:
+        south, west, north, east = bbox
+        latitude = table["latitude"].to_numpy()
+        longitude = table["longitude"].to_numpy()
+        mask &= (latitude >= south) & (latitude <= north)
+        if west <= east:
+            mask &= (longitude >= west) & (longitude <= east)
+        else:
+            mask &= (longitude >= west) | (longitude <= east)
+    if feature_classes is not None:
+        mask &= table["feature class"].isin(list(feature_classes)).to_numpy()
+    if min_population is not None:
+        mask &= table["population"].to_numpy() >= min_population
+    return mask
+
+
+def _block_ranges(file_path, block_size):
+    # blocks end at a line break, so no line is split between two blocks
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + block_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+
+def _read_block(file_path, start, end, columns, filters):
+    '''
+    Reads the rows of one block that match the filters. Only the filter columns are parsed for every row; the
+    other columns are only parsed for the rows that match. Returns the rows and the number of lines in the block.
+    '''
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    lines = data.splitlines()
+    predicates = _parse_rows(data, _PREDICATE_COLUMNS)
+    if len(predicates) != len(lines):
+        # read_csv skips blank lines
+        lines = [line for line in lines if line.strip()]
+    matches = np.flatnonzero(geonames_mask(predicates, **filters))
+    rows = _parse_rows(b"\n".join(lines[i] for i in matches), columns)
+    rows.index = matches
+    return rows, len(lines)
+
+
+def iter_geonames(
+        file_path,
+        columns=None,
+        bbox=None,
+        feature_classes=None,
+        min_population=None,
+        block_size=BLOCK_SIZE,
+        workers=1,
+):
+    '''
+    Streams the rows of a GeoNames dump that pass the filters (see `geonames_mask`), one DataFrame per block of
+    `block_size` bytes, so files such as allCountries.txt can be searched without loading them. The index of
+    the rows is their line number in the file. With `workers` > 1 blocks are parsed on that many processes;
+    at most two blocks per worker are in memory at a time.
+    '''
+    filters = {"bbox": bbox, "feature_classes": feature_classes, "min_population": min_population}
+    ranges = _block_ranges(file_path, block_size)
+    first_line = 0
+    if workers <= 1:
+        for start, end in ranges:
+            rows, line_count = _read_block(file_path, start, end, columns, filters)
+            rows.index += first_line
+            first_line += line_count
+            if len(rows):
+                yield rows
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for start, end in ranges:
+            pending.append(executor.submit(_read_block, file_path, start, end, columns, filters))
+            if len(pending) < 2 * workers:
+                continue
+            rows, line_count = pending.pop(0).result()
+            rows.index += first_line
+            first_line += line_count
+            if len(rows):
+                yield rows
+        for future in pending:
+            rows, line_count = future.result()
+            rows.index += first_line
+            first_line += line_count
+            if len(rows):
+                yield rows
+
+
+def read_country_codes(file_path=None):
+    '''
+    Returns {country name: ISO alpha-2 code} from the wikipedia country code table.
+    '''
+    if file_path is None:
+        file_path = os.path.join(DATA_DIR, "wikipedia-iso-country-codes.csv")
+    codes = pd.read_csv(file_path, keep_default_na=False)
+    return dict(zip(codes["English short name lower case"], codes["Alpha-2 code"]))
@@ -0,0 +1,366 @@
+import datetime
+import itertools
+import json
+import numbers
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# Google Maps Platform list prices in USD per 1000 billable units. Distance Matrix is billed per element,
+# the other endpoints per request. Only used to give a rough per-run cost estimate in the trace.
+PRICE_PER_1000 = {
+    "directions": 5.0,
+    "distance_matrix": 5.0,
+    "geocode": 5.0,
+}
+
+
+def peak_rss_bytes():
+    '''
+    The highest resident memory of the process so far, which only grows over its lifetime.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+
+def current_rss_bytes():
+    '''
+    The resident memory of the process now, or None where /proc is not available.
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def count_locations(locations):
+    '''
+    Returns how many locations a googlemaps `origins`/`destinations` argument holds.
+    '''
+    if locations is None:
+        return 0
+    if isinstance(locations, str):
+        return locations.count("|") + 1
+    if isinstance(locations, dict):
+        return 1
+    if isinstance(locations, (list, tuple)):
+        if len(locations) == 2 and all(isinstance(value, numbers.Number) for value in locations):
+            return 1
+        return len(locations)
+    return 1
+
+
+def _union_seconds(intervals, start, end):
+    # Length of the union of `intervals` clipped to [start, end], so concurrent calls are not double counted
+    total = 0.0
+    current_start = current_end = None
+    for interval_start, interval_end in sorted(intervals):
+        interval_start = max(interval_start, start)
+        interval_end = min(interval_end, end)
+        if interval_end <= interval_start:
+            continue
+        if current_end is None or interval_start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = interval_start, interval_end
+        else:
+            current_end = max(current_end, interval_end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+class Tracer:
+    '''
+    Records wall time per stage, outbound API calls, cache hits and bytes written for a single model run.
+
+    Stages nest per thread. Work handed to a thread pool should be wrapped with `bind` so its API calls are
+    attributed to the stage that submitted it.
+    '''
+
+    def __init__(self, name="run"):
+        self.name = name
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._ids = itertools.count()
+        self.stages = []
+        self.api_calls = []
+        self.cache = defaultdict(lambda: {"hits": 0, "misses": 0})
+        self.bytes_written = {}
+
+    def _now(self):
+        return time.perf_counter() - self._t0
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def stage(self, name):
+        stack = self._stack()
+        record = {
+            "id": next(self._ids),
+            "name": name,
+            "path": "/".join([parent["name"] for parent in stack] + [name]),
+            "thread": threading.get_ident(),
+            "start": self._now(),
+            "rss_start": current_rss_bytes(),
+        }
+        stack.append(record)
+        try:
+            yield record
+        finally:
+            stack.pop()
+            record["end"] = self._now()
+            rss_end = current_rss_bytes()
+            # the process peak would repeat the largest earlier stage, so a stage gets what it added
+            record["rss_delta_bytes"] = (
+                None if rss_end is None or record["rss_start"] is None else rss_end - record["rss_start"]
+            )
+            with self._lock:
+                self.stages.append(record)
+
+    @contextmanager
+    def api_call(self, endpoint, elements=1):
+        record = {
+            "endpoint": endpoint,
+            "elements": elements,
+            "thread": threading.get_ident(),
+            "stage_ids": [stage["id"] for stage in self._stack()],
+            "start": self._now(),
+            "ok": False,
+        }
+        try:
+            yield record
+            record["ok"] = True
+        finally:
+            record["end"] = self._now()
+            with self._lock:
+                self.api_calls.append(record)
+
+    def bind(self, fn):
+        '''
+        Wraps `fn` so that, when it runs on another thread, it is attributed to the caller's current stages.
+        '''
+        parent_stack = list(self._stack())
+
+        def bound(*args, **kwargs):
+            stack = self._stack()
+            saved = list(stack)
+            stack[:] = parent_stack
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stack[:] = saved
+
+        return bound
+
+    def cache_hit(self, cache_name):
+        with self._lock:
+            self.cache[cache_name]["hits"] += 1
+
+    def cache_miss(self, cache_name):
+        with self._lock:
+            self.cache[cache_name]["misses"] += 1
+
+    def wrote(self, path):
+        with self._lock:
+            self.bytes_written[path] = os.path.getsize(path)
+        return path
+
+    def summary(self):
+        with self._lock:
+            stages = sorted(self.stages, key=lambda stage: stage["start"])
+            api_calls = list(self.api_calls)
+            cache = {name: dict(counts) for name, counts in self.cache.items()}
+            bytes_written = dict(self.bytes_written)
+
+        api = defaultdict(lambda: {"calls": 0, "elements": 0, "errors": 0, "seconds": 0.0})
+        for call in api_calls:
+            totals = api[call["endpoint"]]
+            totals["calls"] += 1
+            totals["elements"] += call["elements"]
+            totals["errors"] += 0 if call["ok"] else 1
+            totals["seconds"] += call["end"] - call["start"]
+
+        estimated_cost = 0.0
+        for endpoint, totals in api.items():
+            totals["seconds"] = round(totals["seconds"], 6)
+            units = totals["elements"] if endpoint == "distance_matrix" else totals["calls"]
+            totals["estimated_cost_usd"] = round(units * PRICE_PER_1000.get(endpoint, 0.0) / 1000, 4)
+            estimated_cost += totals["estimated_cost_usd"]
+
+        stage_summaries = []
+        for stage in stages:
+            calls = [call for call in api_calls if stage["id"] in call["stage_ids"]]
+            wall = stage["end"] - stage["start"]
+            network = _union_seconds(
+                [(call["start"], call["end"]) for call in calls], stage["start"], stage["end"]
+            )
+            stage_api = defaultdict(lambda: {"calls": 0, "elements": 0})
+            for call in calls:
+                stage_api[call["endpoint"]]["calls"] += 1
+                stage_api[call["endpoint"]]["elements"] += call["elements"]
+            stage_summaries.append({
+                "name": stage["name"],
+                "path": stage["path"],
+                "start_seconds": round(stage["start"], 6),
+                "wall_seconds": round(wall, 6),
+                "network_seconds": round(network, 6),
+                "python_seconds": round(wall - network, 6),
+                "api": dict(stage_api),
+                "rss_delta_bytes": stage["rss_delta_bytes"],
+            })
+
+        all_calls = [(call["start"], call["end"]) for call in api_calls]
+        wall = self._now()
+        network = _union_seconds(all_calls, 0.0, wall)
+        return {
+            "name": self.name,
+            "started": self.started.isoformat(),
+            "wall_seconds": round(wall, 6),
+            "network_seconds": round(network, 6),
+            "python_seconds": round(wall - network, 6),
+            "process_peak_rss_bytes": peak_rss_bytes(),
+            "estimated_cost_usd": round(estimated_cost, 4),
+            "stages": stage_summaries,
+            "api": dict(api),
+            "cache": cache,
+            "bytes_written": {
+                "total": sum(bytes_written.values()),
+                "files": bytes_written,
+            },
+        }
+
+    def _events(self):
+        with self._lock:
+            stages = list(self.stages)
+            api_calls = list(self.api_calls)
+        events = [
+            (stage["thread"], stage["name"], "stage", stage["start"], stage["end"])
+            for stage in stages
+        ]
+        events.extend(
+            (call["thread"], f"{call['endpoint']} ({call['elements']})", "api", call["start"], call["end"])
+            for call in api_calls
+        )
+        return events
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        trace_events = [
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": round(start * 1e6, 3),
+                "dur": round((end - start) * 1e6, 3),
+                "pid": pid,
+                "tid": thread,
+            }
+            for thread, name, category, start, end in self._events()
+        ]
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms", "otherData": {"name": self.name}}
+
+    def speedscope(self):
+        frames = []
+        frame_index = {}
+        by_thread = defaultdict(list)
+        for thread, name, _, start, end in self._events():
+            if name not in frame_index:
+                frame_index[name] = len(frames)
+                frames.append({"name": name})
+            by_thread[thread].append((start, end, frame_index[name]))
+
+        profiles = []
+        for thread, intervals in by_thread.items():
+            events = []
+            open_intervals = []
+            # Parents sort before their children; closing everything that ended before the next open keeps
+            # the open/close events properly nested as the evented speedscope format requires.
+            for start, end, frame in sorted(intervals, key=lambda interval: (interval[0], -interval[1])):
+                while open_intervals and open_intervals[-1][0] <= start:
+                    closed_end, closed_frame = open_intervals.pop()
+                    events.append({"type": "C", "frame": closed_frame, "at": closed_end})
+                if open_intervals:
+                    end = min(end, open_intervals[-1][0])
+                events.append({"type": "O", "frame": frame, "at": start})
+                open_intervals.append((end, frame))
+            while open_intervals:
+                closed_end, closed_frame = open_intervals.pop()
+                events.append({"type": "C", "frame": closed_frame, "at": closed_end})
+            profiles.append({
+                "type": "evented",
+                "name": f"thread {thread}",
+                "unit": "seconds",
+                "startValue": min(event["at"] for event in events),
+                "endValue": max(event["at"] for event in events),
+                "events": events,
+            })
+
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": self.name,
+            "exporter": "routing_common.instrumentation",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+    def save(self, trace_file=None, chrome_trace_file=None, speedscope_file=None):
+        for path, build in (
+                (trace_file, self.summary),
+                (chrome_trace_file, self.chrome_trace),
+                (speedscope_file, self.speedscope),
+        ):
+            if not path:
+                continue
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(build(), f, indent=2)
+
+
+class TracedClient:
+    '''
+    Wraps a googlemaps client so every geocode, directions and distance matrix call is recorded on a `Tracer`.
+    '''
+
+    def __init__(self, client, tracer):
+        self.client = client
+        self.tracer = tracer
+
+    def geocode(self, *args, **kwargs):
+        with self.tracer.api_call("geocode"):
+            return self.client.geocode(*args, **kwargs)
+
+    def directions(self, origin, destination, *args, **kwargs):
+        with self.tracer.api_call("directions"):
+            return self.client.directions(origin, destination, *args, **kwargs)
+
+    def distance_matrix(self, origins, destinations, *args, **kwargs):
+        elements = count_locations(origins) * count_locations(destinations)
+        with self.tracer.api_call("distance_matrix", elements):
+            return self.client.distance_matrix(origins, destinations, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
@@ -0,0 +1,284 @@
+import argparse
+import json
+import math
+import os
+import threading
+
+import numpy as np
+
+from routing_common.geonames import DATA_DIR
+from routing_common.jobs import call_many
+from routing_common.local_backend import EARTH_RADIUS_KM, haversine_km
+from routing_common.stage_cache import StageCache
+
+ISOCHRONE_CACHE_DIR = os.path.join(DATA_DIR, "isochrones")
+
+# starts in the same cell of this many degrees (about 5 km) share their travel times
+CELL_DEGREES = 0.05
+
+# fields are sampled out to a multiple of this, so nearby flight radii share one field
+RADIUS_STEP_KM = 100
+
+# Distance Matrix destinations per request
+MATRIX_CHUNK = 25
+
+# stands in for the time to places without a route while interpolating, so it stays finite; an interpolated time
+# over a year leans on such a place and is taken as unreachable too
+UNREACHABLE_SECONDS = 1e12
+YEAR_SECONDS = 365 * 86400
+
+_fields = {}
+_fields_lock = threading.Lock()
+
+
+def destination_points(lat, lng, bearings, distances_km):
+    '''
+    The points `distances_km` away from (lat, lng) along `bearings` (degrees clockwise from north), on a sphere.
+    '''
+    phi, lam = math.radians(lat), math.radians(lng)
+    theta = np.radians(np.asarray(bearings, dtype=float))
+    delta = np.asarray(distances_km, dtype=float) / EARTH_RADIUS_KM
+    phi2 = np.arcsin(np.sin(phi) * np.cos(delta) + np.cos(phi) * np.sin(delta) * np.cos(theta))
+    lam2 = lam + np.arctan2(np.sin(theta) * np.sin(delta) * np.cos(phi), np.cos(delta) - np.sin(phi) * np.sin(phi2))
+    return np.degrees(phi2), (np.degrees(lam2) + 540) % 360 - 180
+
+
+def polar_coordinates(lat, lng, latitudes, longitudes):
+    '''
+    The bearing (degrees clockwise from north) and great circle distance in km from (lat, lng) to every point.
+    '''
+    latitudes, longitudes = np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float)
+    phi, phi2 = math.radians(lat), np.radians(latitudes)
+    delta = np.radians(longitudes - lng)
+    bearings = np.degrees(np.arctan2(
+        np.sin(delta) * np.cos(phi2), math.cos(phi) * np.sin(phi2) - math.sin(phi) * np.cos(phi2) * np.cos(delta)
+    )) % 360
+    return bearings, haversine_km(lat, lng, latitudes, longitudes)
+
+
+class Isochrone:
+    '''
+    The area reachable from `start` within `hours`, as a star-shaped polygon: the distance reached along each of
+    evenly spaced bearings. A point is inside when it is no further than the boundary along its bearing, which is
+    one vectorized lookup for any number of points.
+    '''
+
+    def __init__(self, start, hours, bearings, radii_km):
+        self.start = start
+        self.hours = hours
+        self.bearings = bearings
+        self.radii_km = radii_km
+
+    def contains(self, latitudes, longitudes):
+        bearings, distances = polar_coordinates(*self.start, latitudes, longitudes)
+        return distances <= np.interp(bearings, self.bearings, self.radii_km, period=360)
+
+    def polygon(self):
+        '''
+        The boundary as a closed list of (lat, lng) points.
+        '''
+        latitudes, longitudes = destination_points(*self.start, self.bearings, self.radii_km)
+        points = list(zip(latitudes.tolist(), longitudes.tolist()))
+        return points + points[:1]
+
+    def geojson(self):
+        return {
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [[[lng, lat] for lat, lng in self.polygon()]]},
+            "properties": {"hours": self.hours},
+        }
+
+
+class TravelTimeField:
+    '''
+    Travel times from a start point sampled on a polar grid: `seconds[i, j]` is the time to the point
+    `distances_km[j]` away along `bearings[i]`, evenly spaced from north. Times between the samples are
+    interpolated (bilinearly in bearing and distance, from 0 at the start), so the travel time to any number of
+    places is estimated without routing them. Places beyond the last ring have no estimate (NaN), places without
+    a route take forever (inf).
+
+    A sample without a route (NaN or inf) is usually a point in a lake, a sea inlet or a closed area, not a sign
+    that nothing further away can be reached, so it is treated as missing: its time is interpolated from the
+    samples before and after it on the same bearing. Only the samples past the last one with a route are taken as
+    unreachable. Times are then made non-decreasing along each bearing, so every isochrone is a star-shaped
+    polygon around the start.
+    '''
+
+    def __init__(self, start, distances_km, seconds):
+        self.start = (float(start[0]), float(start[1]))
+        self.distances_km = np.asarray(distances_km, dtype=float)
+        seconds = np.atleast_2d(np.asarray(seconds, dtype=float))
+        filled = np.full(seconds.shape, UNREACHABLE_SECONDS)
+        for row, times in enumerate(seconds):
+            routed = np.flatnonzero(np.isfinite(times))
+            if len(routed):
+                last = routed[-1] + 1
+                filled[row, :last] = np.interp(
+                    self.distances_km[:last], np.r_[0.0, self.distances_km[routed]], np.r_[0.0, times[routed]]
+                )
+        self.seconds = np.maximum.accumulate(np.minimum(filled, UNREACHABLE_SECONDS), axis=1)
+        self.bearings = np.arange(len(self.seconds)) * 360 / len(self.seconds)
+
+    @classmethod
+    def sample(cls, client, start, travel_mode, max_radius_km, bearings=16, rings=12):
+        '''
+        Samples the travel times with Distance Matrix calls from `start` to `bearings` x `rings` points, the rings
+        spaced geometrically out to `max_radius_km`, so the samples are densest near the start.
+        '''
+        distances_km = np.geomspace(max_radius_km / 64, max_radius_km, rings)
+        grid_bearings = np.repeat(np.arange(bearings) * 360 / bearings, rings)
+        latitudes, longitudes = destination_points(*start, grid_bearings, np.tile(distances_km, bearings))
+        points = [(float(lat), float(lng)) for lat, lng in zip(latitudes, longitudes)]
+        origin = (float(start[0]), float(start[1]))
+        responses = call_many(client, "distance_matrix", [
+            ((origin, points[first:first + MATRIX_CHUNK]), {"mode": travel_mode})
+            for first in range(0, len(points), MATRIX_CHUNK)
+        ])
+        seconds = []
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+            seconds.extend(
+                element["duration"]["value"] if element.get("status", "OK") == "OK" and "duration" in element
+                else np.inf
+                for element in response["rows"][0]["elements"]
+            )
+        return cls(start, distances_km, np.reshape(seconds, (bearings, rings)))
+
+    def _profiles(self, bearings):
+        # the times along the rings at any bearings, interpolated between the sampled ones, with 0 at the start
+        position = np.asarray(bearings, dtype=float) % 360 / (360 / len(self.bearings))
+        lower = np.floor(position).astype(np.int64) % len(self.bearings)
+        weight = (position - np.floor(position))[:, None]
+        profiles = (1 - weight) * self.seconds[lower] + weight * self.seconds[(lower + 1) % len(self.bearings)]
+        return np.hstack([np.zeros((len(profiles), 1)), profiles])
+
+    def travel_seconds(self, latitudes, longitudes):
+        '''
+        The estimated travel time in seconds to every point.
+        '''
+        bearings, distances = polar_coordinates(*self.start, latitudes, longitudes)
+        bearings, distances = np.atleast_1d(bearings), np.atleast_1d(distances)
+        profiles = self._profiles(bearings)
+        rings = np.r_[0.0, self.distances_km]
+        ring = np.clip(np.searchsorted(rings, distances, side="right") - 1, 0, len(rings) - 2)
+        fraction = (distances - rings[ring]) / (rings[ring + 1] - rings[ring])
+        rows = np.arange(len(profiles))
+        seconds = profiles[rows, ring] + fraction * (profiles[rows, ring + 1] - profiles[rows, ring])
+        seconds[seconds > YEAR_SECONDS] = np.inf
+        seconds[distances > self.distances_km[-1]] = np.nan
+        return seconds
+
+    def isochrone(self, hours, resolution=360):
+        '''
+        The area reachable within `hours`, with its boundary at `resolution` bearings. It stops at the last ring.
+        '''
+        limit = hours * 3600
+        bearings = np.arange(resolution) * 360 / resolution
+        profiles = self._profiles(bearings)
+        rings = np.r_[0.0, self.distances_km]
+        # the last ring reached along each bearing, then the distance where the time passes the limit after it
+        ring = np.count_nonzero(profiles <= limit, axis=1) - 1
+        inner = np.minimum(ring, len(rings) - 2)
+        rows = np.arange(resolution)
+        earlier, later = profiles[rows, inner], profiles[rows, inner + 1]
+        fraction = np.clip((limit - earlier) / np.maximum(later - earlier, 1e-9), 0, 1)
+        radii = rings[inner] + fraction * (rings[inner + 1] - rings[inner])
+        radii[ring == len(rings) - 1] = rings[-1]
+        return Isochrone(self.start, hours, bearings, radii)
+
+
+def start_cell(lat, lng, cell_degrees=CELL_DEGREES):
+    '''
+    The center of the cell of a start point.
+    '''
+    return round(round(lat / cell_degrees) * cell_degrees, 6), round(round(lng / cell_degrees) * cell_degrees, 6)
+
+
+def load_travel_field(
+        client,
+        start,
+        travel_mode="driving",
+        max_radius_km=500,
+        routing_backend="google",
+        cache_dir=ISOCHRONE_CACHE_DIR,
+        cell_degrees=CELL_DEGREES,
+        tracer=None,
+):
+    '''
+    The travel time field of the cell of `start` for a travel mode, sampled with `client` the first time and
+    then kept in memory and, unless `cache_dir` is None, on disk for other runs. `routing_backend` names the
+    service `client` uses, since fields of different services are kept apart.
+    '''
+    center = start_cell(*start, cell_degrees)
+    inputs = {
+        "start": center,
+        "travel_mode": travel_mode,
+        "max_radius_km": RADIUS_STEP_KM * math.ceil(max_radius_km / RADIUS_STEP_KM),
+        "routing_backend": routing_backend,
+    }
+    key = (json.dumps(inputs, sort_keys=True), cache_dir)
+    with _fields_lock:
+        field = _fields.get(key)
+    if field is None:
+        cache = StageCache(cache_dir, enabled=cache_dir is not None, tracer=tracer)
+        _, field = cache.run(
+            "travel_time_field", TravelTimeField.sample, client, center, travel_mode, inputs["max_radius_km"],
+            # the samples are filled in by the constructor, so fields are resampled when that changes
+            code=(TravelTimeField,),
+            inputs=inputs,
+        )
+        with _fields_lock:
+            _fields[key] = field
+    return field
+
+
+def main():
+    from routing_common.clients import ROUTING_BACKENDS, build_client
+    from routing_common.gazetteer import GAZETTEER_FILE, load_gazetteer
+    from routing_common.refresh import read_city_table
+
+    parser = argparse.ArgumentParser(
+        description="Lists the places reachable from a start within some hours, without routing to each of them",
+    )
+    parser.add_argument("start_location", help="\"City, Country\" or \"lat,lng\"")
+    parser.add_argument("hours", type=float, nargs="+", help="Travel times of the isochrones, in hours")
+    parser.add_argument("--travel-mode", default="driving", help="Travel mode of the routing service")
+    parser.add_argument("--routing-backend", choices=ROUTING_BACKENDS, default="google")
+    parser.add_argument("--max-radius-km", type=float, default=1000, help="How far from the start to sample")
+    parser.add_argument(
+        "--destination-file", default=os.path.join(DATA_DIR, "cities5000.txt"), help="GeoNames file of the places"
+    )
+    parser.add_argument("--min-population", type=int, default=None, help="Only places with this many people")
+    parser.add_argument("--cache-dir", default=ISOCHRONE_CACHE_DIR, help="Where the sampled travel times are kept")
+    parser.add_argument("--output-dir", default="output")
+    args = parser.parse_args()
+
+    client = build_client(args.routing_backend)
+    place = load_gazetteer(GAZETTEER_FILE).locate(args.start_location)
+    if place is None:
+        location = client.geocode(address=args.start_location)[0]["geometry"]["location"]
+        place = location["lat"], location["lng"], None
+    field = load_travel_field(
+        client, place[:2], args.travel_mode, args.max_radius_km, args.routing_backend, args.cache_dir
+    )
+
+    places = read_city_table(args.destination_file)
+    if args.min_population is not None:
+        places = places[places["population"] >= args.min_population]
+    latitudes, longitudes = places["latitude"].to_numpy(), places["longitude"].to_numpy()
+    isochrones = [field.isochrone(hours) for hours in sorted(args.hours)]
+    inside = isochrones[-1].contains(latitudes, longitudes)
+    reachable = places.loc[inside, ["name", "country code", "latitude", "longitude", "population"]].assign(
+        travel_hours=np.round(field.travel_seconds(latitudes[inside], longitudes[inside]) / 3600, 2)
+    ).sort_values("travel_hours", kind="stable")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    reachable.to_csv(os.path.join(args.output_dir, "reachable.csv"), index=False)
+    with open(os.path.join(args.output_dir, "isochrones.geojson"), "w") as f:
+        json.dump({"type": "FeatureCollection", "features": [isochrone.geojson() for isochrone in isochrones]}, f)
+    print(f"{len(reachable)} places within {max(args.hours)} hours of {args.start_location}")
+
+
+if __name__ == "__main__":
+    main()
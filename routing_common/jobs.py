@@ -0,0 +1,491 @@
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from routing_common.clients import ROUTING_BACKENDS, build_client
+from routing_common.geonames import DATA_DIR
+from routing_common.scheduler import QuotaExceeded
+
+DEFAULT_QUEUE_FILE = os.path.join(DATA_DIR, "jobs.sqlite")
+
+ENDPOINTS = ("directions", "distance_matrix", "geocode")
+
+JOURNAL_MODES = ["wal", "delete"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    run TEXT NOT NULL,
+    key TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    finished REAL,
+    UNIQUE (run, key)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+
+class JobFailed(Exception):
+    pass
+
+
+def _encode(value):
+    # tuples are kept apart from lists, googlemaps reads a (lat, lng) tuple as one location and a list as several
+    if isinstance(value, tuple):
+        return {"__tuple__": [_encode(item) for item in value]}
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if isinstance(value, dict):
+        if list(value) == ["__tuple__"]:
+            return tuple(_decode(item) for item in value["__tuple__"])
+        return {key: _decode(item) for key, item in value.items()}
+    return value
+
+
+def _dumps(value, sort_keys=False):
+    # NumPy scalars, such as coordinates read from a table, are written as plain numbers
+    return json.dumps(value, sort_keys=sort_keys, default=lambda item: item.item())
+
+
+def job_payload(endpoint, args, kwargs):
+    '''
+    The JSON text of a routing call, which is also what identifies a job within a run.
+    '''
+    if endpoint not in ENDPOINTS:
+        raise ValueError(f"Unknown endpoint {endpoint}, expected one of {', '.join(ENDPOINTS)}")
+    return _dumps({"args": _encode(list(args)), "kwargs": _encode(kwargs)}, sort_keys=True)
+
+
+class Job:
+    def __init__(self, id, run, key, endpoint, payload, attempts):
+        self.id = id
+        self.run = run
+        self.key = key
+        self.endpoint = endpoint
+        self.payload = payload
+        self.attempts = attempts
+
+    def call(self, client):
+        payload = _decode(json.loads(self.payload))
+        return getattr(client, self.endpoint)(*payload["args"], **payload["kwargs"])
+
+
+class JobQueue:
+    '''
+    A durable queue of routing calls in a SQLite file, shared by a coordinator and any number of worker processes.
+
+    Jobs are routing calls (an endpoint with its arguments) grouped by run; the same call is only queued once per
+    run. A worker leases a job for `lease_seconds` and keeps extending the lease while the call runs. Jobs whose
+    lease ran out, because their worker died, are leased again, up to `max_attempts` times. Results are written
+    back to the queue as JSON.
+
+    The "wal" journal mode lets readers and one writer work at the same time, but needs every process on the same
+    host. For workers on other hosts, put the file on a shared filesystem with working locks and use "delete".
+    '''
+
+    def __init__(self, path=DEFAULT_QUEUE_FILE, journal_mode="wal", timeout=60.0):
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(f"Unknown journal mode {journal_mode}, expected one of {', '.join(JOURNAL_MODES)}")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.journal_mode = journal_mode
+        self.timeout = timeout
+        # SQLite connections can not be shared between threads
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers never lease the same job
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def submit(self, run, calls, max_attempts=3):
+        '''
+        Queues `calls`, (endpoint, args, kwargs) triples, under `run` and returns their keys. Calls already
+        queued in the run are not queued again, except failed ones, which get another `max_attempts` tries.
+        '''
+        keys = []
+        rows = {}
+        for endpoint, args, kwargs in calls:
+            payload = job_payload(endpoint, args, kwargs)
+            key = hashlib.sha1(f"{endpoint}\n{payload}".encode("utf8")).hexdigest()
+            keys.append(key)
+            rows[key] = (run, key, endpoint, payload, max_attempts, time.time())
+        with self._transaction() as connection:
+            connection.executemany(
+                "INSERT OR IGNORE INTO jobs (run, key, endpoint, payload, max_attempts, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows.values(),
+            )
+            connection.executemany(
+                "UPDATE jobs SET status = 'pending', attempts = 0, max_attempts = ?, error = NULL "
+                "WHERE run = ? AND key = ? AND status = 'failed'",
+                [(max_attempts, run, key) for key in rows],
+            )
+        return keys
+
+    def lease(self, worker, lease_seconds=60.0, endpoints=None):
+        '''
+        Takes the oldest job that is pending or whose lease ran out, or returns None when there is none.
+        '''
+        now = time.time()
+        endpoints = list(endpoints or ENDPOINTS)
+        placeholders = ", ".join("?" * len(endpoints))
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Lease expired after ' || attempts || ' attempts', "
+                "finished = ? WHERE status = 'running' AND lease_expires < ? AND attempts >= max_attempts",
+                (now, now),
+            )
+            row = connection.execute(
+                "SELECT id, run, key, endpoint, payload, attempts FROM jobs "
+                "WHERE (status = 'pending' OR (status = 'running' AND lease_expires < ?)) "
+                f"AND endpoint IN ({placeholders}) ORDER BY id LIMIT 1",
+                [now] + endpoints,
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_expires = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (worker, now + lease_seconds, row[0]),
+            )
+        return Job(*row[:5], attempts=row[5] + 1)
+
+    def _update(self, sql, params):
+        with self._transaction() as connection:
+            return connection.execute(sql, params).rowcount == 1
+
+    def extend(self, job, worker, lease_seconds=60.0):
+        '''
+        Extends the lease of a running job. Returns False when the worker lost the lease.
+        '''
+        return self._update(
+            "UPDATE jobs SET lease_expires = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time() + lease_seconds, job.id, worker),
+        )
+
+    def complete(self, job, worker, result):
+        return self._update(
+            "UPDATE jobs SET status = 'done', result = ?, error = NULL, finished = ? "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (_dumps(result), time.time(), job.id, worker),
+        )
+
+    def fail(self, job, worker, error, retry=False):
+        '''
+        Records a failed call. With `retry` the job is pending again until it has used all its attempts.
+        '''
+        return self._update(
+            "UPDATE jobs SET status = CASE WHEN ? AND attempts < max_attempts THEN 'pending' ELSE 'failed' END, "
+            "error = ?, finished = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (retry, error, time.time(), job.id, worker),
+        )
+
+    def release(self, job, worker):
+        '''
+        Gives a job back without counting the attempt, for a worker that stops before making the call.
+        '''
+        return self._update(
+            "UPDATE jobs SET status = 'pending', attempts = attempts - 1, worker = NULL, lease_expires = NULL "
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (job.id, worker),
+        )
+
+    def results(self, run, keys):
+        '''
+        Returns {key: result} for the jobs of `run` that are done and {key: JobFailed} for the failed ones.
+        Unfinished jobs are left out.
+        '''
+        results = {}
+        keys = list(keys)
+        connection = self._connection()
+        # SQLite limits the number of parameters of a statement
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = connection.execute(
+                "SELECT key, status, result, error FROM jobs "
+                f"WHERE run = ? AND key IN ({', '.join('?' * len(batch))}) AND status IN ('done', 'failed')",
+                [run] + batch,
+            )
+            for key, status, result, error in rows:
+                results[key] = json.loads(result) if status == "done" else JobFailed(error)
+        return results
+
+    def counts(self, run=None):
+        '''
+        Number of jobs by run and status, as {run: {status: count}}.
+        '''
+        sql = "SELECT run, status, COUNT(*) FROM jobs"
+        params = []
+        if run is not None:
+            sql += " WHERE run = ?"
+            params.append(run)
+        counts = {}
+        for job_run, status, count in self._connection().execute(sql + " GROUP BY run, status", params):
+            counts.setdefault(job_run, {})[status] = count
+        return counts
+
+    def purge(self, run):
+        with self._transaction() as connection:
+            return connection.execute("DELETE FROM jobs WHERE run = ?", (run,)).rowcount
+
+
+class QueueClient:
+    '''
+    Routing client with the googlemaps interface that hands every call to the workers of a `JobQueue` and waits
+    for the result, so the run itself needs no API key.
+
+    Single calls block until a worker answers them; `call_many` queues a batch at once, so it is spread over all
+    the workers. Jobs are queued under `run`, and a run started again with the same `run` reuses the results of
+    the calls that were already made.
+    '''
+
+    def __init__(self, queue, run=None, poll_interval=0.2, timeout=None, max_attempts=3):
+        self.queue = queue
+        self.run = run or uuid.uuid4().hex[:12]
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+
+    def call_many(self, endpoint, calls):
+        '''
+        Makes the calls, (args, kwargs) pairs, of `endpoint` on the workers. Returns the result of every call, or
+        the JobFailed error of the calls that failed.
+        '''
+        keys = self.queue.submit(
+            self.run, [(endpoint, args, kwargs) for args, kwargs in calls], max_attempts=self.max_attempts
+        )
+        started = time.time()
+        results = {}
+        reported = 0
+        while True:
+            results.update(self.queue.results(self.run, set(keys) - set(results)))
+            if len(results) == len(set(keys)):
+                return [results[key] for key in keys]
+            if len(keys) > 1 and len(results) != reported:
+                reported = len(results)
+                print(f"{reported} of {len(keys)} {endpoint} jobs of run {self.run} done")
+            if self.timeout is not None and time.time() - started > self.timeout:
+                raise TimeoutError(
+                    f"{len(set(keys)) - len(results)} {endpoint} jobs of run {self.run} not done after "
+                    f"{self.timeout}s, are workers running on {self.queue.path}?"
+                )
+            time.sleep(self.poll_interval)
+
+    def _call(self, endpoint, *args, **kwargs):
+        result = self.call_many(endpoint, [(args, kwargs)])[0]
+        if isinstance(result, JobFailed):
+            raise result
+        return result
+
+    def geocode(self, *args, **kwargs):
+        return self._call("geocode", *args, **kwargs)
+
+    def directions(self, origin, destination, *args, **kwargs):
+        return self._call("directions", origin, destination, *args, **kwargs)
+
+    def distance_matrix(self, origins, destinations, *args, **kwargs):
+        return self._call("distance_matrix", origins, destinations, *args, **kwargs)
+
+
+def call_many(client, endpoint, calls):
+    '''
+    Makes the calls, (args, kwargs) pairs, of `endpoint` on any routing client and returns the result or the
+    error of each. A `QueueClient` runs them on its workers at once, other clients one after the other.
+    A QuotaExceeded error stops the calls.
+    '''
+    batch = getattr(client, "call_many", None)
+    if batch is not None:
+        return batch(endpoint, calls)
+    results = []
+    for args, kwargs in calls:
+        try:
+            results.append(getattr(client, endpoint)(*args, **kwargs))
+        except QuotaExceeded:
+            raise
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _transient(error):
+    # timeouts and connection errors are worth another try, errors returned by the API are not
+    try:
+        from googlemaps.exceptions import Timeout, TransportError
+    except ImportError:
+        return isinstance(error, OSError)
+    return isinstance(error, (OSError, Timeout, TransportError))
+
+
+class Worker:
+    '''
+    Leases jobs from a `JobQueue` and makes their calls with its own routing client, so every worker has its own
+    rate limits (or shares them with the processes using the same quota state file).
+    '''
+
+    def __init__(self, queue, client, name=None, lease_seconds=60.0, endpoints=None):
+        self.queue = queue
+        self.client = client
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.endpoints = endpoints
+
+    def _heartbeat(self, job, done):
+        while not done.wait(self.lease_seconds / 3):
+            if not self.queue.extend(job, self.name, self.lease_seconds):
+                return
+
+    def run_one(self):
+        '''
+        Runs one job. Returns False when there was none to run.
+        '''
+        job = self.queue.lease(self.name, self.lease_seconds, self.endpoints)
+        if job is None:
+            return False
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job, done), daemon=True)
+        heartbeat.start()
+        try:
+            result = job.call(self.client)
+        except QuotaExceeded:
+            self.queue.release(job, self.name)
+            raise
+        except Exception as e:
+            self.queue.fail(job, self.name, f"{type(e).__name__}: {e}", retry=_transient(e))
+        else:
+            self.queue.complete(job, self.name, result)
+        finally:
+            done.set()
+            heartbeat.join()
+        return True
+
+    def run(self, max_jobs=None, idle_exit=None, poll_interval=0.5):
+        '''
+        Runs jobs until `max_jobs` are done, the queue was empty for `idle_exit` seconds or the daily budget is
+        spent. Returns the number of jobs run.
+        '''
+        count = 0
+        idle_since = time.time()
+        while max_jobs is None or count < max_jobs:
+            try:
+                ran = self.run_one()
+            except QuotaExceeded as e:
+                print(f"Worker {self.name} stopping: {e}")
+                break
+            if ran:
+                count += 1
+                idle_since = time.time()
+            elif idle_exit is not None and time.time() - idle_since >= idle_exit:
+                break
+            else:
+                time.sleep(poll_interval)
+        return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Routing job queue shared by model runs and their workers.")
+    parser.add_argument("--queue-file", default=DEFAULT_QUEUE_FILE, help="SQLite file of the job queue")
+    parser.add_argument(
+        "--journal-mode", choices=JOURNAL_MODES, default="wal",
+        help="\"delete\" for a queue file on a filesystem shared with other hosts",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    worker = commands.add_parser("worker", help="Run routing jobs from the queue")
+    worker.add_argument(
+        "--routing-backend", choices=ROUTING_BACKENDS, default="google",
+        help="Routing service to use. \"local\" is an offline stand-in that needs no API key",
+    )
+    worker.add_argument("--places-file", default=None, help="GeoNames file the local routing backend resolves with")
+    worker.add_argument(
+        "--api-limits", default="{}",
+        help='JSON object of per-endpoint rate limits of this worker, e.g. {"directions": {"qps": 10}}',
+    )
+    worker.add_argument(
+        "--daily-budget", type=int, default=None,
+        help="Maximum billable Google Maps units per day; the worker stops when it is spent",
+    )
+    worker.add_argument(
+        "--quota-state-file", default=None,
+        help="File used to share rate limits and daily usage with other workers on the same API key",
+    )
+    worker.add_argument("--name", default=None, help="Name of the worker in the queue (default host:pid)")
+    worker.add_argument("--lease-seconds", type=float, default=60.0, help="How long a job is leased for at a time")
+    worker.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=None, help="Only run these calls")
+    worker.add_argument("--max-jobs", type=int, default=None, help="Stop after this many jobs")
+    worker.add_argument(
+        "--idle-exit", type=float, default=None, help="Stop when the queue was empty for this many seconds"
+    )
+
+    status = commands.add_parser("status", help="Print the number of jobs by run and status")
+    status.add_argument("--run", default=None, help="Only this run")
+
+    purge = commands.add_parser("purge", help="Delete the jobs of a run")
+    purge.add_argument("run")
+    args = parser.parse_args()
+
+    queue = JobQueue(args.queue_file, journal_mode=args.journal_mode)
+    if args.command == "worker":
+        client = build_client(
+            args.routing_backend,
+            api_limits=json.loads(args.api_limits),
+            daily_budget=args.daily_budget,
+            quota_state_file=args.quota_state_file,
+            places_file=args.places_file,
+        )
+        worker = Worker(queue, client, name=args.name, lease_seconds=args.lease_seconds, endpoints=args.endpoints)
+        print(f"Worker {worker.name} running jobs from {queue.path}")
+        count = worker.run(max_jobs=args.max_jobs, idle_exit=args.idle_exit)
+        print(f"Worker {worker.name} ran {count} jobs")
+    elif args.command == "status":
+        for run, statuses in queue.counts(args.run).items():
+            print(f"{run}: " + ", ".join(f"{count} {status}" for status, count in sorted(statuses.items())))
+    else:
+        print(f"Deleted {queue.purge(args.run)} jobs of run {args.run}")
+
+
+if __name__ == "__main__":
+    main()
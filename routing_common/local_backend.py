@@ -0,0 +1,232 @@
+import numbers
+
+import numpy as np
+import polyline
+
+from routing_common.geonames import read_country_codes, read_geonames_file
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+SPEEDS_KMH = {
+    "driving": 60.0,
+    "walking": 5.0,
+    "bicycling": 15.0,
+    "transit": 40.0,
+}
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = (np.radians(value) for value in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def _distance_text(meters):
+    if meters < 1000:
+        return f"{int(meters)} m"
+    return f"{meters / 1000:,.1f} km"
+
+
+def _duration_text(seconds):
+    minutes = int(round(seconds / 60))
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    parts = []
+    if days:
+        parts.append(f"{days} day{'s' if days != 1 else ''}")
+    if hours:
+        parts.append(f"{hours} hour{'s' if hours != 1 else ''}")
+    if minutes or not parts:
+        parts.append(f"{minutes} min{'s' if minutes != 1 else ''}")
+    return " ".join(parts)
+
+
+class LocalRoutingClient:
+    '''
+    Offline stand-in for `googlemaps.Client`.
+
+    Routes follow the great circle between the two points, with a detour factor and a fixed speed per travel
+    mode, and come back in the Google Directions/Distance Matrix response shapes. Place names are resolved
+    against a GeoNames city table, and a route gets an "Entering <country>" step where the nearest city along
+    it switches to the destination country, which is enough for the border crossing logic of the models.
+    It is meant for tests, demos and service runs without an API key, not for real estimates.
+    '''
+
+    def __init__(self, places=None, country_codes=None, detour_factor=1.3, steps_per_route=12, speeds_kmh=None):
+        self.detour_factor = detour_factor
+        self.steps_per_route = steps_per_route
+        self.speeds_kmh = dict(SPEEDS_KMH, **(speeds_kmh or {}))
+        self.country_codes = {name.lower(): code for name, code in (country_codes or {}).items()}
+        self.country_names = {}
+        for name, code in (country_codes or {}).items():
+            self.country_names.setdefault(code, name)
+
+        self._names = {}
+        self._largest_city = {}
+        if places is not None and len(places):
+            places = places.sort_values("population", ascending=False)
+            self._latitudes = places["latitude"].to_numpy(dtype=float)
+            self._longitudes = places["longitude"].to_numpy(dtype=float)
+            self._countries = places["country code"].to_numpy(dtype=object)
+            for idx, (name, country) in enumerate(zip(places["name"], self._countries)):
+                self._names.setdefault(str(name).lower(), []).append(idx)
+                self._largest_city.setdefault(country, idx)
+        else:
+            self._latitudes = self._longitudes = self._countries = None
+
+    @classmethod
+    def from_geonames(cls, file_path, country_codes_file=None, **kwargs):
+        places = read_geonames_file(
+            file_path, columns=["name", "latitude", "longitude", "country code", "population"]
+        )
+        return cls(places=places, country_codes=read_country_codes(country_codes_file), **kwargs)
+
+    def _country_at(self, lat, lng):
+        if self._latitudes is None:
+            return None
+        distances = haversine_km(lat, lng, self._latitudes, self._longitudes)
+        return self._countries[int(np.argmin(distances))]
+
+    def _place(self, idx):
+        return (
+            float(self._latitudes[idx]),
+            float(self._longitudes[idx]),
+            self._countries[idx],
+        )
+
+    def _resolve(self, location):
+        '''
+        Returns (lat, lng, country code) for a coordinate pair, "lat,lng" string, "City, Country" or "Country".
+        '''
+        if isinstance(location, dict):
+            lat, lng = location["lat"], location.get("lng", location.get("lon"))
+            return float(lat), float(lng), self._country_at(lat, lng)
+        if isinstance(location, (list, tuple)) and len(location) == 2 \
+                and all(isinstance(value, numbers.Number) for value in location):
+            return float(location[0]), float(location[1]), self._country_at(location[0], location[1])
+        if not isinstance(location, str):
+            return None
+
+        parts = [part.strip() for part in location.split(",")]
+        try:
+            lat, lng = float(parts[0]), float(parts[1])
+            return lat, lng, self._country_at(lat, lng)
+        except (ValueError, IndexError):
+            pass
+
+        country = None
+        if len(parts) > 1 and parts[-1].lower() in self.country_codes:
+            country = self.country_codes[parts[-1].lower()]
+            parts = parts[:-1]
+        name = ", ".join(parts).lower()
+
+        for idx in self._names.get(name, []):
+            if country is None or self._countries[idx] == country:
+                return self._place(idx)
+        if name in self.country_codes and self.country_codes[name] in self._largest_city:
+            return self._place(self._largest_city[self.country_codes[name]])
+        if country is not None and country in self._largest_city:
+            return self._place(self._largest_city[country])
+        return None
+
+    def _leg_totals(self, origin, destination, mode):
+        distance_m = float(haversine_km(origin[0], origin[1], destination[0], destination[1])) \
+                     * 1000 * self.detour_factor
+        speed = self.speeds_kmh.get(mode, self.speeds_kmh["driving"])
+        return distance_m, distance_m / (speed * 1000 / 3600)
+
+    def geocode(self, address=None, **kwargs):
+        place = self._resolve(address)
+        if place is None:
+            return []
+        lat, lng, country = place
+        return [{
+            "formatted_address": address if isinstance(address, str) else f"{lat},{lng}",
+            "geometry": {"location": {"lat": lat, "lng": lng}},
+            "address_components": [{"short_name": country, "types": ["country"]}] if country else [],
+        }]
+
+    def distance_matrix(self, origins, destinations, mode="driving", **kwargs):
+        origins = [origins] if self._is_single(origins) else list(origins)
+        destinations = [destinations] if self._is_single(destinations) else list(destinations)
+        resolved_destinations = [self._resolve(destination) for destination in destinations]
+        rows = []
+        for origin in origins:
+            resolved_origin = self._resolve(origin)
+            elements = []
+            for destination in resolved_destinations:
+                if resolved_origin is None or destination is None:
+                    elements.append({"status": "NOT_FOUND"})
+                    continue
+                distance_m, duration_s = self._leg_totals(resolved_origin, destination, mode)
+                elements.append({
+                    "status": "OK",
+                    "distance": {"text": _distance_text(distance_m), "value": int(round(distance_m))},
+                    "duration": {"text": _duration_text(duration_s), "value": int(round(duration_s))},
+                })
+            rows.append({"elements": elements})
+        return {
+            "status": "OK",
+            "origin_addresses": [str(origin) for origin in origins],
+            "destination_addresses": [str(destination) for destination in destinations],
+            "rows": rows,
+        }
+
+    def directions(self, origin, destination, mode="driving", **kwargs):
+        start = self._resolve(origin)
+        end = self._resolve(destination)
+        if start is None or end is None:
+            return []
+        distance_m, duration_s = self._leg_totals(start, end, mode)
+
+        fractions = np.linspace(0, 1, self.steps_per_route + 1)
+        lats = start[0] + (end[0] - start[0]) * fractions
+        lngs = start[1] + (end[1] - start[1]) * fractions
+        crossing_step = None
+        if start[2] is not None and end[2] is not None and start[2] != end[2]:
+            for idx in range(1, len(fractions)):
+                if self._country_at(lats[idx], lngs[idx]) == end[2]:
+                    crossing_step = idx - 1
+                    break
+
+        steps = []
+        step_distance = distance_m / self.steps_per_route
+        step_duration = duration_s / self.steps_per_route
+        for idx in range(self.steps_per_route):
+            if idx == crossing_step:
+                instructions = f"Continue straight<div style=\"font-size:0.9em\">Entering " \
+                               f"{self.country_names.get(end[2], end[2])}</div>"
+            else:
+                instructions = "Continue straight"
+            steps.append({
+                "distance": {"text": _distance_text(step_distance), "value": int(round(step_distance))},
+                "duration": {"text": _duration_text(step_duration), "value": int(round(step_duration))},
+                "start_location": {"lat": float(lats[idx]), "lng": float(lngs[idx])},
+                "end_location": {"lat": float(lats[idx + 1]), "lng": float(lngs[idx + 1])},
+                "html_instructions": instructions,
+                "polyline": {"points": polyline.encode([(lats[idx], lngs[idx]), (lats[idx + 1], lngs[idx + 1])])},
+                "travel_mode": mode.upper(),
+            })
+
+        return [{
+            "summary": "local route",
+            "legs": [{
+                "distance": {"text": _distance_text(distance_m), "value": int(round(distance_m))},
+                "duration": {"text": _duration_text(duration_s), "value": int(round(duration_s))},
+                "start_location": {"lat": start[0], "lng": start[1]},
+                "end_location": {"lat": end[0], "lng": end[1]},
+                "start_address": str(origin),
+                "end_address": str(destination),
+                "steps": steps,
+            }],
+            "overview_polyline": {"points": polyline.encode(list(zip(lats, lngs)))},
+            "warnings": ["Route computed by the local routing stand-in"],
+        }]
+
+    @staticmethod
+    def _is_single(locations):
+        if isinstance(locations, (str, dict)):
+            return True
+        return isinstance(locations, tuple) and len(locations) == 2 \
+            and all(isinstance(value, numbers.Number) for value in locations)
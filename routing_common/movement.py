@@ -0,0 +1,157 @@
+import numpy as np
+
+DEPARTURE_CURVES = ["exponential", "uniform"]
+
+
+def departure_curve(curve="exponential", days=60, departure_days=14, half_life_days=7):
+    '''
+    The share of the refugees of an origin that leave on each of `days` days. "uniform" spreads them evenly over
+    the first `departure_days` days, "exponential" has half of those still there leave every `half_life_days`
+    days, and a list gives the weight of each day. The shares add up to 1 over the days, so everyone has left by
+    the last day.
+    '''
+    if isinstance(curve, str):
+        if curve not in DEPARTURE_CURVES:
+            raise ValueError(f"Unknown departure curve {curve}, use one of {', '.join(DEPARTURE_CURVES)} or a list")
+        if curve == "uniform":
+            weights = (np.arange(days) < max(int(departure_days), 1)).astype(float)
+        else:
+            weights = 0.5 ** (np.arange(days) / half_life_days)
+    else:
+        weights = np.zeros(days)
+        curve = np.asarray(curve, dtype=float)[:days]
+        weights[:len(curve)] = curve
+    if days < 1 or (weights < 0).any() or weights.sum() <= 0:
+        raise ValueError("A departure curve needs at least one day and weights that are not negative")
+    return weights / weights.sum()
+
+
+def split_integers(totals, shares):
+    '''
+    Splits every integer total over the shares (which add up to 1) into integer parts that add up to the total:
+    a total is rounded down at every cumulative share and each part is the difference.
+    '''
+    totals = np.asarray(totals, dtype=np.int64)
+    cumulative = np.floor(totals[:, None] * np.cumsum(shares) + 1e-9)
+    cumulative[:, -1] = totals
+    return np.diff(cumulative, axis=1, prepend=0).astype(np.int64)
+
+
+def travel_steps(indptr, cumulative_durations, step_hours=1, travel_hours_per_day=24):
+    '''
+    The time step, counted from the start of the day people leave, in which they get to the end of every route.
+    Routes are in CSR form: route r has the cumulative duration in seconds at the end of each of its steps in
+    cumulative_durations[indptr[r]:indptr[r + 1]], the last of them the duration of the whole route.
+
+    People travel `travel_hours_per_day` hours from the start of every day. They stop for the night at the end
+    of the last route step they reached, or where they are when they did not finish a step that day.
+    '''
+    indptr = np.asarray(indptr, dtype=np.int64)
+    cumulative_durations = np.asarray(cumulative_durations, dtype=float)
+    lengths = np.diff(indptr)
+    durations = np.where(lengths > 0, cumulative_durations[np.maximum(indptr[1:] - 1, 0)], 0.0)
+    step_seconds = step_hours * 3600
+    if travel_hours_per_day >= 24:
+        return np.floor(durations / step_seconds).astype(np.int64)
+    if travel_hours_per_day <= 0:
+        raise ValueError("travel_hours_per_day must be positive")
+
+    steps_per_day = round(24 / step_hours)
+    daily_seconds = travel_hours_per_day * 3600
+    # the step ends of all routes in one sorted array, those of route r moved past the ones of the routes before
+    span = durations.max() + 1 if len(durations) else 1.0
+    keys = np.repeat(np.arange(len(lengths)), lengths) * span + cumulative_durations
+
+    arrival = np.zeros(len(durations), dtype=np.int64)
+    position = np.zeros(len(durations))
+    remaining = np.arange(len(durations))
+    day = 0
+    while len(remaining):
+        reach = position[remaining] + daily_seconds
+        done = reach >= durations[remaining]
+        arrived = remaining[done]
+        arrival[arrived] = day * steps_per_day + np.floor((durations[arrived] - position[arrived]) / step_seconds)
+        remaining, reach = remaining[~done], reach[~done]
+        # the last step end at or before today's reach; one of an earlier route is before the start of this one
+        index = np.searchsorted(keys, remaining * span + reach, side="right") - 1
+        stop = np.where(index >= 0, keys[np.maximum(index, 0)] - remaining * span, -1.0)
+        position[remaining] = np.where(stop > position[remaining], stop, reach)
+        day += 1
+    return arrival
+
+
+class Movement:
+    '''
+    The result of `simulate`, as crossings x days arrays of people: those who left for the crossing that day, who
+    are on the way at the end of the day, who got to the crossing, who crossed and who are waiting to cross at the
+    end of the day.
+    '''
+
+    def __init__(self, departed, en_route, arrived, crossed, waiting):
+        self.departed = departed
+        self.en_route = en_route
+        self.arrived = arrived
+        self.crossed = crossed
+        self.waiting = waiting
+
+    @property
+    def days(self):
+        return self.departed.shape[1]
+
+
+def simulate(indptr, cumulative_durations, crossings, people, throughputs, shares, step_hours=1,
+             travel_hours_per_day=24):
+    '''
+    Moves the people of every route to its crossing and over it, day by day for as many days as `shares` has.
+
+    Routes are given as for `travel_steps`, with the crossing index at their end and their (integer) number of
+    people. Every day the `shares` of the people of a route leave together, as one cohort, and all cohorts of a
+    route take the same number of time steps to the crossing, so the arrivals are one array operation over
+    routes x days. Crossings then take people from their queue every time step, at most `throughputs` (people
+    per day, inf for no limit) spread over the day. People still on the way after the last day are left en route.
+    '''
+    crossings = np.asarray(crossings, dtype=np.int64)
+    throughputs = np.asarray(throughputs, dtype=float)
+    if (throughputs <= 0).any():
+        raise ValueError("Crossing throughputs must be positive")
+    if 24 % step_hours:
+        raise ValueError("step_hours must divide a day")
+    days = len(shares)
+    steps_per_day = round(24 / step_hours)
+    steps = days * steps_per_day
+    size = len(throughputs)
+
+    departures = split_integers(people, shares)
+    arrival = travel_steps(indptr, cumulative_durations, step_hours, travel_hours_per_day)[:, None] + (
+        np.arange(days) * steps_per_day
+    )
+    inside = arrival < steps
+    departed = np.bincount(
+        (crossings[:, None] * days + np.arange(days)).ravel(), weights=departures.ravel(), minlength=size * days
+    ).reshape(size, days)
+    arrived = np.bincount(
+        (crossings[:, None] * steps + arrival)[inside], weights=departures[inside], minlength=size * steps
+    ).reshape(size, steps)
+
+    if np.isinf(throughputs).all():
+        crossed = arrived
+    else:
+        per_step = throughputs / steps_per_day
+        crossed = np.empty_like(arrived)
+        queue = np.zeros(size)
+        for step in range(steps):
+            queue += arrived[:, step]
+            crossed[:, step] = np.minimum(queue, per_step)
+            queue -= crossed[:, step]
+
+    arrived = arrived.reshape(size, days, steps_per_day).sum(axis=2)
+    # crossings take fractions of people per step; the running total is rounded down to whole people
+    crossed_total = np.floor(np.cumsum(crossed.reshape(size, days, steps_per_day).sum(axis=2), axis=1) + 1e-6)
+    arrived_total = np.cumsum(arrived, axis=1)
+    return Movement(
+        departed.astype(np.int64),
+        (np.cumsum(departed, axis=1) - arrived_total).astype(np.int64),
+        arrived.astype(np.int64),
+        np.diff(crossed_total, axis=1, prepend=0).astype(np.int64),
+        (arrived_total - crossed_total).astype(np.int64),
+    )
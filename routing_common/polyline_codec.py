@@ -0,0 +1,103 @@
+import numpy as np
+
+
+def decode_grid(encoded):
+    '''
+    Decodes many encoded polylines at once into integer coordinates, the encoded values before they are divided
+    by 10 ** precision. Returns `(grid, offsets)` like `decode_many`.
+    '''
+    encoded = list(encoded)
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    buffer = np.frombuffer("".join(encoded).encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    if not len(buffer):
+        return np.zeros((0, 2), dtype=np.int64), offsets
+    if buffer.min() < 0 or buffer.max() > 63:
+        raise ValueError("Invalid character in encoded polyline")
+
+    # every value is a run of 5 bit chunks, least significant first, and the last chunk has no 0x20 flag
+    ends = np.flatnonzero((buffer & 0x20) == 0)
+    if not len(ends) or ends[-1] != len(buffer) - 1:
+        raise ValueError("Encoded polyline is truncated")
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    position = np.arange(len(buffer)) - np.repeat(starts, ends - starts + 1)
+    values = np.add.reduceat((buffer & 0x1f) << (5 * position), starts)
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+
+    # values of each line: the values that end before the end of its string
+    value_counts = np.diff(np.searchsorted(ends, np.cumsum([len(line) for line in encoded]), side="left"), prepend=0)
+    if np.any(value_counts % 2):
+        raise ValueError("Encoded polyline has a latitude without a longitude")
+    np.cumsum(value_counts // 2, out=offsets[1:])
+
+    # values are deltas from the previous point of the same line
+    grid = np.cumsum(values.reshape(-1, 2), axis=0)
+    line_start = np.vstack(([[0, 0]], grid))[offsets[:-1]]
+    grid -= np.repeat(line_start, np.diff(offsets), axis=0)
+    return grid, offsets
+
+
+def decode_many(encoded, precision=5):
+    '''
+    Decodes many encoded polylines at once, without a Python loop over their points.
+
+    Returns `(coordinates, offsets)`: an (n, 2) array of the (lat, lng) points of all lines one after the other,
+    and the index of the first point of each line followed by the total, so line i is
+    `coordinates[offsets[i]:offsets[i + 1]]`. Points are the same as polyline.decode returns.
+    '''
+    grid, offsets = decode_grid(encoded)
+    return grid / float(10 ** precision), offsets
+
+
+def lines(coordinates, offsets):
+    '''
+    Yields the lines of a coordinate buffer as views into it.
+    '''
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        yield coordinates[start:end]
+
+
+def _kept_offsets(keep, offsets):
+    return np.concatenate(([0], np.cumsum(keep)))[offsets]
+
+
+def drop_repeated(coordinates, offsets):
+    '''
+    Removes points equal to the point before them on the same line. Returns a new `(coordinates, offsets)`.
+    '''
+    keep = np.ones(len(coordinates), dtype=bool)
+    keep[1:] = np.any(coordinates[1:] != coordinates[:-1], axis=1)
+    keep[offsets[:-1][offsets[:-1] < len(coordinates)]] = True
+    return coordinates[keep], _kept_offsets(keep, offsets)
+
+
+def simplify(coordinates, offsets, tolerance):
+    '''
+    Douglas-Peucker simplification of every line of a coordinate buffer: drops the points that are less than
+    `tolerance` (in coordinate units) from the line through the points kept around them. The first and last point
+    of each line are always kept. Returns a new `(coordinates, offsets)`.
+    '''
+    keep = np.zeros(len(coordinates), dtype=bool)
+    stack = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        if end > start:
+            keep[start] = keep[end - 1] = True
+            stack.append((start, end - 1))
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        inner = coordinates[first + 1:last]
+        a = coordinates[first]
+        direction = coordinates[last] - a
+        length = np.hypot(*direction)
+        if length == 0:
+            distances = np.hypot(*(inner - a).T)
+        else:
+            distances = np.abs(direction[0] * (inner[:, 1] - a[1]) - direction[1] * (inner[:, 0] - a[0])) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return coordinates[keep], _kept_offsets(keep, offsets)
@@ -0,0 +1,493 @@
+import argparse
+import fnmatch
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import unicodedata
+import urllib.request
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+from routing_common.columnar import _field
+from routing_common.geonames import DATA_DIR, GEONAMES_COLUMNS, GEONAMES_DTYPES, read_geonames_file
+
+ARTIFACT_DIR = os.path.join(DATA_DIR, "artifacts")
+MANIFEST_FILE = os.path.join(ARTIFACT_DIR, "manifest.json")
+
+# Bumped when an artifact layout changes, so old artifacts are rebuilt
+SCHEMA_VERSION = 1
+
+# Where each source can come from. A source is the newest file matching its first pattern that matches anything,
+# looked up in the source directories in order; World Bank and V-Dem downloads can be the zips or the CSVs in them.
+SOURCES = {
+    "gdp": {
+        "patterns": ["API_NY.GDP.MKTP.CD*.zip", "API_NY.GDP.MKTP.CD*.csv", "GDP_historic.csv"],
+        "url": "https://api.worldbank.org/v2/en/indicator/NY.GDP.MKTP.CD?downloadformat=csv",
+        "download_name": "API_NY.GDP.MKTP.CD_DS2_en_csv.zip",
+    },
+    "population": {
+        "patterns": ["API_SP.POP.TOTL*.zip", "API_SP.POP.TOTL*.csv", "historic_pop.csv"],
+        "url": "https://api.worldbank.org/v2/en/indicator/SP.POP.TOTL?downloadformat=csv",
+        "download_name": "API_SP.POP.TOTL_DS2_en_csv.zip",
+    },
+    "vdem": {
+        "patterns": ["*V-Dem*.zip", "*V-Dem*.csv", "country_dem.csv"],
+        "url": "https://v-dem.net/media/datasets/Country_Year_V-Dem_Core_CSV_v12.zip",
+        "download_name": "Country_Year_V-Dem_Core_CSV_v12.zip",
+    },
+    "country_codes": {"patterns": ["wikipedia-iso-country-codes.csv"]},
+    "cities15000": {
+        "patterns": ["cities15000.zip", "cities15000.txt"],
+        "url": "https://download.geonames.org/export/dump/cities15000.zip",
+        "download_name": "cities15000.zip",
+    },
+    "cities5000": {
+        "patterns": ["cities5000.zip", "cities5000.txt"],
+        "url": "https://download.geonames.org/export/dump/cities5000.zip",
+        "download_name": "cities5000.zip",
+    },
+}
+
+# Layouts of the artifacts: (column, type) pairs like the output tables in columnar.SCHEMAS
+_GEONAMES_TYPES = {np.int64: "int64", np.float64: "float64"}
+ARTIFACT_SCHEMAS = {
+    "gdp": [("country_name", "string"), ("country_code", "string"), ("year", "int32"), ("gdp", "float64")],
+    "population": [
+        ("country_name", "string"),
+        ("country_code", "string"),
+        ("year", "int32"),
+        ("population", "int64"),
+    ],
+    "democracy": [
+        ("country_name", "string"),
+        ("year", "int32"),
+        ("v2xeg_eqdr", "float64"),
+        ("v2x_libdem", "float64"),
+    ],
+    "country_aliases": [("alias", "string"), ("name", "string"), ("iso3", "string"), ("source", "string")],
+    "cities15000": [(name, _GEONAMES_TYPES.get(GEONAMES_DTYPES.get(name), "string")) for name in GEONAMES_COLUMNS],
+    "cities5000": [(name, _GEONAMES_TYPES.get(GEONAMES_DTYPES.get(name), "string")) for name in GEONAMES_COLUMNS],
+}
+
+# The sources every artifact is built from
+ARTIFACT_SOURCES = {
+    "gdp": ["gdp"],
+    "population": ["population"],
+    "democracy": ["vdem"],
+    "country_aliases": ["country_codes", "gdp", "population", "vdem"],
+    "cities15000": ["cities15000"],
+    "cities5000": ["cities5000"],
+}
+
+# Integer columns with missing values, read back as pandas' nullable Int64
+_NULLABLE_INTS = {"population": ["population"]}
+
+# The files in the data directory the feature tables are parsed from when their artifacts are not built
+FEATURE_FILES = {"gdp": "GDP_historic.csv", "population": "historic_pop.csv", "democracy": "country_dem.csv"}
+
+
+def artifact_path(name):
+    return os.path.join(ARTIFACT_DIR, f"{name}.parquet")
+
+
+def artifact_schema(name):
+    import pyarrow as pa
+
+    return pa.schema([_field(column, kind) for column, kind in ARTIFACT_SCHEMAS[name]])
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_FILE) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {"schema_version": SCHEMA_VERSION, "sources": {}, "artifacts": {}}
+    if manifest.get("schema_version") != SCHEMA_VERSION:
+        return {"schema_version": SCHEMA_VERSION, "sources": {}, "artifacts": {}}
+    return manifest
+
+
+def _source_record(path, previous=None):
+    '''
+    Size, modification time and hash of a source file. The hash of the previous record is reused when the size
+    and modification time are unchanged, so unchanged sources are not read again.
+    '''
+    stat = os.stat(path)
+    record = {"path": os.path.relpath(path, DATA_DIR), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if previous and all(previous.get(key) == record[key] for key in ("path", "size", "mtime_ns")):
+        record["sha256"] = previous["sha256"]
+    else:
+        record["sha256"] = sha256_file(path)
+    return record
+
+
+def find_source(name, source_dirs):
+    '''
+    Returns the path of a source file, or None when no source directory has one.
+    '''
+    for pattern in SOURCES[name]["patterns"]:
+        for source_dir in source_dirs:
+            matches = glob.glob(os.path.join(glob.escape(source_dir), pattern))
+            if matches:
+                return max(matches, key=os.path.getmtime)
+    return None
+
+
+def download_sources(names, source_dir):
+    '''
+    Downloads the archives of `names` into `source_dir`. Returns their paths.
+    '''
+    os.makedirs(source_dir, exist_ok=True)
+    paths = []
+    for name in names:
+        source = SOURCES[name]
+        if "url" not in source:
+            continue
+        path = os.path.join(source_dir, source["download_name"])
+        print(f"Downloading {source['url']}")
+        with urllib.request.urlopen(source["url"]) as response, open(path + ".part", "wb") as f:
+            shutil.copyfileobj(response, f)
+        os.replace(path + ".part", path)
+        paths.append(path)
+    return paths
+
+
+def _open_text(path, member_patterns):
+    '''
+    Returns the text of a CSV file, or of the first file in a zip archive matching one of `member_patterns`.
+    '''
+    if not path.endswith(".zip"):
+        with open(path, encoding="utf-8-sig") as f:
+            return f.read()
+    with zipfile.ZipFile(path) as archive:
+        names = [name for name in archive.namelist() if not name.startswith("__MACOSX")]
+        for pattern in member_patterns:
+            matches = [name for name in names if fnmatch.fnmatch(os.path.basename(name), pattern)]
+            if matches:
+                # the largest match is the data, not a codebook or readme
+                member = max(matches, key=lambda name: archive.getinfo(name).file_size)
+                return archive.read(member).decode("utf-8-sig")
+    raise ValueError(f"{path} has no file matching {', '.join(member_patterns)}")
+
+
+def _check_columns(frame, required, path):
+    missing = [column for column in required if column not in frame.columns]
+    if missing:
+        raise ValueError(f"{path} is missing the column(s) {', '.join(missing)}")
+
+
+def _check(condition, message):
+    if not condition:
+        raise ValueError(message)
+
+
+def parse_world_bank(path, value_name):
+    '''
+    Reads a World Bank indicator CSV, a bulk download (with its zip) or a DataBank export, into one row per country
+    and year. Rows keep the order of the file, with the years of a country in order, and countries without a value
+    for a year keep their row with a missing value.
+    '''
+    text = _open_text(path, ["API_*.csv", "*.csv"])
+    lines = text.splitlines()
+    # bulk downloads start with a few lines about the data before the header
+    header = next((i for i, line in enumerate(lines[:20]) if "Country Name" in line and "Country Code" in line), None)
+    _check(header is not None, f"{path} has no World Bank header row")
+    wide = pd.read_csv(io.StringIO(text), skiprows=header, dtype=str, keep_default_na=False)
+    _check_columns(wide, ["Country Name", "Country Code"], path)
+    # DataBank exports end with notes that are not countries
+    wide = wide[(wide["Country Name"] != "") & (wide["Country Code"] != "")].reset_index(drop=True)
+
+    year_columns = {}
+    for column in wide.columns:
+        match = re.match(r"^(\d{4})(?:\s*\[YR\d{4}\])?$", column.strip())
+        if match:
+            year_columns[column] = int(match.group(1))
+    _check(year_columns, f"{path} has no year columns")
+
+    # ".." and empty cells are missing values
+    values = wide[list(year_columns)].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    count, years = values.shape
+    frame = pd.DataFrame({
+        "country_name": np.repeat(wide["Country Name"].to_numpy(), years),
+        "country_code": np.repeat(wide["Country Code"].to_numpy(), years),
+        "year": np.tile(np.array(list(year_columns.values()), dtype=np.int32), count),
+        value_name: values.reshape(-1),
+    })
+    present = frame[value_name].dropna()
+    _check((present >= 0).all(), f"{path} has negative {value_name} values")
+    _check(not frame.duplicated(["country_code", "year"]).any(), f"{path} has a country twice")
+    if value_name == "population":
+        _check((present == np.round(present)).all(), f"{path} has fractional population values")
+        frame["population"] = pd.array(np.round(frame["population"]), dtype="Int64")
+    return frame
+
+
+def parse_vdem(path):
+    '''
+    Reads the liberal democracy and egalitarian indices from the V-Dem country-year data (its zip or CSV) or a
+    table already cut down to them, keeping the order of the file.
+    '''
+    text = _open_text(path, ["*V-Dem*.csv", "*.csv"])
+    header = pd.read_csv(io.StringIO(text), nrows=0).columns
+    columns = ["country_name", "year", "v2xeg_eqdr", "v2x_libdem"]
+    if "country_text_id" in header:
+        columns.append("country_text_id")
+    _check_columns(pd.DataFrame(columns=header), columns[:4], path)
+    frame = pd.read_csv(io.StringIO(text), usecols=columns, low_memory=False)[columns]
+    _check(frame["year"].between(1700, 2100).all(), f"{path} has years out of range")
+    for column in ("v2xeg_eqdr", "v2x_libdem"):
+        _check(frame[column].dropna().between(0, 1).all(), f"{path} has {column} values outside 0-1")
+    frame["year"] = frame["year"].astype(np.int32)
+    return frame
+
+
+def normalize_country(name):
+    '''
+    The key a country name is looked up by: lower case ASCII words, so "Côte d'Ivoire" and "Cote D Ivoire" match.
+    '''
+    text = unicodedata.normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii").lower()
+    return " ".join(re.findall(r"[a-z0-9]+", text))
+
+
+def build_country_aliases(country_codes_path, gdp, population, democracy):
+    '''
+    Maps every spelling of a country name used by a source, and the ISO codes, to the ISO alpha-3 code.
+    '''
+    codes = pd.read_csv(country_codes_path, keep_default_na=False, dtype=str)
+    _check_columns(codes, ["English short name lower case", "Alpha-2 code", "Alpha-3 code"], country_codes_path)
+    rows = []
+    iso = zip(codes["English short name lower case"], codes["Alpha-2 code"], codes["Alpha-3 code"])
+    for name, alpha2, alpha3 in iso:
+        rows += [(name, name, alpha3, "iso"), (alpha2, name, alpha3, "iso"), (alpha3, name, alpha3, "iso")]
+    for source, table in (("world_bank_gdp", gdp), ("world_bank_population", population)):
+        names = table.drop_duplicates("country_code")
+        rows += [(name, name, code, source) for name, code in zip(names["country_name"], names["country_code"])]
+
+    aliases = pd.DataFrame(rows, columns=["alias", "name", "iso3", "source"])
+    aliases["alias"] = aliases["alias"].map(normalize_country)
+    known = dict(zip(aliases["alias"], aliases["iso3"]))
+    # the cut down V-Dem table has no codes, its names get the code of the same name in another source
+    names = democracy.drop_duplicates("country_name")
+    codes = names["country_text_id"] if "country_text_id" in names else [None] * len(names)
+    vdem = pd.DataFrame({
+        "alias": [normalize_country(name) for name in names["country_name"]],
+        "name": names["country_name"].to_numpy(),
+        "iso3": [code or known.get(normalize_country(name)) for name, code in zip(names["country_name"], codes)],
+        "source": "vdem",
+    })
+    aliases = pd.concat([aliases, vdem], ignore_index=True)
+    return aliases[aliases["alias"] != ""].drop_duplicates(["alias", "iso3", "source"], ignore_index=True)
+
+
+def parse_cities(path):
+    '''
+    Reads a GeoNames cities file, or its zip.
+    '''
+    if not path.endswith(".zip"):
+        frame = read_geonames_file(path)
+    else:
+        with tempfile.TemporaryDirectory() as tmp, zipfile.ZipFile(path) as archive:
+            member = next(name for name in archive.namelist() if name.endswith(".txt"))
+            frame = read_geonames_file(archive.extract(member, tmp))
+    _check(frame["latitude"].between(-90, 90).all(), f"{path} has latitudes out of range")
+    _check(frame["longitude"].between(-180, 180).all(), f"{path} has longitudes out of range")
+    _check(not frame["geonameid"].duplicated().any(), f"{path} has a geonameid twice")
+    return frame
+
+
+def write_artifact(name, frame):
+    '''
+    Writes an artifact with its schema (the columns must convert to it exactly) and returns its hash.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = artifact_schema(name)
+    table = pa.Table.from_pandas(frame[schema.names], schema=schema, preserve_index=False)
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    path = artifact_path(name)
+    pq.write_table(table, path + ".part", compression="zstd")
+    os.replace(path + ".part", path)
+    return sha256_file(path)
+
+
+def load_artifact(name, columns=None):
+    '''
+    Reads an artifact, or returns None when it has not been built. Raises if its layout is not the expected one.
+    '''
+    import pyarrow.parquet as pq
+
+    path = artifact_path(name)
+    if not os.path.exists(path):
+        return None
+    expected = artifact_schema(name)
+    found = pq.read_schema(path).remove_metadata()
+    if not found.equals(expected):
+        raise ValueError(f"{path} does not have the expected columns, rebuild it with python -m routing_common.refresh")
+    table = pq.read_table(path, columns=columns)
+    nullable = [table.schema.field(column) for column in _NULLABLE_INTS.get(name, []) if column in table.schema.names]
+    return table.to_pandas(
+        types_mapper={field.type: pd.Int64Dtype() for field in nullable}.get if nullable else None
+    )
+
+
+def artifact_is_current(name):
+    '''
+    Whether an artifact was built from its sources as they are now. Sources that are no longer on disk (such as
+    deleted downloads) do not make it stale.
+    '''
+    manifest = load_manifest()
+    built = manifest["artifacts"].get(name)
+    if built is None or not os.path.exists(artifact_path(name)):
+        return False
+    for source in built["sources"]:
+        record = manifest["sources"].get(source)
+        if record is None:
+            return False
+        path = os.path.normpath(os.path.join(DATA_DIR, record["path"]))
+        if not os.path.exists(path):
+            continue
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime_ns) != (record["size"], record["mtime_ns"]) and \
+                sha256_file(path) != record["sha256"]:
+            return False
+    return True
+
+
+def load_feature_table(name):
+    '''
+    Reads one of the country-year feature tables ("gdp", "population" or "democracy") from its artifact when it is
+    current, and otherwise parses its file in the data directory the way a refresh does.
+    '''
+    if artifact_is_current(name):
+        return load_artifact(name)
+    path = os.path.join(DATA_DIR, FEATURE_FILES[name])
+    return parse_vdem(path) if name == "democracy" else parse_world_bank(path, name)
+
+
+def read_city_table(file_path, columns=None):
+    '''
+    Reads a GeoNames cities file from its artifact when one was built from this file and is current (or the file
+    is not on disk any more), and from the text file otherwise.
+    '''
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    if name in ARTIFACT_SCHEMAS and artifact_is_current(name):
+        source = os.path.normpath(os.path.join(DATA_DIR, load_manifest()["sources"][name]["path"]))
+        if not os.path.exists(file_path) or os.path.realpath(file_path) == os.path.realpath(source):
+            return load_artifact(name, columns)
+    return read_geonames_file(file_path, columns=columns)
+
+
+def refresh(source_dirs=(), artifacts=None, force=False):
+    '''
+    Rebuilds the artifacts whose sources changed since the last refresh, or whose files are missing. Sources are
+    looked up in `source_dirs`, then in the data directory. Returns {artifact: "built", "current" or "skipped"}.
+    '''
+    source_dirs = list(source_dirs) + [DATA_DIR]
+    manifest = load_manifest()
+    names = list(ARTIFACT_SOURCES) if artifacts is None else list(artifacts)
+
+    records = {}
+    for source in sorted({source for name in names for source in ARTIFACT_SOURCES[name]}):
+        path = find_source(source, source_dirs)
+        if path is not None:
+            records[source] = _source_record(path, manifest["sources"].get(source))
+
+    parsed = {}
+
+    def parse(source):
+        if source not in parsed:
+            path = os.path.normpath(os.path.join(DATA_DIR, records[source]["path"]))
+            print(f"Reading {path}")
+            if source in ("gdp", "population"):
+                parsed[source] = parse_world_bank(path, source)
+            elif source == "vdem":
+                parsed[source] = parse_vdem(path)
+            elif source == "country_codes":
+                parsed[source] = path
+            else:
+                parsed[source] = parse_cities(path)
+        return parsed[source]
+
+    status = {}
+    for name in names:
+        sources = ARTIFACT_SOURCES[name]
+        if any(source not in records for source in sources):
+            print(f"Skipping {name}: no {', '.join(source for source in sources if source not in records)} file")
+            status[name] = "skipped"
+            continue
+        hashes = {source: records[source]["sha256"] for source in sources}
+        built = manifest["artifacts"].get(name)
+        path = artifact_path(name)
+        if not force and built is not None and built["sources"] == hashes and os.path.exists(path) \
+                and sha256_file(path) == built["sha256"]:
+            status[name] = "current"
+            continue
+
+        if name == "democracy":
+            frame = parse("vdem")
+        elif name == "country_aliases":
+            frame = build_country_aliases(parse("country_codes"), parse("gdp"), parse("population"), parse("vdem"))
+        else:
+            frame = parse(sources[0])
+        manifest["artifacts"][name] = {
+            "file": os.path.basename(path),
+            "sources": hashes,
+            "rows": len(frame),
+            "sha256": write_artifact(name, frame),
+        }
+        manifest["sources"].update({source: records[source] for source in sources})
+        status[name] = "built"
+        print(f"Built {path} ({len(frame)} rows)")
+
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    with open(MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write("\n")
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the data artifacts (country-year features, country aliases and city tables) from the "
+                    "source downloads. Only artifacts whose sources changed are rebuilt."
+    )
+    parser.add_argument(
+        "--source-dir", action="append", default=[],
+        help="Directory with downloaded source files (World Bank and V-Dem zips or CSVs, GeoNames cities files). "
+             "Can be given several times; the data directory is always searched last.",
+    )
+    parser.add_argument(
+        "--download", action="store_true",
+        help="Download the World Bank, V-Dem and GeoNames files into the first --source-dir first",
+    )
+    parser.add_argument("--artifact", action="append", choices=list(ARTIFACT_SOURCES), help="Only refresh these")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the sources did not change")
+    args = parser.parse_args()
+
+    if args.download:
+        if not args.source_dir:
+            parser.error("--download needs a --source-dir to download into")
+        names = args.artifact or list(ARTIFACT_SOURCES)
+        download_sources(sorted({source for name in names for source in ARTIFACT_SOURCES[name]}), args.source_dir[0])
+    for name, state in refresh(args.source_dir, args.artifact, args.force).items():
+        print(f"{name}: {state}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import hashlib
+
+import numpy as np
+
+from routing_common.local_backend import haversine_km
+from routing_common.polyline_codec import decode_grid, drop_repeated
+
+# Encoded polylines have 5 decimals, so points are deduplicated on that grid
+PRECISION = 1e5
+
+
+class RouteStore:
+    '''
+    Stores many routes with the geometry they share kept once.
+
+    Routes are split into segments: the longest stretches of road that are used by the same set of routes.
+    Each segment is kept once, under an id that is a hash of its points, and a route is the list of segments it
+    runs through. Memory, output size and map weight then grow with the length of road covered instead of the
+    number of routes, and adding up the flow of the routes through a segment gives the flow on that road.
+    '''
+
+    def __init__(self):
+        self._grids = []
+        self.properties = {}
+        self.segments = {}
+        self.routes = {}
+
+    def add(self, route_id, points, **properties):
+        '''
+        Adds a route through `points`, (lat, lng) pairs, with optional properties.
+        '''
+        self.add_grid(route_id, np.rint(np.asarray(points, dtype=float).reshape(-1, 2) * PRECISION), **properties)
+
+    def add_grid(self, route_id, grid, **properties):
+        '''
+        Adds a route through points already on the 1e-5 degree grid, as returned by polyline_codec.decode_grid.
+        '''
+        if self._grids is None:
+            raise ValueError("Routes can not be added after the segments are built")
+        if route_id in self.properties:
+            raise ValueError(f"Route {route_id} is already in the store")
+        self._grids.append(np.asarray(grid, dtype=np.int64).reshape(-1, 2))
+        self.properties[route_id] = properties
+
+    def build(self):
+        '''
+        Splits every route into segments where the set of routes using the road changes. Returns the store.
+        '''
+        route_ids = list(self.properties)
+        route_lengths = [len(grid) for grid in self._grids]
+        grid, offsets = drop_repeated(
+            np.concatenate(self._grids) if self._grids else np.zeros((0, 2), dtype=np.int64),
+            np.concatenate(([0], np.cumsum(route_lengths))).astype(np.int64),
+        )
+        self._grids = None
+        point_route = np.repeat(np.arange(len(route_ids)), np.diff(offsets))
+        unique_points, nodes = np.unique(grid, axis=0, return_inverse=True)
+        nodes = nodes.reshape(-1)
+        points = unique_points / PRECISION
+
+        # an edge joins two consecutive points of a route, and is the same edge whichever way it is travelled
+        edge_at = np.flatnonzero(point_route[1:] == point_route[:-1])
+        low = np.minimum(nodes[edge_at], nodes[edge_at + 1])
+        high = np.maximum(nodes[edge_at], nodes[edge_at + 1])
+        _, edges = np.unique(low * len(unique_points) + high, return_inverse=True)
+        edges = edges.reshape(-1)
+        edge_route = point_route[edge_at]
+
+        # the set of routes using an edge, as a sum of random 64 bit route tags
+        tags = np.random.default_rng(0).integers(0, 2 ** 63, len(route_ids), dtype=np.uint64)
+        pairs = np.unique(edges * len(route_ids) + edge_route)
+        pair_edge, pair_route = pairs // len(route_ids), pairs % len(route_ids)
+        signatures = np.zeros(edges.max() + 1 if len(edges) else 0, dtype=np.uint64)
+        np.add.at(signatures, pair_edge, tags[pair_route])
+        pair_start = np.searchsorted(pair_edge, np.arange(len(signatures) + 1))
+
+        # segments start where a route starts or the set of routes using the road changes
+        edge_signatures = signatures[edges]
+        changes = (edge_route[1:] != edge_route[:-1]) | (edge_signatures[1:] != edge_signatures[:-1])
+        breaks = np.append(np.flatnonzero(np.concatenate(([True], changes))[:len(edges)]), len(edges))
+
+        for route_id in route_ids:
+            self.routes[route_id] = []
+        for start, end in zip(breaks[:-1], breaks[1:]):
+            run = nodes[edge_at[start]:edge_at[end - 1] + 2]
+            # a stretch is stored once whichever way it is travelled
+            reverse = tuple(unique_points[run[-1]]) < tuple(unique_points[run[0]])
+            if reverse:
+                run = run[::-1]
+            segment_id = hashlib.sha1(np.ascontiguousarray(unique_points[run]).tobytes()).hexdigest()[:16]
+            if segment_id not in self.segments:
+                edge = edges[start]
+                coordinates = points[run]
+                self.segments[segment_id] = {
+                    "coordinates": coordinates,
+                    "routes": sorted(
+                        (route_ids[route] for route in pair_route[pair_start[edge]:pair_start[edge + 1]]), key=str
+                    ),
+                    "length_meters": float(
+                        haversine_km(
+                            coordinates[:-1, 0], coordinates[:-1, 1], coordinates[1:, 0], coordinates[1:, 1]
+                        ).sum() * 1000
+                    ),
+                }
+            self.routes[route_ids[edge_route[start]]].append((segment_id, reverse))
+        return self
+
+    def route_coordinates(self, route_id):
+        '''
+        Rebuilds the (lat, lng) points of a route from its segments, as an (n, 2) array.
+        '''
+        parts = []
+        for segment_id, reverse in self.routes[route_id]:
+            segment = self.segments[segment_id]["coordinates"]
+            if reverse:
+                segment = segment[::-1]
+            parts.append(segment[1:] if parts else segment)
+        return np.concatenate(parts) if parts else np.zeros((0, 2))
+
+    def segment_flows(self, route_flows):
+        '''
+        Returns the total flow through each segment, given the flow along each route as {route_id: flow}.
+        '''
+        return {
+            segment_id: sum(route_flows.get(route_id, 0) for route_id in segment["routes"])
+            for segment_id, segment in self.segments.items()
+        }
+
+    def stats(self):
+        route_points_count = sum(
+            sum(len(self.segments[segment_id]["coordinates"]) for segment_id, _ in parts)
+            for parts in self.routes.values()
+        )
+        return {
+            "routes": len(self.routes),
+            "segments": len(self.segments),
+            "route_points": route_points_count,
+            "unique_points": sum(len(segment["coordinates"]) for segment in self.segments.values()),
+        }
+
+
+def build_route_store(all_directions, origins=None):
+    '''
+    Builds a route store of the exit routes in `all_directions`, {route id: crossing}, up to their border crossing.
+    A route id is the conflict city of the route unless `origins` maps it to one, {route id: conflict city}.
+    '''
+    origins = origins or {}
+    chosen = {
+        route_id: crossing for route_id, crossing in all_directions.items() if crossing["result"][0] is not None
+    }
+    # the steps of all routes are decoded in one go
+    steps = [
+        crossing["result"][0]["legs"][0]["steps"][0:crossing["final_ind"] + 1] for crossing in chosen.values()
+    ]
+    grid, offsets = decode_grid(step["polyline"]["points"] for route in steps for step in route)
+    step_offsets = offsets[np.concatenate(([0], np.cumsum([len(route) for route in steps])))]
+
+    store = RouteStore()
+    for (route_id, crossing), start, end in zip(chosen.items(), step_offsets[:-1], step_offsets[1:]):
+        store.add_grid(
+            route_id,
+            grid[start:end],
+            origin_city=origins.get(route_id, route_id),
+            destination_country=crossing["destination_country"],
+            duration_seconds=crossing["final_duration"],
+            distance_meters=crossing["final_distance"],
+        )
+    return store.build()
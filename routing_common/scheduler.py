@@ -0,0 +1,277 @@
+import datetime
+import heapq
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, quota state is then only shared within one process
+    fcntl = None
+
+from routing_common.instrumentation import count_locations
+
+
+class Priority(IntEnum):
+    # Lower values are served first when several calls wait on the same endpoint
+    PRIMARY = 0
+    NORMAL = 1
+    FALLBACK = 2
+
+
+# Defaults follow the Google Maps Platform limits: 50 requests per second for Directions and Geocoding, and
+# 1000 elements per second (60,000 per minute) for Distance Matrix.
+DEFAULT_LIMITS = {
+    "directions": {"qps": 50},
+    "distance_matrix": {"qps": 50, "elements_per_second": 1000},
+    "geocode": {"qps": 50},
+}
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class TokenBucket:
+    '''
+    Token bucket that refills at `rate` tokens per second up to `capacity` tokens.
+    '''
+
+    def __init__(self, rate, capacity=None, tokens=None, updated=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity if tokens is None else tokens
+        self.updated = time.time() if updated is None else updated
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        '''
+        Seconds until `amount` tokens can be taken. Requests larger than the bucket only wait for a full bucket
+        and leave it in debt, so they are not starved.
+        '''
+        self.refill(now)
+        needed = min(amount, self.capacity)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= amount
+
+
+class QuotaScheduler:
+    '''
+    Owns every outbound routing call of a run and keeps them within per-endpoint rate limits and a daily budget.
+
+    `client` is anything with the googlemaps `directions`, `distance_matrix` and `geocode` methods. Calls that
+    wait on the same endpoint are released in priority order. Calls rejected with OVER_QUERY_LIMIT are retried
+    with exponential backoff, and only charged to the daily budget once. When `state_file` is set the buckets and
+    the daily usage are kept in that file (guarded by a file lock), so several runs sharing one API key also share
+    its quota. The file is read and written outside the lock the waiting calls wait on.
+
+    `daily_budget` is either a total number of billable units (requests, or elements for the Distance Matrix)
+    or a dict with a budget per endpoint.
+    '''
+
+    def __init__(
+            self,
+            client,
+            limits=None,
+            daily_budget=None,
+            state_file=None,
+            max_retries=5,
+            backoff_seconds=1.0,
+            max_backoff_seconds=60.0,
+    ):
+        self.client = client
+        self.limits = {endpoint: dict(limit) for endpoint, limit in DEFAULT_LIMITS.items()}
+        for endpoint, limit in (limits or {}).items():
+            self.limits.setdefault(endpoint, {}).update(limit)
+        self.daily_budget = daily_budget
+        self.state_file = state_file
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+        self._condition = threading.Condition()
+        self._waiting = {endpoint: [] for endpoint in self.limits}
+        # endpoints whose first waiting call is taking its tokens, outside the condition lock
+        self._acquiring = set()
+        # guards the quota state, so the condition lock is never held while the state file is read or written
+        self._state_lock = threading.Lock()
+        self._sequence = itertools.count()
+        self._state = {"buckets": {}, "usage": {}}
+
+    def _buckets(self, state, endpoint):
+        limit = self.limits[endpoint]
+        saved = state["buckets"].setdefault(endpoint, {})
+        buckets = []
+        for kind, rate_key in (("requests", "qps"), ("elements", "elements_per_second")):
+            if not limit.get(rate_key):
+                continue
+            rate = limit[rate_key]
+            bucket = TokenBucket(
+                rate,
+                capacity=limit.get(f"{kind}_burst"),
+                tokens=saved.get(kind, {}).get("tokens"),
+                updated=saved.get(kind, {}).get("updated"),
+            )
+            buckets.append((kind, bucket))
+        return buckets
+
+    @staticmethod
+    def _store_buckets(state, endpoint, buckets):
+        state["buckets"][endpoint] = {
+            kind: {"tokens": bucket.tokens, "updated": bucket.updated}
+            for kind, bucket in buckets
+        }
+
+    def _budget_for(self, endpoint):
+        if self.daily_budget is None:
+            return None
+        if isinstance(self.daily_budget, dict):
+            return self.daily_budget.get(endpoint)
+        return self.daily_budget
+
+    def _check_budget(self, state, endpoint, units):
+        today = datetime.date.today().isoformat()
+        if state["usage"].get("date") != today:
+            state["usage"] = {"date": today, "endpoints": {}}
+        used = state["usage"]["endpoints"]
+        budget = self._budget_for(endpoint)
+        if isinstance(self.daily_budget, dict):
+            spent = used.get(endpoint, 0)
+        else:
+            spent = sum(used.values())
+        if budget is not None and spent + units > budget:
+            raise QuotaExceeded(
+                f"Daily budget of {budget} units for {endpoint} would be exceeded ({spent} used, {units} requested)"
+            )
+
+    @staticmethod
+    def _spend(state, endpoint, units):
+        used = state["usage"]["endpoints"]
+        used[endpoint] = used.get(endpoint, 0) + units
+
+    @contextmanager
+    def _locked_state(self):
+        with self._state_lock:
+            if self.state_file is None:
+                yield self._state
+            else:
+                with self._locked_state_file() as state:
+                    yield state
+
+    @contextmanager
+    def _locked_state_file(self):
+        directory = os.path.dirname(self.state_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.state_file, "a+") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                state = json.loads(content) if content else {}
+                state.setdefault("buckets", {})
+                state.setdefault("usage", {})
+                yield state
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _try_acquire(self, endpoint, elements, units):
+        with self._locked_state() as state:
+            self._check_budget(state, endpoint, units)
+            now = time.time()
+            buckets = self._buckets(state, endpoint)
+            wait = max(
+                [bucket.wait_time(1 if kind == "requests" else elements, now) for kind, bucket in buckets] + [0.0]
+            )
+            if wait == 0:
+                for kind, bucket in buckets:
+                    bucket.take(1 if kind == "requests" else elements)
+                self._spend(state, endpoint, units)
+            self._store_buckets(state, endpoint, buckets)
+            return wait
+
+    def acquire(self, endpoint, elements=1, priority=Priority.NORMAL, retry=False):
+        '''
+        Blocks until a call to `endpoint` with `elements` elements may be sent. A `retry` of a call that was
+        rejected takes rate limit tokens again but is not charged to the daily budget a second time.
+        '''
+        units = 0 if retry else elements if endpoint == "distance_matrix" else 1
+        ticket = (int(priority), next(self._sequence))
+        with self._condition:
+            # every thread waiting on an endpoint must share its queue, so it is only set up under the lock
+            self.limits.setdefault(endpoint, {})
+            waiting = self._waiting.setdefault(endpoint, [])
+            heapq.heappush(waiting, ticket)
+        try:
+            while True:
+                with self._condition:
+                    while waiting[0] != ticket or endpoint in self._acquiring:
+                        self._condition.wait()
+                    self._acquiring.add(endpoint)
+                try:
+                    wait = self._try_acquire(endpoint, elements, units)
+                finally:
+                    with self._condition:
+                        self._acquiring.discard(endpoint)
+                        self._condition.notify_all()
+                if wait == 0:
+                    return
+                with self._condition:
+                    # Other processes may take tokens meanwhile, so never sleep longer than a short poll interval
+                    self._condition.wait(min(wait, 0.25) if self.state_file else wait)
+        finally:
+            with self._condition:
+                waiting.remove(ticket)
+                heapq.heapify(waiting)
+                self._condition.notify_all()
+
+    def call(self, endpoint, fn, *args, elements=1, priority=Priority.NORMAL, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire(endpoint, elements=elements, priority=priority, retry=attempt > 0)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if getattr(e, "status", None) != "OVER_QUERY_LIMIT" or attempt >= self.max_retries:
+                    raise
+            delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** attempt)
+            delay = delay * (0.5 + random.random() / 2)
+            print(f"{endpoint} over query limit, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def geocode(self, *args, priority=Priority.NORMAL, **kwargs):
+        return self.call("geocode", self.client.geocode, *args, priority=priority, **kwargs)
+
+    def directions(self, origin, destination, *args, priority=Priority.PRIMARY, **kwargs):
+        return self.call(
+            "directions", self.client.directions, origin, destination, *args, priority=priority, **kwargs
+        )
+
+    def distance_matrix(self, origins, destinations, *args, priority=Priority.NORMAL, **kwargs):
+        elements = count_locations(origins) * count_locations(destinations)
+        return self.call(
+            "distance_matrix", self.client.distance_matrix, origins, destinations, *args,
+            elements=elements, priority=priority, **kwargs
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
@@ -0,0 +1,578 @@
+import argparse
+import asyncio
+import functools
+import hashlib
+import json
+import os
+import sys
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from aiohttp import web
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENSEMBLE_DIR = os.path.join(ROOT_DIR, "Ensemble_Attraction_Routing")
+sys.path.append(ROOT_DIR)
+sys.path.append(ENSEMBLE_DIR)
+
+from routing_common.clients import ROUTING_BACKENDS, build_client
+from routing_common.columnar import OUTPUT_FORMATS
+from routing_common.filters import compile_filters
+from routing_common.gazetteer import GAZETTEER_FILE, load_gazetteer
+from routing_common.geonames import DATA_DIR
+from routing_common.instrumentation import Tracer, TracedClient
+from routing_common.polyline_codec import decode_many, lines
+
+
+FIND_ROUTES_PARAMS = {
+    "start_location",
+    "disaster_radius_km",
+    "flight_radius_km",
+    "travel_mode",
+    "extra_filters",
+    "destination_file",
+    "location_id_col",
+    "latitude_col",
+    "longitude_col",
+    "render_map",
+    "output_format",
+    "feature_classes",
+    "min_population",
+    "max_concurrency",
+    "max_travel_hours",
+}
+
+# Config keys that belong to the service (credentials, quota, tracing) rather than to a single ensemble run
+SERVICE_CONFIG_KEYS = {
+    "GOOGLEMAPS_KEY",
+    "routing_backend",
+    "api_limits",
+    "daily_budget",
+    "quota_state_file",
+    "trace_file",
+    "chrome_trace_file",
+    "speedscope_file",
+    "stage_cache_dir",
+    "use_stage_cache",
+}
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+json_response = functools.partial(web.json_response, dumps=functools.partial(json.dumps, default=_json_default))
+
+
+def resolve_destination_file(name, data_dir=DATA_DIR):
+    '''
+    The path of the destination file a request names. Requests can only name a file in `data_dir`, not give a
+    path, so they cannot make the service read any other file. Raises ValueError for anything else.
+    '''
+    if not isinstance(name, str) or name in ("", ".", "..") or os.path.basename(name) != name:
+        raise ValueError("destination_file must be the name of a file in the data folder")
+    path = os.path.realpath(os.path.join(data_dir, name))
+    if os.path.dirname(path) != os.path.realpath(data_dir) or not os.path.isfile(path):
+        raise ValueError(f"There is no destination file {name} in the data folder")
+    return path
+
+
+def _check_number(params, name, minimum=None, maximum=None, integer=False, required=False):
+    if params.get(name) is None:
+        if required:
+            raise ValueError(f"{name} is required")
+        return
+    value = params[name]
+    kinds = (int,) if integer else (int, float)
+    if isinstance(value, bool) or not isinstance(value, kinds):
+        raise ValueError(f"{name} must be {'an integer' if integer else 'a number'}")
+    if minimum is not None and value < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    if maximum is not None and value > maximum:
+        raise ValueError(f"{name} must be at most {maximum}")
+
+
+def _check_type(params, name, kinds, description):
+    if params.get(name) is not None and not isinstance(params[name], kinds):
+        raise ValueError(f"{name} must be {description}")
+
+
+def validate_find_routes_params(params):
+    '''
+    Checks the find_routes parameters of a request and returns them with destination_file resolved. Raises
+    ValueError for parameters a run would fail on, which is answered with a 400; any error of the run itself is
+    answered with a 500.
+    '''
+    from simple_refugee_route_model.evacuation import TravelModes
+
+    unknown = set(params) - FIND_ROUTES_PARAMS
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+    if not isinstance(params.get("start_location"), str) or not params["start_location"].strip():
+        raise ValueError("start_location is required")
+    _check_number(params, "disaster_radius_km", minimum=0, required=True)
+    _check_number(params, "flight_radius_km", minimum=0, required=True)
+    if params["flight_radius_km"] <= params["disaster_radius_km"]:
+        raise ValueError("flight_radius_km must be larger than disaster_radius_km")
+    travel_modes = [mode.value for mode in TravelModes]
+    if params.get("travel_mode", TravelModes.Driving.value) not in travel_modes:
+        raise ValueError(f"travel_mode must be one of {', '.join(travel_modes)}")
+    _check_type(params, "extra_filters", list, "a list of filters")
+    try:
+        compile_filters(params.get("extra_filters") or [])
+    except KeyError as e:
+        raise ValueError(f"Invalid extra_filters: a filter is missing {e}")
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid extra_filters: {e}")
+    for name in ("location_id_col", "latitude_col", "longitude_col"):
+        _check_type(params, name, str, "a column name")
+    _check_type(params, "render_map", bool, "true or false")
+    if params.get("output_format", "csv") not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {', '.join(OUTPUT_FORMATS)}")
+    _check_type(params, "feature_classes", (str, list), "a feature class or a list of them")
+    _check_number(params, "min_population", minimum=0)
+    _check_number(params, "max_concurrency", minimum=1, integer=True)
+    _check_number(params, "max_travel_hours", minimum=0)
+    if "destination_file" in params:
+        params = dict(params, destination_file=resolve_destination_file(params["destination_file"]))
+    return params
+
+
+def validate_ensemble_config(config):
+    '''
+    Checks the Ensemble Attraction Routing config of a request the same way (see validate_find_routes_params).
+    '''
+    from ensemble import MAX_SPEEDS_KMH, get_flight_modes
+
+    if not isinstance(config.get("conflict_country"), str) or not config["conflict_country"].strip():
+        raise ValueError("conflict_country is required")
+    _check_type(config, "flight_mode", (str, list), "a travel mode or a list of them")
+    for flight_mode in get_flight_modes(config):
+        if flight_mode not in MAX_SPEEDS_KMH:
+            raise ValueError(f"flight_mode must be one or more of {', '.join(MAX_SPEEDS_KMH)}")
+    for name in ("excluded_countries", "added_countries"):
+        _check_type(config, name, (str, list), "a comma separated string or a list of countries")
+    _check_number(config, "conflict_start", integer=True)
+    _check_number(config, "number_conflict_cities", minimum=1, integer=True)
+    _check_number(config, "number_haven_cities", minimum=1, integer=True)
+    _check_number(config, "percent_of_pop_leaving", minimum=0, maximum=1)
+    _check_number(config, "attraction_weight", minimum=0, maximum=1)
+    _check_number(config, "haven_hops", minimum=1, integer=True)
+    for name in ("crossing_capacity", "simulation"):
+        _check_type(config, name, dict, "an object")
+    _check_type(config, "render_map", bool, "true or false")
+    if config.get("output_format", "csv") not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {', '.join(OUTPUT_FORMATS)}")
+    return config
+
+
+def request_key(kind, params):
+    return hashlib.sha256(json.dumps([kind, params], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _line(points):
+    # GeoJSON coordinates are (longitude, latitude)
+    return np.asarray(points).reshape(-1, 2)[:, ::-1].tolist()
+
+
+def find_routes_geojson(result):
+    start_lat, start_lng = result["start_position"]
+    features = [{
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [start_lng, start_lat]},
+        "properties": {
+            "kind": "start",
+            "name": result["start_location"],
+            "disaster_radius_km": result["disaster_radius_km"],
+        },
+    }]
+    route_points, route_offsets = decode_many(
+        destination["route"][0]["overview_polyline"]["points"] if destination.get("route") else ""
+        for destination in result["destinations"]
+    )
+    for rank, (destination, points) in enumerate(
+            zip(result["destinations"], lines(route_points, route_offsets)), start=1
+    ):
+        properties = {
+            "kind": "destination",
+            "rank": rank,
+            "name": destination["name"],
+            "address": destination.get("address"),
+            "duration_hrs": round(destination["duration"]["value"] / 3600, 3),
+            "distance_km": round(destination["distance"]["value"] / 1000, 3),
+            "travel_mode": result["travel_mode"],
+        }
+        lat, lng = destination["location"]
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [lng, lat]},
+            "properties": properties,
+        })
+        if destination.get("route"):
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "LineString", "coordinates": _line(points)},
+                "properties": dict(properties, kind="route"),
+            })
+    return {"type": "FeatureCollection", "features": features}
+
+
+def ensemble_geojson(result):
+    features = []
+    for _, origin in result["refugees_by_mode"].iterrows():
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [origin["longitude"], origin["latitude"]]},
+            "properties": {
+                "kind": "crossing",
+                "origin city": origin["origin city"],
+                "travel mode": origin["travel mode"],
+                "destination country": origin["destination country"],
+                "total refugees": origin["total refugees"],
+            },
+        })
+    for flight_mode, mode_result in result["modes"].items():
+        route_store = mode_result["route_store"]
+        for route_id, route in route_store.properties.items():
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "LineString", "coordinates": _line(route_store.route_coordinates(route_id))},
+                "properties": {
+                    "kind": "route",
+                    "origin city": route["origin_city"],
+                    "travel mode": flight_mode,
+                    "destination country": route["destination_country"],
+                    "duration_seconds": route["duration_seconds"],
+                    "distance_meters": route["distance_meters"],
+                },
+            })
+        for segment_id, segment in route_store.segments.items():
+            features.append({
+                "type": "Feature",
+                "id": segment_id,
+                "geometry": {"type": "LineString", "coordinates": _line(segment["coordinates"])},
+                "properties": {
+                    "kind": "segment",
+                    "travel mode": flight_mode,
+                    "routes": segment["routes"],
+                    "total refugees": mode_result["segment_flows"][segment_id],
+                    "length_meters": round(segment["length_meters"], 1),
+                },
+            })
+    return {"type": "FeatureCollection", "features": features}
+
+
+class RouteService:
+    '''
+    Keeps the models, their reference data and one routing client resident, and runs requests on a thread pool.
+
+    Identical requests that arrive while one is still running share its result instead of running again. All
+    requests share one routing client, so they also share its rate limits and daily budget.
+    '''
+
+    def __init__(
+            self,
+            routing_backend="google",
+            output_root="service_runs",
+            max_workers=4,
+            api_limits=None,
+            daily_budget=None,
+            quota_state_file=None,
+            places_file=None,
+    ):
+        self.routing_backend = routing_backend
+        self.output_root = output_root
+        self.client = build_client(
+            routing_backend,
+            api_limits=api_limits,
+            daily_budget=daily_budget,
+            quota_state_file=quota_state_file,
+            places_file=places_file,
+        )
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.inflight = {}
+        self.stats = {"requests": 0, "coalesced": 0, "errors": 0}
+        self.started = time.time()
+
+    def preload(self):
+        '''
+        Imports the models and loads their reference data so the first request does not pay for it.
+        '''
+        from simple_refugee_route_model import evacuation
+        import ensemble
+
+        if os.path.exists(evacuation.CITY_FILE):
+            evacuation.load_city_store(evacuation.CITY_FILE, "latitude", "longitude")
+        if os.path.exists(GAZETTEER_FILE):
+            load_gazetteer(GAZETTEER_FILE)
+        try:
+            ensemble.load_reference_data()
+        except FileNotFoundError as e:
+            print(f"Ensemble reference data not preloaded: {e}")
+
+    def run_find_routes(self, params, key):
+        from simple_refugee_route_model.evacuation import find_routes
+
+        tracer = Tracer("find_routes")
+        run_dir = os.path.join(self.output_root, "routes", key[:16])
+        result = find_routes(
+            **params,
+            gmaps=TracedClient(self.client, tracer),
+            tracer=tracer,
+            output_dir=os.path.join(run_dir, "output"),
+            media_dir=os.path.join(run_dir, "media"),
+        )
+        return {"routes": find_routes_geojson(result), "trace": tracer.summary()}
+
+    def run_ensemble(self, config, key):
+        from ensemble import run_ensemble
+
+        tracer = Tracer("ensemble")
+        result = run_ensemble(
+            dict(
+                config,
+                routing_backend=self.routing_backend,
+                stage_cache_dir=os.path.join(self.output_root, "stage_cache"),
+            ),
+            gmaps=TracedClient(self.client, tracer),
+            tracer=tracer,
+            output_dir=os.path.join(self.output_root, "ensemble", key[:16]),
+        )
+        return {
+            "border_countries": result["border_countries"].to_dict(orient="records"),
+            "refugees": result["refugees_by_mode"].to_dict(orient="records"),
+            "refugees_by_country": {
+                flight_mode: mode_result["refugees_by_country"].to_dict(orient="records")
+                for flight_mode, mode_result in result["modes"].items()
+            },
+            "refugee_breakdowns": {
+                flight_mode: {
+                    name: table.to_dict(orient="records")
+                    for name, table in mode_result["refugee_breakdowns"].items()
+                }
+                for flight_mode, mode_result in result["modes"].items()
+            },
+            "daily_arrivals_by_country": {
+                flight_mode: mode_result["daily_arrivals"][1].to_dict(orient="records")
+                for flight_mode, mode_result in result["modes"].items()
+                if mode_result["daily_arrivals"] is not None
+            },
+            "routes": ensemble_geojson(result),
+            "trace": tracer.summary(),
+        }
+
+    def stream_find_routes(self, params, emit):
+        from simple_refugee_route_model.evacuation import iter_routes
+
+        tracer = Tracer("find_routes")
+        # streams are not coalesced, so each gets its own folder instead of the one of a /routes run
+        run_dir = os.path.join(
+            self.output_root, "routes", f"{request_key('routes', params)[:16]}-stream-{uuid.uuid4().hex[:12]}"
+        )
+        events = iter_routes(
+            **params,
+            gmaps=TracedClient(self.client, tracer),
+            tracer=tracer,
+            output_dir=os.path.join(run_dir, "output"),
+            media_dir=os.path.join(run_dir, "media"),
+        )
+        while True:
+            try:
+                emit(next(events))
+            except StopIteration as stop:
+                emit({"type": "result", "routes": find_routes_geojson(stop.value), "trace": tracer.summary()})
+                return
+
+    async def coalesce(self, kind, params, fn):
+        key = request_key(kind, params)
+        self.stats["requests"] += 1
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, fn, params, key)
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        else:
+            self.stats["coalesced"] += 1
+        # shield so a client that disconnects does not cancel the run for the others waiting on it
+        return await asyncio.shield(future)
+
+    async def _respond(self, kind, params, fn):
+        # the parameters were checked before, so any error here is one of the run
+        try:
+            return json_response(await self.coalesce(kind, params, fn))
+        except Exception as e:
+            self.stats["errors"] += 1
+            traceback.print_exc()
+            return json_response({"error": str(e)}, status=500)
+
+    async def _read_body(self, request):
+        '''
+        The JSON object of a request body, or None when the body is not valid JSON or not an object.
+        '''
+        try:
+            body = await request.json()
+        except ValueError:
+            return None
+        return body if isinstance(body, dict) else None
+
+    async def handle_routes(self, request):
+        params = await self._read_body(request)
+        if params is None:
+            return json_response({"error": "The request body must be a JSON object"}, status=400)
+        try:
+            params = validate_find_routes_params(params)
+        except ValueError as e:
+            return json_response({"error": str(e)}, status=400)
+        return await self._respond("routes", params, self.run_find_routes)
+
+    async def handle_routes_stream(self, request):
+        '''
+        Like /routes, but answers with newline delimited JSON: the events of iter_routes as they happen and the
+        GeoJSON result last. Streams are not coalesced, every request runs.
+        '''
+        params = await self._read_body(request)
+        if params is None:
+            return json_response({"error": "The request body must be a JSON object"}, status=400)
+        try:
+            params = validate_find_routes_params(params)
+        except ValueError as e:
+            return json_response({"error": str(e)}, status=400)
+        self.stats["requests"] += 1
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def emit(event):
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+        def run():
+            try:
+                self.stream_find_routes(params, emit)
+            except Exception as e:
+                self.stats["errors"] += 1
+                traceback.print_exc()
+                emit({"type": "error", "error": str(e)})
+            finally:
+                emit(None)
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        done = loop.run_in_executor(self.executor, run)
+        while True:
+            event = await queue.get()
+            if event is None:
+                break
+            await response.write((json.dumps(event, default=_json_default) + "\n").encode())
+        await done
+        await response.write_eof()
+        return response
+
+    async def handle_ensemble(self, request):
+        body = await self._read_body(request)
+        if body is None:
+            return json_response({"error": "The request body must be a JSON object"}, status=400)
+        config = {key: value for key, value in body.items() if key not in SERVICE_CONFIG_KEYS}
+        try:
+            config = validate_ensemble_config(config)
+        except ValueError as e:
+            return json_response({"error": str(e)}, status=400)
+        return await self._respond("ensemble", config, self.run_ensemble)
+
+    async def handle_health(self, request):
+        return json_response({
+            "status": "ok",
+            "routing_backend": self.routing_backend,
+            "uptime_seconds": round(time.time() - self.started, 3),
+            "inflight": len(self.inflight),
+            **self.stats,
+        })
+
+    async def _on_startup(self, app):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.preload)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/health", self.handle_health)
+        app.router.add_post("/routes", self.handle_routes)
+        app.router.add_post("/routes/stream", self.handle_routes_stream)
+        app.router.add_post("/ensemble", self.handle_ensemble)
+        app.on_startup.append(self._on_startup)
+        return app
+
+
+if __name__ == "__main__":
+    description = """
+    Long running HTTP service for the refugee route models.
+
+    POST /routes takes the find_routes parameters as JSON and returns the routes as GeoJSON.
+    POST /routes/stream takes the same parameters and streams candidates and routes as newline delimited JSON.
+    POST /ensemble takes an Ensemble Attraction Routing config as JSON and returns its result tables and routes.
+    The Google Maps key is read from the GOOGLEMAPS_KEY environment variable.
+    """
+
+    arg_parser = argparse.ArgumentParser(
+        description=description, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument("--host", type=str, default="0.0.0.0")
+    arg_parser.add_argument("--port", type=int, default=8080)
+    arg_parser.add_argument(
+        "--routing-backend",
+        help="Routing service to use. \"local\" is an offline stand-in that needs no API key",
+        choices=ROUTING_BACKENDS,
+        default="google",
+    )
+    arg_parser.add_argument(
+        "--places-file",
+        help="GeoNames file the local routing backend resolves place names with",
+        type=str,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--output-root",
+        help="Folder the outputs of each request are written under",
+        type=str,
+        default="service_runs",
+    )
+    arg_parser.add_argument(
+        "--workers",
+        help="Number of model runs executed at the same time",
+        type=int,
+        default=4,
+    )
+    arg_parser.add_argument(
+        "--api-limits",
+        help='JSON object of per-endpoint rate limits, e.g. {"directions": {"qps": 10}}',
+        type=str,
+        default="{}",
+    )
+    arg_parser.add_argument(
+        "--daily-budget",
+        help="Maximum billable Google Maps units (requests, or elements for the distance matrix) per day",
+        type=int,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--quota-state-file",
+        help="File used to share rate limits and daily usage with other processes on the same API key",
+        type=str,
+        default=None,
+    )
+    args = arg_parser.parse_args()
+
+    service = RouteService(
+        routing_backend=args.routing_backend,
+        output_root=args.output_root,
+        max_workers=args.workers,
+        api_limits=json.loads(args.api_limits),
+        daily_budget=args.daily_budget,
+        quota_state_file=args.quota_state_file,
+        places_file=args.places_file,
+    )
+    web.run_app(service.app(), host=args.host, port=args.port)
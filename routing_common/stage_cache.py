@@ -0,0 +1,118 @@
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import tempfile
+
+
+def _source_hash(fn):
+    try:
+        source = inspect.getsource(fn)
+    except (OSError, TypeError):
+        source = getattr(fn, "__qualname__", repr(fn))
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def file_fingerprint(*paths):
+    '''
+    Cheap fingerprint of input files (path, size and modification time), for use in a stage's inputs.
+    '''
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            fingerprint.append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            fingerprint.append([os.path.abspath(path), None, None])
+    return fingerprint
+
+
+class StageCache:
+    '''
+    On-disk cache of pipeline stage artifacts.
+
+    A stage's key is a hash of its name, the source code of the functions that compute it, its slice of the
+    config and the keys of the stages it depends on, so a stage only runs again when something it depends on
+    changed. Artifacts are pickled to `cache_dir/<stage>/<key>.pickle`; writes are atomic so concurrent runs
+    can share one cache directory. With `enabled=False` every stage runs and nothing is stored.
+
+    A stage whose result is incomplete (see `run`) is not stored, and neither is any stage that depends on it, so
+    the next run computes them again instead of replaying the incomplete result.
+    '''
+
+    def __init__(self, cache_dir, enabled=True, tracer=None):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.tracer = tracer
+        self._code_versions = {}
+        self._incomplete = set()
+
+    def code_version(self, code):
+        versions = []
+        for fn in code:
+            # functions defined inside a function (lambdas, closures) are new objects on every call but share
+            # their code object
+            code_id = getattr(fn, "__code__", fn)
+            if code_id not in self._code_versions:
+                self._code_versions[code_id] = _source_hash(fn)
+            versions.append(self._code_versions[code_id])
+        return versions
+
+    def key(self, name, code, inputs=None, upstream=()):
+        payload = json.dumps(
+            [name, self.code_version(code), inputs, list(upstream)], sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, name, key):
+        return os.path.join(self.cache_dir, name.replace("/", "_").replace(":", "_"), f"{key}.pickle")
+
+    def load(self, name, key):
+        path = self._path(name, key)
+        try:
+            with open(path, "rb") as f:
+                return True, pickle.load(f)
+        except FileNotFoundError:
+            return False, None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            print(f"Ignoring unreadable cache entry {path}: {e}")
+            return False, None
+
+    def store(self, name, key, artifact):
+        path = self._path(name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def run(self, name, fn, *args, code=(), inputs=None, upstream=(), complete=None, **kwargs):
+        '''
+        Returns `(key, artifact)` for a stage, loading the artifact from the cache or computing it with
+        `fn(*args, **kwargs)`. `code` lists the functions whose source makes up the stage, in addition to `fn`.
+        `complete`, when given, is called after `fn`; when it returns False (e.g. because calls failed) the
+        artifact is used but not stored.
+        '''
+        key = self.key(name, (fn,) + tuple(code), inputs, upstream)
+        if self.enabled:
+            found, artifact = self.load(name, key)
+            if found:
+                if self.tracer is not None:
+                    self.tracer.cache_hit(f"stage:{name}")
+                return key, artifact
+            if self.tracer is not None:
+                self.tracer.cache_miss(f"stage:{name}")
+        artifact = fn(*args, **kwargs)
+        if (complete is not None and not complete()) or self._incomplete.intersection(upstream):
+            self._incomplete.add(key)
+            if self.enabled:
+                print(f"Not caching stage {name}, its result or a stage it depends on is incomplete")
+        elif self.enabled:
+            self.store(name, key, artifact)
+        return key, artifact
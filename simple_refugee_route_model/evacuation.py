@@ -1,18 +1,29 @@
 import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+import contextlib
 import csv
 import datetime
 from enum import Enum
-import itertools
+import functools
 import json
 import os
+import sys
 
-import geopandas as gpd
+import numpy as np
 import pandas as pd
-from shapely.geometry import Point
-import googlemaps
 from haversine import inverse_haversine, Direction
-import pyproj
-import polyline
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from routing_common.clients import ROUTING_BACKENDS, build_client
+from routing_common.columnar import OUTPUT_FORMATS, TableWriter, wkb_linestring, wkb_point
+from routing_common.filters import CityStore, compile_filters
+from routing_common.gazetteer import GAZETTEER_FILE, load_gazetteer
+from routing_common.geonames import read_geonames_file
+from routing_common.instrumentation import TracedClient, Tracer
+from routing_common.isochrones import ISOCHRONE_CACHE_DIR, load_travel_field
+from routing_common.jobs import DEFAULT_QUEUE_FILE, JobQueue, QueueClient
+from routing_common.polyline_codec import decode_many, lines
+from routing_common.refresh import read_city_table
 
 
 def safe(text):
@@ -34,37 +45,103 @@ class TravelModes(Enum):
         return lookup.get(travel_mode, "")
 
 
-CITY_FILE = "../data/cities5000.txt"
-
-
-def read_geonames_file(file_path):
-    city_df = pd.read_csv(
-        file_path,
-        sep="\t",
-        header=0,
-        names=[
-            "geonameid",
-            "name",
-            "name_ascii",
-            "alternatenames",
-            "latitude",
-            "longitude",
-            "feature class",
-            "feature code",
-            "country code",
-            "cc2",
-            "admin1 code",
-            "admin2 code",
-            "admin3 code",
-            "admin4 code",
-            "population",
-            "elevation",
-            "dem",
-            "timezone",
-            "modification date",
-        ]
-    )
-    return city_df
+CITY_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "cities5000.txt")
+
+# Top average speed of a trip in each travel mode, in km/h. No destination is reached faster than its straight
+# line distance at this speed, which tells early which destinations are certain to be among the fastest.
+MAX_SPEEDS_KMH = {"driving": 150, "walking": 7, "bicycling": 45, "transit": 350}
+
+# Duration (in seconds) and distance (in meters) of a destination the Distance Matrix has no route to
+UNREACHABLE = 999999
+
+# GeoNames files larger than this (e.g. allCountries.txt) are not kept in memory; each request streams the file
+# and only reads the places inside its search area.
+STREAM_THRESHOLD = 256 * 1024 * 1024
+
+
+def is_geonames_file(destination_file):
+    name = os.path.basename(destination_file)
+    return (name.startswith("cities") or name == "allCountries.txt") and name.endswith(".txt")
+
+
+@functools.lru_cache(maxsize=8)
+def load_destinations(destination_file):
+    '''
+    Reads a destination table. Tables are kept in memory so a long running service only reads each file once;
+    callers must not modify the returned DataFrame.
+    '''
+    if is_geonames_file(destination_file):
+        return read_city_table(destination_file).rename(columns={"asciiname": "name_ascii"}), "name_ascii"
+    return pd.read_csv(destination_file), None
+
+
+@functools.lru_cache(maxsize=8)
+def load_city_store(destination_file, latitude_col, longitude_col):
+    '''
+    The destination table indexed by latitude for filtering. Kept in memory like `load_destinations`.
+    '''
+    return CityStore(load_destinations(destination_file)[0], latitude_col, longitude_col)
+
+
+def _plain(value):
+    # numpy scalars from the destination table
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def destination_summary(destination):
+    '''
+    The JSON-serializable fields of a destination: its name, address, location, travel time and distance and,
+    once its directions are in, the route's own time, distance and encoded line.
+    '''
+    summary = {
+        "name": _plain(destination["name"]),
+        "address": destination.get("address"),
+        "location": [float(value) for value in destination["location"]],
+        "duration_seconds": destination["duration"]["value"],
+        "distance_meters": destination["distance"]["value"],
+    }
+    if destination.get("route"):
+        route = destination["route"][0]
+        summary["route"] = {
+            "duration_seconds": route["legs"][0]["duration"]["value"],
+            "distance_meters": route["legs"][0]["distance"]["value"],
+            "polyline": route["overview_polyline"]["points"],
+        }
+    elif "route" in destination:
+        summary["route"] = None
+    return summary
+
+
+def duration_lower_bounds(distances_km, travel_mode):
+    '''
+    The least trip duration, in seconds, to destinations `distances_km` away in a straight line: no trip is faster
+    than that distance at the top speed of the travel mode. A destination without a route gets UNREACHABLE as its
+    duration, which can be below that, so no bound is above it.
+    '''
+    if travel_mode not in MAX_SPEEDS_KMH:
+        return [0] * len(distances_km)
+    return [min(distance / MAX_SPEEDS_KMH[travel_mode] * 3600, UNREACHABLE) for distance in distances_km]
+
+
+def certain_top(durations, lower_bounds, top=20):
+    '''
+    Returns the indexes of the destinations certain to be among the `top` fastest, whatever the durations that are
+    not known yet turn out to be.
+
+    `durations` has the trip duration of every destination, or None when it is not known yet, and `lower_bounds`
+    the least each duration can be. Equal durations are ranked by position, like a stable sort.
+    '''
+    known = np.array([np.nan if duration is None else duration for duration in durations], dtype=float)
+    unknown_bounds = np.sort(np.asarray(lower_bounds, dtype=float)[np.isnan(known)])
+    certain = []
+    for index in np.flatnonzero(~np.isnan(known)):
+        duration = known[index]
+        ahead = np.count_nonzero(known < duration) + np.count_nonzero(known[:index] == duration)
+        # a destination whose duration is not known yet can only be ahead if its lower bound allows it
+        ahead += np.searchsorted(unknown_bounds, duration, side="right")
+        if ahead < top:
+            certain.append(int(index))
+    return certain
 
 
 def get_directions(start, end):
@@ -72,6 +149,8 @@ def get_directions(start, end):
     This function takes in a start and end location from `mlocations.csv`
     and obtains the Google Directions for them.
     '''
+    import googlemaps
+
     directions_result = googlemaps.directions(
         (start.latitude, start.longitude),
         (end.latitude, end.longitude),
@@ -79,7 +158,7 @@ def get_directions(start, end):
     return directions_result
 
 
-def find_routes(
+def iter_routes(
         start_location,
         disaster_radius_km,
         flight_radius_km,
@@ -89,211 +168,478 @@ def find_routes(
         location_id_col="location_id",
         latitude_col="latitude",
         longitude_col="longitude",
+        gmaps=None,
+        routing_backend="google",
+        output_dir="output",
+        media_dir="media",
+        tracer=None,
+        trace_file=None,
+        chrome_trace_file=None,
+        speedscope_file=None,
+        api_limits=None,
+        daily_budget=None,
+        quota_state_file=None,
+        render_map=True,
+        output_format="csv",
+        feature_classes=None,
+        min_population=None,
+        parse_workers=1,
+        max_concurrency=8,
+        job_queue=None,
+        job_run=None,
+        job_timeout=None,
+        gazetteer_file=GAZETTEER_FILE,
+        max_travel_hours=None,
+        isochrone_cache_dir=ISOCHRONE_CACHE_DIR,
 ):
+    '''
+    Finds the fastest routes out of the disaster area around `start_location` to destinations between
+    `disaster_radius_km` and `flight_radius_km` away, yielding results as they come in.
 
-    if destination_file is None:
-        destination_file = CITY_FILE
-
-    googlemaps_key = os.environ.get("GOOGLEMAPS_KEY")
-    gmaps = googlemaps.Client(key=googlemaps_key)
+    Yields a "candidates" event after each Distance Matrix chunk with the destinations of that chunk and the
+    current top 20, then a "route" event as the directions of each of the top 20 arrive, and finally a
+    "ranking" event. Events are plain JSON-serializable dicts.
 
-    place = gmaps.geocode(address=start_location)
-    std_start_location = place[0]["geometry"]["location"]
-    start_position = (std_start_location["lat"], std_start_location["lng"])
+    Writes the route data, raw API responses and map to `output_dir` and `media_dir`. The generator's return
+    value, which `find_routes` returns, is the start position with the ranked destinations and their directions. `gmaps` can be any routing client with the
+    googlemaps interface; by default one is built for `routing_backend`. The map is skipped when `render_map` is
+    false. With `output_format` "parquet" the candidate destinations and the routes are also written as
+    GeoParquet tables, row group by row group as the responses come in.
 
-    AEQD_STR = pyproj.Proj(f"+proj=aeqd +units=km +lat_0={std_start_location['lat']} +lon_0={std_start_location['lng']}")
-    EPSG_STR = "EPSG:4326"
+    `extra_filters` is a list of filters on the destination columns (and "distance", in km); see
+    routing_common.filters. They are combined with the search area into one mask, so only literal comparisons are
+    allowed and nothing from the config is evaluated as code.
 
-    bounds = {
-        "north": inverse_haversine(start_position, flight_radius_km * 2, Direction.NORTH)[0],
-        "east": inverse_haversine(start_position, flight_radius_km * 2, Direction.EAST)[1],
-        "south": inverse_haversine(start_position, flight_radius_km * 2, Direction.SOUTH)[0],
-        "west": inverse_haversine(start_position, flight_radius_km * 2, Direction.WEST)[1],
-    }
+    GeoNames destinations can be limited to `feature_classes` (e.g. "P" for populated places) and places of at
+    least `min_population`. GeoNames files over STREAM_THRESHOLD are streamed, on `parse_workers` processes, and
+    only the places inside the search area that pass these filters are read.
 
-    if destination_file.startswith("cities") and destination_file.endswith(".txt"):
-        destination_df = read_geonames_file(CITY_FILE)
-        location_id_col = "name_ascii"
-    else:
-        destination_df = pd.read_csv(destination_file)
+    The Distance Matrix chunks are requested concurrently, and the directions to a destination are requested as soon
+    as it is certain to be in the top 20, before the other chunks arrive. At most `max_concurrency` calls run at a
+    time, over one pool of keep-alive connections. Results and events are the same as with sequential calls.
 
-    required_column_set = {location_id_col, latitude_col, longitude_col}
+    With `job_queue`, the path of a routing_common.jobs queue file, the calls are queued as jobs for the workers of
+    that queue instead (under `job_run`, which resumes a run when it is given again), and no API key is needed.
 
-    if set(destination_df.columns).intersection(required_column_set) != required_column_set:
-        raise ValueError(
-            f"Datafile {destination_file} does not include the all required columns: {' '.join(required_column_set)}"
-        )
+    `start_location` is looked up in the GeoNames `gazetteer_file` first and only geocoded by the routing service
+    when it is not found there (or `gazetteer_file` is None). Every routing call then uses coordinates.
 
-    proj_df = gpd.GeoDataFrame(
-        destination_df,
-        geometry=gpd.points_from_xy(destination_df[latitude_col], destination_df[longitude_col]),
-        crs=pyproj.CRS(EPSG_STR),
-    )
+    With `max_travel_hours` only the destinations inside the isochrone of that many hours are candidates, nearest
+    by estimated travel time first instead of by distance. The estimates come from travel times sampled once
+    around the start (routing_common.isochrones) and kept under `isochrone_cache_dir` for the next runs from
+    the same area.
+    '''
+    if tracer is None:
+        tracer = Tracer("find_routes")
+    if trace_file is None:
+        trace_file = os.path.join(output_dir, "trace.json")
+    try:
+        if destination_file is None:
+            destination_file = CITY_FILE
+
+        if gmaps is None and job_queue is not None:
+            gmaps = TracedClient(QueueClient(JobQueue(job_queue), run=job_run, timeout=job_timeout), tracer)
+        if gmaps is None:
+            gmaps = build_client(
+                routing_backend,
+                tracer=tracer,
+                api_limits=api_limits,
+                daily_budget=daily_budget,
+                quota_state_file=quota_state_file,
+                http_pool_size=max_concurrency,
+            )
 
-    # Quick and dirty filter to filter out most of the cities that are outside the bounds of the area to reduce computation
-    proj_df = proj_df.query(
-        f"not ("
-            f"{latitude_col} > {bounds['north']} or {longitude_col} > {bounds['east']} "
-            f"or {latitude_col} < {bounds['south']} or {longitude_col} < {bounds['west']}"
-        f")"
-    )
+        with tracer.stage("geocode"):
+            # places in the gazetteer are located offline, anything else is geocoded by the routing service
+            place = []
+            if gazetteer_file is not None and os.path.exists(gazetteer_file):
+                place = load_gazetteer(gazetteer_file).geocode(start_location)
+            if not place:
+                place = gmaps.geocode(address=start_location)
+        std_start_location = place[0]["geometry"]["location"]
+        start_position = (std_start_location["lat"], std_start_location["lng"])
+
+        # shapely and pyproj are only needed to filter the destinations, so they are imported here
+        import pyproj
+        from shapely.geometry import Point
+
+        AEQD_STR = pyproj.Proj(f"+proj=aeqd +units=km +lat_0={std_start_location['lat']} +lon_0={std_start_location['lng']}")
+        EPSG_STR = "EPSG:4326"
+
+        bounds = {
+            "north": inverse_haversine(start_position, flight_radius_km * 2, Direction.NORTH)[0],
+            "east": inverse_haversine(start_position, flight_radius_km * 2, Direction.EAST)[1],
+            "south": inverse_haversine(start_position, flight_radius_km * 2, Direction.SOUTH)[0],
+            "west": inverse_haversine(start_position, flight_radius_km * 2, Direction.WEST)[1],
+        }
 
-    transformer = pyproj.Transformer.from_proj(EPSG_STR, AEQD_STR)
+        with tracer.stage("load_destinations"):
+            if is_geonames_file(destination_file) and os.path.getsize(destination_file) > STREAM_THRESHOLD:
+                destination_df = read_geonames_file(
+                    destination_file,
+                    bbox=(bounds["south"], bounds["west"], bounds["north"], bounds["east"]),
+                    feature_classes=feature_classes,
+                    min_population=min_population,
+                    workers=parse_workers,
+                ).rename(columns={"asciiname": "name_ascii"})
+                geonames_id_col = "name_ascii"
+                city_store = CityStore(destination_df, latitude_col, longitude_col)
+            else:
+                destination_df, geonames_id_col = load_destinations(destination_file)
+                city_store = None
+            if geonames_id_col is not None:
+                location_id_col = geonames_id_col
+
+        required_column_set = {location_id_col, latitude_col, longitude_col}
+
+        if set(destination_df.columns).intersection(required_column_set) != required_column_set:
+            raise ValueError(
+                f"Datafile {destination_file} does not include the all required columns: {' '.join(required_column_set)}"
+            )
 
-    proj_df["geometry"] = proj_df["geometry"].transform(lambda i: Point(transformer.transform(i.x, i.y)))
-    proj_df["distance"] = proj_df["geometry"].distance(Point(0, 0))
+        with tracer.stage("filter_destinations"):
+            if city_store is None:
+                city_store = load_city_store(destination_file, latitude_col, longitude_col)
 
-    closest_cities = (
-        proj_df.query(f"distance > {disaster_radius_km} and distance <= {flight_radius_km}")
-    )
+            destination_filters = [
+                # Quick filter on the bounds of the area, it is answered from the latitude index
+                {"column": latitude_col, "op": "between", "value": [bounds["south"], bounds["north"]]},
+                {"column": longitude_col, "op": "between", "value": [bounds["west"], bounds["east"]]},
+                {"column": "distance", "op": ">", "value": disaster_radius_km},
+                {"column": "distance", "op": "<=", "value": flight_radius_km},
+            ]
+            if geonames_id_col is not None and feature_classes is not None:
+                destination_filters.append({"column": "feature class", "op": "in", "value": list(feature_classes)})
+            if geonames_id_col is not None and min_population is not None:
+                destination_filters.append({"column": "population", "op": ">=", "value": min_population})
 
-    for extra_filter in extra_filters:
-        closest_cities = closest_cities.query(extra_filter)
+            transformer = pyproj.Transformer.from_proj(EPSG_STR, AEQD_STR)
 
-    closest_cities = closest_cities.sort_values("distance", ascending=True).head(60)
+            def distance(columns):
+                x, y = transformer.transform(columns[latitude_col], columns[longitude_col])
+                return np.sqrt(x * x + y * y)
 
-    if not os.path.exists("output"):
-        os.mkdir("output")
-    if not os.path.exists("media"):
-        os.mkdir("media")
+            closest_cities, derived = city_store.select(
+                compile_filters(destination_filters + list(extra_filters)), derived={"distance": distance}
+            )
+            closest_cities = closest_cities.assign(distance=derived["distance"])
+            isochrone = None
+            if max_travel_hours is None:
+                closest_cities = closest_cities.sort_values("distance", ascending=True).head(60)
+            else:
+                with tracer.stage("isochrone"):
+                    field = load_travel_field(
+                        gmaps,
+                        start_position,
+                        travel_mode,
+                        flight_radius_km,
+                        routing_backend="job_queue" if job_queue is not None else routing_backend,
+                        cache_dir=isochrone_cache_dir,
+                        tracer=tracer,
+                    )
+                isochrone = field.isochrone(max_travel_hours)
+                latitudes = closest_cities[latitude_col].to_numpy()
+                longitudes = closest_cities[longitude_col].to_numpy()
+                inside = isochrone.contains(latitudes, longitudes)
+                closest_cities = closest_cities[inside]
+                closest_cities.insert(
+                    len(closest_cities.columns) - 1,
+                    "travel_hours_estimate",
+                    field.travel_seconds(latitudes[inside], longitudes[inside]) / 3600,
+                )
+                closest_cities = closest_cities.sort_values("travel_hours_estimate", kind="stable").head(60)
+
+            x, y = transformer.transform(closest_cities[latitude_col].to_numpy(), closest_cities[longitude_col].to_numpy())
+            closest_cities.insert(
+                len(closest_cities.columns) - 1, "geometry", [Point(point) for point in zip(x, y)]
+            )
 
-    closest_cities.to_csv("output/closest_cities.txt")
+        os.makedirs(output_dir, exist_ok=True)
+        os.makedirs(media_dir, exist_ok=True)
 
-    today = datetime.date.today().isoformat()
-    destinations = []
-    iterrows = closest_cities.iterrows()
-    with open("output/distance_matrix.json", "w") as matrix_file:
-        while True:
-            rows = list(itertools.islice(iterrows, 20))
-            if not rows:
-                break
+        closest_cities.to_csv(os.path.join(output_dir, "closest_cities.txt"))
+        tracer.wrote(os.path.join(output_dir, "closest_cities.txt"))
 
-            destination_set = [
+        today = datetime.date.today().isoformat()
+        rows = [city_data for _, city_data in closest_cities.iterrows()]
+        destination_sets = [
+            [
                 {
                     "name": city_data[location_id_col],
                     "location": (city_data[latitude_col], city_data[longitude_col]),
                 }
-                for _, city_data in rows
+                for city_data in rows[first:first + 20]
             ]
+            for first in range(0, len(rows), 20)
+        ]
+        destinations = [destination for destination_set in destination_sets for destination in destination_set]
+        lower_bounds = duration_lower_bounds([city_data["distance"] for city_data in rows], travel_mode)
 
-            dest_locations = [destination["location"] for destination in destination_set]
-
-            destinations.extend(destination_set)
+        def open_destinations_table():
+            if output_format != "parquet":
+                return contextlib.nullcontext()
+            return TableWriter(os.path.join(output_dir, "destinations.parquet"), "destinations", 20)
 
-            distances = gmaps.distance_matrix(
-                origins=start_position, destinations=dest_locations,
+        def fetch_matrix(destination_set):
+            return gmaps.distance_matrix(
+                origins=start_position, destinations=[destination["location"] for destination in destination_set],
                 mode=travel_mode, language="en", units="metric",
             )
 
-            json.dump(distances, matrix_file)
-            matrix_file.write("\n")
-
-            for destination, address, distance, in zip(
-                    destination_set,
-                    distances["destination_addresses"],
-                    distances["rows"][0]["elements"]
-            ):
-                destination["address"] = address
-                destination["distance"] = distance.get("distance", {"text": "NA", "value": 999999})
-                destination["duration"] = distance.get("duration", {"text": "NA", "value": 999999})
-    sorted_destinations = list(sorted(destinations, key=lambda obj: obj["duration"]["value"]))[0:20]
-
-    for destination in sorted_destinations:
-        directions_result = gmaps.directions(
-            start_position,
-            destination["location"],
-            mode=travel_mode)
-        destination["route"] = directions_result
-
-    with open('output/routes.json', 'w') as f:
-        f.write(json.dumps({
-            destination['name']: destination['route']
+        def fetch_directions(destination):
+            return gmaps.directions(start_position, destination["location"], mode=travel_mode)
+
+        # The Distance Matrix chunks are requested at once and the directions of a destination as soon as it is
+        # certain to be in the top 20, at most `max_concurrency` calls at a time.
+        executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        matrix_futures = {}
+        directions_futures = {}
+        try:
+            for chunk, destination_set in enumerate(destination_sets):
+                matrix_futures[executor.submit(tracer.bind(fetch_matrix), destination_set)] = chunk
+            responses = {}
+            chunk = 0
+            # the destinations table is closed with the distance matrix file, also when the run fails, so the rows
+            # written so far stay readable
+            with tracer.stage("distance_matrix"), open_destinations_table() as destinations_table, \
+                    open(os.path.join(output_dir, "distance_matrix.json"), "w") as matrix_file:
+                pending = set(matrix_futures)
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        distances = responses[matrix_futures[future]] = future.result()
+                        destination_set = destination_sets[matrix_futures[future]]
+                        for destination, address, distance, in zip(
+                                destination_set,
+                                distances["destination_addresses"],
+                                distances["rows"][0]["elements"]
+                        ):
+                            destination["address"] = address
+                            destination["distance"] = distance.get("distance", {"text": "NA", "value": UNREACHABLE})
+                            destination["duration"] = distance.get("duration", {"text": "NA", "value": UNREACHABLE})
+
+                    for index in certain_top(
+                            [destination.get("duration", {}).get("value") for destination in destinations], lower_bounds
+                    ):
+                        if index not in directions_futures:
+                            directions_futures[index] = executor.submit(
+                                tracer.bind(fetch_directions), destinations[index]
+                            )
+
+                    # the responses are written and reported in the order of the chunks
+                    while chunk in responses:
+                        destination_set = destination_sets[chunk]
+                        json.dump(responses.pop(chunk), matrix_file)
+                        matrix_file.write("\n")
+
+                        if destinations_table is not None:
+                            for destination in destination_set:
+                                destinations_table.add(
+                                    date=datetime.date.today(),
+                                    travel_mode=travel_mode,
+                                    name=str(destination["name"]),
+                                    address=destination["address"],
+                                    latitude=float(destination["location"][0]),
+                                    longitude=float(destination["location"][1]),
+                                    duration_seconds=destination["duration"]["value"],
+                                    distance_meters=destination["distance"]["value"],
+                                    geometry=wkb_point(*destination["location"]),
+                                )
+
+                        chunk += 1
+                        reported = [
+                            destination for destination_set in destination_sets[:chunk] for destination in destination_set
+                        ]
+                        yield {
+                            "type": "candidates",
+                            "chunk": chunk,
+                            "destinations": [destination_summary(destination) for destination in destination_set],
+                            "top": [
+                                destination_summary(destination)["name"]
+                                for destination in sorted(reported, key=lambda obj: obj["duration"]["value"])[0:20]
+                            ],
+                        }
+            tracer.wrote(os.path.join(output_dir, "distance_matrix.json"))
+            if destinations_table is not None:
+                tracer.wrote(destinations_table.path)
+            ranking = sorted(range(len(destinations)), key=lambda index: destinations[index]["duration"]["value"])[0:20]
+            sorted_destinations = [destinations[index] for index in ranking]
+
+            with tracer.stage("directions"):
+                for index in ranking:
+                    if index not in directions_futures:
+                        directions_futures[index] = executor.submit(tracer.bind(fetch_directions), destinations[index])
+                ranks = {directions_futures[index]: rank for rank, index in enumerate(ranking, start=1)}
+                for future in as_completed(ranks):
+                    destination = sorted_destinations[ranks[future] - 1]
+                    destination["route"] = future.result()
+                    yield {"type": "route", "rank": ranks[future], "destination": destination_summary(destination)}
+        finally:
+            # stops the calls not started yet when the run fails or the caller stops listening
+            for future in list(matrix_futures) + list(directions_futures.values()):
+                future.cancel()
+            executor.shutdown(wait=False)
+
+        # the route lines of all destinations are decoded in one go
+        route_points, route_offsets = decode_many(
+            destination["route"][0]["overview_polyline"]["points"] if destination["route"] else ""
             for destination in sorted_destinations
-        }))
-
-    # mapping and shape utils
-    import folium
-    from folium import plugins
-
-    # Create Map
-    map = folium.Map(location=start_position, zoom_start=7)
-
-    # Add evacuation area
-    evacuation_area = folium.vector_layers.Circle(
-        location=start_position,
-        radius=disaster_radius_km * 1000,
-        color="#ff8888",
-        fill=True,
-        fill_opacity=0.3,
-        popup=f"Evacuation distance: {disaster_radius_km} km"
-    )
-    evacuation_area.add_to(map)
-
-    start_m = folium.Marker(start_position, popup=start_position,
-                            icon=folium.Icon(icon='glyphicon glyphicon-fire', color='darkred'))
-    start_m.add_to(map)
+        )
 
-    output_dataset = []
-    travel_mode_desc = TravelModes.travel_mode_text(travel_mode)
+        if output_format == "parquet":
+            with TableWriter(os.path.join(output_dir, "routes.parquet"), "routes", 20) as routes_table:
+                for rank, (destination, points) in enumerate(
+                        zip(sorted_destinations, lines(route_points, route_offsets)), start=1
+                ):
+                    if not destination["route"]:
+                        continue
+                    leg = destination["route"][0]["legs"][0]
+                    routes_table.add(
+                        travel_mode=travel_mode,
+                        origin=start_location,
+                        destination=str(destination["name"]),
+                        rank=rank,
+                        duration_seconds=leg["duration"]["value"],
+                        distance_meters=leg["distance"]["value"],
+                        geometry=wkb_linestring(points),
+                    )
+            tracer.wrote(routes_table.path)
+
+        with open(os.path.join(output_dir, "routes.json"), "w") as f:
+            json.dump({
+                destination['name']: destination['route']
+                for destination in sorted_destinations
+            }, f)
+        tracer.wrote(os.path.join(output_dir, "routes.json"))
+
+        output_dataset = []
+        for destination in sorted_destinations:
+            if not destination["route"]:
+                continue
+            output_dataset.append([
+                today,
+                destination["name"],
+                destination["location"][0],
+                destination["location"][1],
+                round(destination["duration"]["value"] / 3600, 3),
+                round(destination["distance"]["value"] / 1000, 3),
+                travel_mode,
+            ])
+
+        if render_map:
+            with tracer.stage("map"):
+                # mapping and shape utils
+                import folium
+                from folium import plugins
+
+                # Create Map
+                map = folium.Map(location=start_position, zoom_start=7)
+
+                # Add evacuation area
+                evacuation_area = folium.vector_layers.Circle(
+                    location=start_position,
+                    radius=disaster_radius_km * 1000,
+                    color="#ff8888",
+                    fill=True,
+                    fill_opacity=0.3,
+                    popup=f"Evacuation distance: {disaster_radius_km} km"
+                )
+                evacuation_area.add_to(map)
+
+                if isochrone is not None:
+                    folium.GeoJson(
+                        isochrone.geojson(),
+                        style_function=lambda feature: {"color": "#3388ff", "fill": False, "dashArray": "5, 5"},
+                        tooltip=f"Reachable within {max_travel_hours} hours",
+                    ).add_to(map)
+
+                start_m = folium.Marker(start_position, popup=start_position,
+                                        icon=folium.Icon(icon='glyphicon glyphicon-fire', color='darkred'))
+                start_m.add_to(map)
+
+                travel_mode_desc = TravelModes.travel_mode_text(travel_mode)
+
+                # Plot conflict starting points
+                for destination, points in zip(sorted_destinations, lines(route_points, route_offsets)):
+                    if not destination["route"]:
+                        continue
+                    route = destination["route"][0]
+                    leg = route['legs'][0]
+                    distance = leg['distance']['text']
+                    duration = leg['duration']['text']
+                    tooltip = safe(
+                            f"Travel between <b>{start_location}</b> and <b>{destination.get('name', 'N/A')}"
+                            f"</b> {travel_mode_desc} is <b>{distance}</b> and takes <b>{duration}</b>."
+                    )
+
+                    popup_html = safe(
+                        f'''
+                        <div style="min-width: 400px">
+                            <h3>Travel to {destination["name"]} {travel_mode_desc}</h3>
+                            Total travel time: <b>{duration}</b><br/>
+                            Total travel distance: <b>{distance}</b>
+                        </div>
+                        '''
+                    )
+
+                    loc_m = folium.Marker(destination["location"], popup=folium.Popup(popup_html),
+                                          icon=folium.Icon(icon='glyphicon glyphicon-home', color='blue'))
+                    loc_m.add_to(map)
+
+                    polyline_m = folium.PolyLine(points.tolist(), color='blue', tooltip=tooltip, weight=5,
+                                                 popup=folium.Popup(popup_html))
+                    polyline_m.add_to(map)
+
+                # Add fullscreen button
+                plugins.Fullscreen().add_to(map)
+                map.save(os.path.join(media_dir, "routes.html"))
+            tracer.wrote(os.path.join(media_dir, "routes.html"))
+
+        with open(os.path.join(output_dir, "route_data.csv"), "w") as output_datafile:
+            output_csv = csv.writer(output_datafile, dialect="unix")
+            output_csv.writerow([
+                "date",
+                "destination",
+                "destination_latitude",
+                "destination_longitude",
+                "duration_hrs",
+                "distance_km",
+                "travel_mode",
+            ])
+            output_csv.writerows(output_dataset)
+        tracer.wrote(os.path.join(output_dir, "route_data.csv"))
+
+        yield {
+            "type": "ranking",
+            "start_location": start_location,
+            "start_position": list(start_position),
+            "travel_mode": travel_mode,
+            "destinations": [destination_summary(destination) for destination in sorted_destinations],
+        }
+        return {
+            "start_location": start_location,
+            "start_position": start_position,
+            "disaster_radius_km": disaster_radius_km,
+            "flight_radius_km": flight_radius_km,
+            "travel_mode": travel_mode,
+            "destinations": sorted_destinations,
+            "route_data": output_dataset,
+        }
+    finally:
+        tracer.save(trace_file, chrome_trace_file, speedscope_file)
 
-    # Plot conflict starting points
-    for destination in sorted_destinations:
-        if not destination["route"]:
-            continue
-        route = destination["route"][0]
-        leg = route['legs'][0]
-        distance = leg['distance']['text']
-        duration = leg['duration']['text']
-        tooltip = safe(
-                f"Travel between <b>{start_location}</b> and <b>{destination.get('name', 'N/A')}"
-                f"</b> {travel_mode_desc} is <b>{distance}</b> and takes <b>{duration}</b>."
-        )
 
-        popup_html = safe(
-            f'''
-            <div style="min-width: 400px">
-                <h3>Travel to {destination["name"]} {travel_mode_desc}</h3>
-                Total travel time: <b>{duration}</b><br/>
-                Total travel distance: <b>{distance}</b>
-            </div>
-            '''
-        )
+def find_routes(*args, **kwargs):
+    '''
+    Runs `iter_routes` to the end and returns the start position with the ranked destinations and their directions.
+    '''
+    events = iter_routes(*args, **kwargs)
+    while True:
+        try:
+            next(events)
+        except StopIteration as stop:
+            return stop.value
 
-        loc_m = folium.Marker(destination["location"], popup=folium.Popup(popup_html),
-                              icon=folium.Icon(icon='glyphicon glyphicon-home', color='blue'))
-        loc_m.add_to(map)
-
-        polyline_ = polyline.decode(route['overview_polyline']['points'])
-        polyline_m = folium.PolyLine(polyline_, color='blue', tooltip=tooltip, weight=5,
-                                     popup=folium.Popup(popup_html))
-        polyline_m.add_to(map)
-
-        output_dataset.append([
-            today,
-            destination["name"],
-            destination["location"][0],
-            destination["location"][1],
-            round(destination["duration"]["value"] / 3600, 3),
-            round(destination["distance"]["value"] / 1000, 3),
-            travel_mode,
-        ])
-
-    # Add fullscreen button
-    plugins.Fullscreen().add_to(map)
-    map.save("media/routes.html")
-
-    with open("output/route_data.csv", "w") as output_datafile:
-        output_csv = csv.writer(output_datafile, dialect="unix")
-        output_csv.writerow([
-            "date",
-            "destination",
-            "destination_latitude",
-            "destination_longitude",
-            "duration_hrs",
-            "distance_km",
-            "travel_mode",
-        ])
-        output_csv.writerows(output_dataset)
 
 
 if __name__ == "__main__":
@@ -336,6 +682,8 @@ if __name__ == "__main__":
     )
     arg_parser.add_argument(
         "--extra-filters",
+        help="JSON list of destination filters, expressions such as \"population > 10000\" or structured filters "
+             "such as {\"column\": \"country code\", \"op\": \"in\", \"value\": [\"PL\", \"RO\"]}",
         type=str,
         default="[]",
     )
@@ -357,9 +705,129 @@ if __name__ == "__main__":
         type=str,
         default="longitude",
     )
+    arg_parser.add_argument(
+        "--routing-backend",
+        help="Routing service to use. \"local\" is an offline stand-in that needs no API key",
+        choices=ROUTING_BACKENDS,
+        default="google",
+    )
+    arg_parser.add_argument(
+        "--trace-file",
+        help="Path of the JSON run trace with per-stage timings, API calls and bytes written (default output/trace.json)",
+        type=str,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--chrome-trace-file",
+        help="Optional path of a Chrome trace (chrome://tracing, Perfetto) of the run",
+        type=str,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--speedscope-file",
+        help="Optional path of a speedscope profile of the run",
+        type=str,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--api-limits",
+        help='JSON object of per-endpoint rate limits, e.g. {"directions": {"qps": 10}}',
+        type=str,
+        default="{}",
+    )
+    arg_parser.add_argument(
+        "--daily-budget",
+        help="Maximum billable Google Maps units (requests, or elements for the distance matrix) per day",
+        type=int,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--quota-state-file",
+        help="File used to share rate limits and daily usage between concurrent runs on the same API key",
+        type=str,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--output-format",
+        help="\"parquet\" also writes the destinations and routes as GeoParquet tables",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+    )
+    arg_parser.add_argument(
+        "--no-map",
+        help="Do not render the routes map, only write the route data",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--ndjson",
+        help="Print the candidates and routes to stdout as newline delimited JSON events as they come in",
+        action="store_true",
+    )
+    arg_parser.add_argument(
+        "--feature-classes",
+        help="GeoNames feature classes destinations must have, e.g. \"P\" for populated places",
+        type=str,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--min-population",
+        help="Minimum population of GeoNames destinations",
+        type=int,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--parse-workers",
+        help="Number of processes that parse a large GeoNames file (such as allCountries.txt)",
+        type=int,
+        default=1,
+    )
+    arg_parser.add_argument(
+        "--max-concurrency",
+        help="Maximum number of routing API calls in flight at the same time",
+        type=int,
+        default=8,
+    )
+    arg_parser.add_argument(
+        "--job-queue",
+        help=f"Queue the routing calls for the workers of this job queue file (e.g. {DEFAULT_QUEUE_FILE}) "
+             "instead of making them",
+        type=str,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--job-run",
+        help="Name of the run in the job queue; a run started again with the same name reuses its results",
+        type=str,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--job-timeout",
+        help="Seconds to wait for the workers of the job queue before giving up",
+        type=float,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--gazetteer-file",
+        help="GeoNames file the start location is looked up in before it is geocoded by the routing service",
+        type=str,
+        default=GAZETTEER_FILE,
+    )
+    arg_parser.add_argument(
+        "--max-travel-hours",
+        help="Only consider destinations estimated to be reachable within this many hours, from travel times "
+             "sampled once around the start",
+        type=float,
+        default=None,
+    )
+    arg_parser.add_argument(
+        "--isochrone-cache-dir",
+        help="Directory the sampled travel times are kept in for later runs",
+        type=str,
+        default=ISOCHRONE_CACHE_DIR,
+    )
     args = arg_parser.parse_args()
 
-    find_routes(
+    kwargs = dict(
         start_location=args.start_location,
         disaster_radius_km=args.disaster_radius_km,
         flight_radius_km=args.flight_radius_km,
@@ -369,4 +837,32 @@ if __name__ == "__main__":
         location_id_col=args.location_id_col,
         latitude_col=args.latitude_col,
         longitude_col=args.longitude_col,
+        routing_backend=args.routing_backend,
+        trace_file=args.trace_file,
+        chrome_trace_file=args.chrome_trace_file,
+        speedscope_file=args.speedscope_file,
+        api_limits=json.loads(args.api_limits),
+        daily_budget=args.daily_budget,
+        quota_state_file=args.quota_state_file,
+        render_map=not args.no_map,
+        output_format=args.output_format,
+        feature_classes=args.feature_classes,
+        min_population=args.min_population,
+        parse_workers=args.parse_workers,
+        max_concurrency=args.max_concurrency,
+        job_queue=args.job_queue,
+        job_run=args.job_run,
+        job_timeout=args.job_timeout,
+        gazetteer_file=args.gazetteer_file,
+        max_travel_hours=args.max_travel_hours,
+        isochrone_cache_dir=args.isochrone_cache_dir,
     )
+    if args.ndjson:
+        # anything else printed during the run goes to stderr, stdout only has the events
+        events_out = sys.stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            for event in iter_routes(**kwargs):
+                events_out.write(json.dumps(event) + "\n")
+                events_out.flush()
+    else:
+        find_routes(**kwargs)
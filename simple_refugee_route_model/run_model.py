@@ -21,8 +21,9 @@ if __name__ == "__main__":
     args = arg_parser.parse_args()
     config_file = args.config_file
     config: dict = json.load(open(config_file))
-    googlemaps_key = config.pop("GOOGLEMAPS_KEY")
-    os.environ["GOOGLEMAPS_KEY"] = googlemaps_key
+    googlemaps_key = config.pop("GOOGLEMAPS_KEY", None)
+    if googlemaps_key:
+        os.environ["GOOGLEMAPS_KEY"] = googlemaps_key
 
     find_routes(
         **{
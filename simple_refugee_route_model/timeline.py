@@ -0,0 +1,367 @@
+import argparse
+import csv
+import datetime
+import json
+import math
+import os
+import sys
+import threading
+
+from haversine import inverse_haversine
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from routing_common.clients import build_client
+from routing_common.instrumentation import TracedClient, Tracer
+from routing_common.jobs import JobQueue, QueueClient
+from routing_common.polyline_codec import decode_many, lines
+from simple_refugee_route_model.evacuation import TravelModes, find_routes, safe
+
+STEP_KEYS = ["start_location", "disaster_radius_km", "flight_radius_km"]
+
+
+def _location_key(location):
+    if isinstance(location, (tuple, list)) and len(location) == 2:
+        return float(location[0]), float(location[1])
+    return str(location)
+
+
+def _options_key(kwargs):
+    return tuple(sorted((name, str(value)) for name, value in kwargs.items()))
+
+
+class ReusingClient:
+    '''
+    Wraps a routing client and keeps every Distance Matrix element, directions result and geocode it gets, so the
+    later steps of a timeline only request what they have not seen yet.
+
+    A Distance Matrix request from one origin is split into the destinations already known, which are answered
+    from memory, and the others, which are requested in one call; the response has the same shape as if all of
+    them had been requested. Calls actually made are recorded on `tracer`, reused results as its cache hits.
+    '''
+
+    def __init__(self, client, tracer=None):
+        self.client = client
+        self.tracer = tracer
+        self.origin_addresses = {}
+        self.elements = {}
+        self.routes = {}
+        self.places = {}
+        self.counts = {"distance_matrix": [0, 0], "directions": [0, 0]}
+        self._lock = threading.Lock()
+
+    def _count(self, endpoint, fetched, reused):
+        with self._lock:
+            self.counts[endpoint][0] += fetched
+            self.counts[endpoint][1] += reused
+        if self.tracer is not None:
+            for _ in range(reused):
+                self.tracer.cache_hit(endpoint)
+            for _ in range(fetched):
+                self.tracer.cache_miss(endpoint)
+
+    def take_counts(self):
+        '''
+        Returns {endpoint: (fetched, reused)} since the last call, in elements for the Distance Matrix.
+        '''
+        with self._lock:
+            counts = {endpoint: tuple(count) for endpoint, count in self.counts.items()}
+            self.counts = {endpoint: [0, 0] for endpoint in self.counts}
+        return counts
+
+    def geocode(self, address, **kwargs):
+        key = (str(address), _options_key(kwargs))
+        if key not in self.places:
+            self.places[key] = self.client.geocode(address=address, **kwargs)
+        return self.places[key]
+
+    def directions(self, origin, destination, **kwargs):
+        key = (_location_key(origin), _location_key(destination), _options_key(kwargs))
+        with self._lock:
+            reused = key in self.routes
+        if not reused:
+            route = self.client.directions(origin, destination, **kwargs)
+            with self._lock:
+                self.routes[key] = route
+        self._count("directions", int(not reused), int(reused))
+        return self.routes[key]
+
+    def distance_matrix(self, origins, destinations, **kwargs):
+        if not (isinstance(origins, (tuple, list)) and len(origins) == 2 and not isinstance(origins[0], (tuple, list))):
+            # only requests from a single origin are split
+            return self.client.distance_matrix(origins, destinations, **kwargs)
+        origin = _location_key(origins)
+        options = _options_key(kwargs)
+        keys = [(origin, _location_key(destination), options) for destination in destinations]
+        with self._lock:
+            missing = [index for index, key in enumerate(keys) if key not in self.elements]
+        if missing:
+            response = self.client.distance_matrix(origins, [destinations[index] for index in missing], **kwargs)
+            with self._lock:
+                self.origin_addresses[(origin, options)] = response["origin_addresses"][0]
+                for index, address, element in zip(
+                        missing, response["destination_addresses"], response["rows"][0]["elements"]
+                ):
+                    self.elements[keys[index]] = (address, element)
+        self._count("distance_matrix", len(missing), len(keys) - len(missing))
+        with self._lock:
+            known = [self.elements[key] for key in keys]
+            origin_address = self.origin_addresses[(origin, options)]
+        return {
+            "status": "OK",
+            "origin_addresses": [origin_address],
+            "destination_addresses": [address for address, _ in known],
+            "rows": [{"elements": [element for _, element in known]}],
+        }
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def expand_steps(steps, start_time=None):
+    '''
+    Fills in every step of a timeline: a step only needs the values that changed since the previous one, and a
+    step without a "time" comes an hour after the previous one (the first one at `start_time`, by default the
+    current hour).
+    '''
+    if start_time is None:
+        start_time = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    expanded = []
+    previous = {"time": start_time - datetime.timedelta(hours=1)}
+    for index, step in enumerate(steps):
+        step = dict(previous, **step)
+        if "time" not in steps[index]:
+            step["time"] = previous["time"] + datetime.timedelta(hours=1)
+        elif isinstance(step["time"], str):
+            step["time"] = datetime.datetime.fromisoformat(step["time"])
+        missing = [key for key in STEP_KEYS if key not in step]
+        if missing:
+            raise ValueError(f"Step {index} of the timeline has no {', '.join(missing)}")
+        expanded.append(step)
+        previous = step
+    return expanded
+
+
+def _circle(position, radius_km, points=64):
+    # GeoJSON ring (longitude, latitude) around a point
+    ring = [inverse_haversine(position, radius_km, 2 * math.pi * index / points) for index in range(points)]
+    return [[lng, lat] for lat, lng in ring + ring[:1]]
+
+
+def timeline_features(results):
+    '''
+    The disaster area, routes and destinations of every step as GeoJSON features with the time of their step,
+    for a time-sliced map.
+    '''
+    features = []
+    for step in results:
+        time = step["time"].isoformat()
+        result = step["result"]
+        start_position = result["start_position"]
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Polygon", "coordinates": [_circle(start_position, result["disaster_radius_km"])]},
+            "properties": {
+                "times": [time],
+                "popup": f"Evacuation distance: {result['disaster_radius_km']} km",
+                "style": {"color": "#ff8888", "fillColor": "#ff8888", "fillOpacity": 0.3},
+            },
+        })
+        travel_mode_desc = TravelModes.travel_mode_text(result["travel_mode"])
+        destinations = [destination for destination in result["destinations"] if destination["route"]]
+        route_points, route_offsets = decode_many(
+            destination["route"][0]["overview_polyline"]["points"] for destination in destinations
+        )
+        for destination, points in zip(destinations, lines(route_points, route_offsets)):
+            leg = destination["route"][0]["legs"][0]
+            popup = safe(
+                f"Travel between <b>{result['start_location']}</b> and <b>{destination['name']}</b> "
+                f"{travel_mode_desc} is <b>{leg['distance']['text']}</b> and takes <b>{leg['duration']['text']}</b>."
+            )
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "LineString", "coordinates": points[:, ::-1].tolist()},
+                "properties": {"times": [time] * len(points), "popup": popup, "style": {"color": "blue", "weight": 5}},
+            })
+            features.append({
+                "type": "Feature",
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [float(destination["location"][1]), float(destination["location"][0])],
+                },
+                "properties": {
+                    "times": [time],
+                    "popup": popup,
+                    "icon": "circle",
+                    "iconstyle": {"color": "blue", "fillColor": "blue", "fillOpacity": 0.8, "radius": 5},
+                },
+            })
+    return features
+
+
+def draw_timeline_map(results, path):
+    '''
+    Writes one map of every step with a time slider; each step shows its disaster area, routes and destinations.
+    '''
+    import folium
+    from folium import plugins
+
+    times = [step["time"] for step in results]
+    gaps = [(later - earlier).total_seconds() for earlier, later in zip(times, times[1:]) if later > earlier]
+    # a feature is shown until just before the next step
+    duration = f"PT{int(min(gaps)) - 1}S" if gaps and min(gaps) > 1 else None
+
+    map = folium.Map(location=results[0]["result"]["start_position"], zoom_start=7)
+    plugins.TimestampedGeoJson(
+        {"type": "FeatureCollection", "features": timeline_features(results)},
+        period="PT1H",
+        duration=duration,
+        add_last_point=False,
+        auto_play=False,
+        date_options="YYYY-MM-DD HH:mm",
+    ).add_to(map)
+    plugins.Fullscreen().add_to(map)
+    map.save(path)
+
+
+def run_timeline(
+        steps,
+        output_dir="output",
+        media_dir="media",
+        gmaps=None,
+        routing_backend="google",
+        api_limits=None,
+        daily_budget=None,
+        quota_state_file=None,
+        max_concurrency=8,
+        job_queue=None,
+        job_run=None,
+        job_timeout=None,
+        render_map=True,
+        start_time=None,
+        **kwargs
+):
+    '''
+    Runs `find_routes` for every step of an incident that changes over time, such as a disaster radius that grows
+    every hour or a start point that moves.
+
+    `steps` is a list of {"time", "start_location", "disaster_radius_km", "flight_radius_km"}, where a step only
+    needs the values that changed (see `expand_steps`). Other `find_routes` parameters apply to every step.
+
+    The routing client of the run keeps every result (`ReusingClient`), so a step only requests the Distance
+    Matrix elements of the destinations that were not candidates of an earlier step from the same start point,
+    such as those the grown annulus now reaches, and the directions of new top destinations. Everything else,
+    including the destinations themselves, is computed again, which takes milliseconds.
+
+    Each step writes the usual outputs under `output_dir`/step_NNN. `output_dir` also gets timeline.csv (the
+    route data of every step), steps.csv (what each step fetched and reused, and the destinations that entered or
+    left the top 20) and `media_dir` a map of all steps with a time slider. Returns the expanded steps with the
+    result of each.
+    '''
+    steps = expand_steps(steps, start_time)
+    tracer = Tracer("timeline")
+    if gmaps is None and job_queue is not None:
+        gmaps = QueueClient(JobQueue(job_queue), run=job_run, timeout=job_timeout)
+    if gmaps is None:
+        gmaps = build_client(
+            routing_backend,
+            api_limits=api_limits,
+            daily_budget=daily_budget,
+            quota_state_file=quota_state_file,
+            http_pool_size=max_concurrency,
+        )
+    client = ReusingClient(gmaps)
+
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    summaries = []
+    previous_top = []
+    for index, step in enumerate(steps):
+        step_dir = os.path.join(output_dir, f"step_{index:03d}")
+        step_tracer = Tracer(f"timeline step {index}")
+        # the calls a step makes are recorded on its own trace
+        client.client = TracedClient(gmaps, step_tracer)
+        client.tracer = step_tracer
+        with tracer.stage(f"step:{index}"):
+            result = find_routes(
+                **{key: step[key] for key in STEP_KEYS},
+                **kwargs,
+                gmaps=client,
+                tracer=step_tracer,
+                output_dir=step_dir,
+                media_dir=step_dir,
+                render_map=False,
+                max_concurrency=max_concurrency,
+            )
+        counts = client.take_counts()
+        top = [destination["name"] for destination in result["destinations"]]
+        summaries.append({
+            "step": index,
+            "time": step["time"].isoformat(),
+            **{key: step[key] for key in STEP_KEYS},
+            "matrix_elements_fetched": counts["distance_matrix"][0],
+            "matrix_elements_reused": counts["distance_matrix"][1],
+            "directions_fetched": counts["directions"][0],
+            "directions_reused": counts["directions"][1],
+            "entered_top": "|".join(str(name) for name in top if name not in previous_top),
+            "left_top": "|".join(str(name) for name in previous_top if name not in top),
+        })
+        print(
+            f"step {index} ({step['time'].isoformat()}): {counts['distance_matrix'][0]} matrix elements and "
+            f"{counts['directions'][0]} directions fetched, {counts['distance_matrix'][1]} and "
+            f"{counts['directions'][1]} reused"
+        )
+        previous_top = top
+        results.append(dict(step, result=result))
+
+    with open(os.path.join(output_dir, "timeline.csv"), "w") as f:
+        output_csv = csv.writer(f, dialect="unix")
+        output_csv.writerow([
+            "step", "time", "date", "destination", "destination_latitude", "destination_longitude", "duration_hrs",
+            "distance_km", "travel_mode",
+        ])
+        for index, step in enumerate(results):
+            output_csv.writerows([index, step["time"].isoformat()] + row for row in step["result"]["route_data"])
+    tracer.wrote(os.path.join(output_dir, "timeline.csv"))
+
+    with open(os.path.join(output_dir, "steps.csv"), "w") as f:
+        output_csv = csv.DictWriter(f, fieldnames=list(summaries[0]) if summaries else [], dialect="unix")
+        output_csv.writeheader()
+        output_csv.writerows(summaries)
+    tracer.wrote(os.path.join(output_dir, "steps.csv"))
+
+    if render_map and results:
+        with tracer.stage("map"):
+            os.makedirs(media_dir, exist_ok=True)
+            draw_timeline_map(results, os.path.join(media_dir, "timeline.html"))
+        tracer.wrote(os.path.join(media_dir, "timeline.html"))
+    tracer.save(os.path.join(output_dir, "trace.json"))
+    return results
+
+
+if __name__ == "__main__":
+    description = """
+    Runs the evacuation routes model for every step of an incident that changes over time, reusing the routing
+    results of the earlier steps. The config has the find_routes parameters and "steps", e.g.:
+
+    {"travel_mode": "driving", "routing_backend": "local",
+     "steps": [{"time": "2026-10-19T08:00", "start_location": "Kyiv, Ukraine", "disaster_radius_km": 50,
+                "flight_radius_km": 400},
+               {"disaster_radius_km": 80, "flight_radius_km": 450},
+               {"disaster_radius_km": 120, "flight_radius_km": 500}]}
+    """
+    arg_parser = argparse.ArgumentParser(
+        description=description, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument(
+        "config_file",
+        type=str,
+        help="Path to the json config file with the steps. (E.g.: timeline.json)",
+    )
+    args = arg_parser.parse_args()
+    with open(args.config_file) as f:
+        config = json.load(f)
+    googlemaps_key = config.pop("GOOGLEMAPS_KEY", None)
+    if googlemaps_key:
+        os.environ["GOOGLEMAPS_KEY"] = googlemaps_key
+
+    run_timeline(**{key: value for key, value in config.items() if value is not None})
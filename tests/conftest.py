@@ -0,0 +1,12 @@
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the models import their modules from their own folders, like the scripts they are run as
+for path in (
+    ROOT_DIR,
+    os.path.join(ROOT_DIR, "Ensemble_Attraction_Routing"),
+    os.path.join(ROOT_DIR, "simple_refugee_route_model"),
+):
+    if path not in sys.path:
+        sys.path.append(path)
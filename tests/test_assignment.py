@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from routing_common.assignment import BPR, assign, round_flows
+
+pytest.importorskip("fuzzywuzzy")
+from ensemble import assign_refugees, crossing_capacities, crossing_options  # noqa: E402
+
+
+def congested_options():
+    rng = np.random.default_rng(0)
+    origins = np.repeat(np.arange(30), 3)
+    crossings = rng.integers(0, 6, len(origins))
+    base_costs = rng.uniform(3600, 7200, len(origins))
+    demands = rng.integers(100, 5000, 30).astype(float)
+    return base_costs, origins, crossings, demands, BPR(np.full(6, 30000.0), 6 * 3600)
+
+
+@pytest.mark.parametrize("method", ["frank-wolfe", "msa"])
+def test_assignment_reaches_the_relative_gap(method):
+    base_costs, origins, crossings, demands, congestion = congested_options()
+    result = assign(base_costs, origins, crossings, demands, congestion, method=method, max_iterations=5000)
+    assert result.converged
+    np.testing.assert_allclose(np.bincount(origins, weights=result.flows), demands)
+    np.testing.assert_allclose(np.bincount(crossings, weights=result.flows, minlength=6), result.volumes)
+    # the gap worked out again from the flows: what moving everyone to their cheapest option would save
+    costs = base_costs + congestion.cost(result.volumes)[crossings]
+    lowest = np.minimum.reduceat(costs, np.arange(0, len(origins), 3))
+    total = costs @ result.flows
+    assert (total - lowest @ demands) / total <= 1e-4
+
+
+def test_used_options_cost_no_more_than_the_cheapest():
+    base_costs, origins, crossings, demands, congestion = congested_options()
+    result = assign(base_costs, origins, crossings, demands, congestion, tolerance=1e-7, max_iterations=5000)
+    # Wardrop: nobody on an option that costs noticeably more than the cheapest option of their origin
+    costs = base_costs + result.waits[crossings]
+    lowest = np.minimum.reduceat(costs, np.arange(0, len(origins), 3))[origins]
+    used = result.flows > 1e-3 * demands[origins]
+    assert (costs[used] <= lowest[used] * 1.001).all()
+
+
+def test_both_methods_reach_the_same_volumes():
+    origins = np.array([0, 0, 1, 1, 2])
+    crossings = np.array([0, 1, 0, 1, 1])
+    base_costs = np.array([1000.0, 3000.0, 1500.0, 1200.0, 500.0])
+    demands = np.array([8000.0, 4000.0, 3000.0])
+    congestion = BPR([5000.0, 5000.0], 3600)
+    frank_wolfe = assign(base_costs, origins, crossings, demands, congestion, tolerance=1e-7, max_iterations=5000)
+    msa = assign(base_costs, origins, crossings, demands, congestion, method="msa", tolerance=1e-5, max_iterations=5000)
+    np.testing.assert_allclose(frank_wolfe.volumes, msa.volumes, rtol=1e-2)
+
+
+def test_unlimited_capacity_keeps_everyone_on_the_cheapest_option():
+    origins = np.array([0, 0, 1, 1])
+    crossings = np.array([0, 1, 0, 1])
+    # ties go to the first option of the origin
+    base_costs = np.array([10.0, 20.0, 5.0, 5.0])
+    result = assign(base_costs, origins, crossings, [100.0, 50.0], BPR([np.inf, np.inf], 3600))
+    assert result.iterations == 0
+    assert result.flows.tolist() == [100.0, 0.0, 50.0, 0.0]
+
+
+def test_invalid_inputs_are_rejected():
+    with pytest.raises(ValueError):
+        BPR([100.0, 0.0], 3600)
+    with pytest.raises(ValueError):
+        assign([1.0, 2.0], [1, 0], [0, 1], [1.0, 1.0], BPR([1.0, 1.0], 1))
+    with pytest.raises(ValueError):
+        assign([1.0], [0], [0], [1.0, 1.0], BPR([1.0], 1))
+    with pytest.raises(ValueError):
+        assign([1.0], [0], [0], [1.0], BPR([1.0], 1), method="greedy")
+
+
+def test_round_flows_keeps_every_demand():
+    rng = np.random.default_rng(2)
+    origins = np.repeat(np.arange(50), 4)
+    demands = rng.integers(0, 1000, 50)
+    shares = rng.dirichlet(np.ones(4), 50).ravel()
+    flows = shares * demands[origins]
+    rounded = round_flows(flows, origins, demands)
+    assert (rounded >= 0).all()
+    assert (np.abs(rounded - flows) < 1).all()
+    assert np.bincount(origins, weights=rounded, minlength=50).astype(int).tolist() == demands.tolist()
+
+
+def crossing(origin, country, lat, lng, duration):
+    return {origin: {
+        "final_ind": 0,
+        "final_duration": duration,
+        "final_distance": duration * 20,
+        "destination_country": country,
+        "result": [{"legs": [{"steps": [{"end_location": {"lat": lat, "lng": lng}}]}]}],
+    }}
+
+
+@pytest.fixture
+def scenario():
+    crossings = [
+        crossing("Lviv", "Poland", 50.0, 23.0, 3600),
+        crossing("Lviv", "Slovakia", 48.9, 22.5, 4 * 3600),
+        crossing("Kyiv", "Poland", 50.0, 23.0, 6 * 3600),
+        crossing("Kyiv", "Slovakia", 48.9, 22.5, 8 * 3600),
+        # less than a kilometre from the first Polish crossing, so it shares its capacity
+        crossing("Kyiv", "Poland", 50.001, 23.001, 6.5 * 3600),
+    ]
+    refugees = pd.DataFrame({
+        "origin city": ["Lviv", "Kyiv", "Odesa"],
+        "origin country": ["Ukraine"] * 3,
+        "conflict_year": [2022] * 3,
+        "destination country": ["Poland", "Poland", None],
+        "latitude": [50.0, 50.0, None],
+        "longitude": [23.0, 23.0, None],
+        "total refugees": [40000, 60000, 5000],
+    })
+    attractions = pd.DataFrame({"country": ["Poland", "Slovakia"], "predicted_shares": [0.5, 0.5]})
+    longest = {"Lviv": 8 * 3600, "Kyiv": 8 * 3600, "Odesa": 8 * 3600}
+    return refugees, crossings, attractions, longest
+
+
+def test_without_limits_everyone_takes_the_chosen_crossing(scenario):
+    refugees, crossings, attractions, longest = scenario
+    assigned, by_country, loads = assign_refugees(refugees, crossings, attractions, 0.3, longest, {})
+    assert assigned["total refugees"].tolist() == [40000, 60000, 5000]
+    assert assigned["destination country"].tolist()[:2] == ["Poland", "Poland"]
+    assert by_country.set_index("country")["total refugees"].to_dict() == {"Poland": 100000}
+    assert loads["total refugees"].sum() == 100000
+
+
+def test_a_full_crossing_sends_refugees_elsewhere(scenario):
+    refugees, crossings, attractions, longest = scenario
+    limits = {"default": 1000000, "crossings": [{"latitude": 50.0, "longitude": 23.0, "capacity": 20000}]}
+    assigned, by_country, loads = assign_refugees(refugees, crossings, attractions, 0.3, longest, limits)
+
+    # every origin keeps its refugees, and the origin without a route keeps its row last
+    totals = assigned.groupby("origin city", sort=False)["total refugees"].sum()
+    assert totals.to_dict() == {"Lviv": 40000, "Kyiv": 60000, "Odesa": 5000}
+    assert assigned["origin city"].tolist()[-1] == "Odesa" and pd.isna(assigned["destination country"].iloc[-1])
+    assert list(assigned["origin city"]) == sorted(assigned["origin city"], key=["Lviv", "Kyiv", "Odesa"].index)
+
+    by_country = by_country.set_index("country")["total refugees"]
+    assert by_country["Slovakia"] > 0 and by_country.sum() == 100000
+    # the two Polish crossings share one capacity, so they are one crossing in the loads
+    polish = loads[loads["destination country"] == "Poland"]
+    assert len(polish) == 1 and polish["capacity"].iloc[0] == 20000
+    assert loads["total refugees"].sum() == 100000
+
+
+def test_capacities_match_by_point_radius_and_country():
+    crossings = [("Poland", 50.0, 23.0), ("Slovakia", 50.05, 23.0), ("Poland", 52.0, 23.0)]
+    limits = {
+        "default": 500,
+        "crossings": [
+            {"latitude": 50.0, "longitude": 23.0, "radius_km": 10, "country": "Slovakia", "capacity": 10},
+            {"latitude": 50.0, "longitude": 23.0, "radius_km": 10, "capacity": 20},
+        ],
+    }
+    assert crossing_capacities(crossings, limits).tolist() == [20, 10, 500]
+    assert np.isinf(crossing_capacities(crossings, {})).all()
+
+
+def test_options_need_a_duration_weight(scenario):
+    refugees, crossings, attractions, longest = scenario
+    with pytest.raises(ValueError):
+        crossing_options(refugees, crossings, attractions, 1.0, longest)
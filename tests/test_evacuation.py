@@ -0,0 +1,90 @@
+import numpy as np
+
+from simple_refugee_route_model.evacuation import (
+    MAX_SPEEDS_KMH,
+    UNREACHABLE,
+    certain_top,
+    duration_lower_bounds,
+)
+
+
+def exact_top(durations, top):
+    # the ranking of iter_routes once every duration is known: a stable sort by duration
+    return set(sorted(range(len(durations)), key=lambda index: durations[index])[:top])
+
+
+def completions(durations, lower_bounds, rng, count):
+    '''
+    Durations the unknown ones can turn out to be: every one at its lower bound (the closest they can get to the
+    known ones, tied with them when the bounds are durations), unreachable, and random ones at or above the bound.
+    '''
+    unknown = [index for index, duration in enumerate(durations) if duration is None]
+    fills = [
+        {index: lower_bounds[index] for index in unknown},
+        {index: UNREACHABLE for index in unknown},
+    ]
+    for _ in range(count):
+        fills.append({
+            index: rng.choice([lower_bounds[index], UNREACHABLE, lower_bounds[index] + rng.integers(0, 5)])
+            for index in unknown
+        })
+    for fill in fills:
+        yield [fill.get(index, duration) for index, duration in enumerate(durations)]
+
+
+def test_certain_destinations_are_in_every_exact_top():
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        size = int(rng.integers(1, 30))
+        top = int(rng.integers(1, 8))
+        # few distinct values, so there are many ties between known durations and with the bounds
+        lower_bounds = [int(bound) for bound in rng.integers(0, 6, size)]
+        final = [bound + int(rng.integers(0, 4)) for bound in lower_bounds]
+        durations = [duration if rng.random() < 0.6 else None for duration in final]
+
+        certain = certain_top(durations, lower_bounds, top)
+        assert len(certain) <= top
+        assert all(durations[index] is not None for index in certain)
+        for filled in completions(durations, lower_bounds, rng, 20):
+            assert set(certain) <= exact_top(filled, top)
+
+
+def test_all_known_is_the_exact_top():
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        size = int(rng.integers(1, 40))
+        durations = [int(duration) for duration in rng.integers(0, 10, size)]
+        top = int(rng.integers(1, 25))
+        assert set(certain_top(durations, [0] * size, top)) == exact_top(durations, top)
+
+
+def test_ties_are_ranked_by_position():
+    # the unknown destination in front can tie with the known one at 5 and so push it out of the top 2
+    assert certain_top([None, 1, 5], [5, 0, 0], top=2) == [1]
+    # a bound equal to the duration is counted as ahead wherever it is, which never makes too much certain
+    assert certain_top([1, 5, None], [0, 0, 5], top=2) == [0]
+    assert certain_top([1, 5, None], [0, 0, 6], top=2) == [0, 1]
+    # a known destination tied with an earlier known one comes after it
+    assert certain_top([3, 3, 3], [0, 0, 0], top=2) == [0, 1]
+
+
+def test_nothing_is_certain_before_any_duration_is_known():
+    assert certain_top([None] * 5, [0, 1, 2, 3, 4], top=2) == []
+    assert certain_top([], [], top=20) == []
+
+
+def test_an_unknown_destination_with_a_low_bound_blocks_the_known_ones():
+    assert certain_top([10, 20, None], [0, 0, 0], top=2) == [0]
+    assert certain_top([10, 20, None], [0, 0, 30], top=2) == [0, 1]
+
+
+def test_lower_bounds_are_not_above_the_duration_of_an_unreachable_destination():
+    bounds = duration_lower_bounds([0, 70, 100000], "walking")
+    assert bounds[:2] == [0, 70 / MAX_SPEEDS_KMH["walking"] * 3600]
+    assert bounds[2] == UNREACHABLE
+    assert duration_lower_bounds([100, 200], "flying") == [0, 0]
+    # a far walking destination has a bound above UNREACHABLE, but if it turns out unreachable it is faster
+    durations = [UNREACHABLE + 1, None]
+    lower_bounds = duration_lower_bounds([0, 100000], "walking")
+    assert certain_top(durations, lower_bounds, top=1) == []
+    assert exact_top([UNREACHABLE + 1, UNREACHABLE], 1) == {1}
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from routing_common.filters import CityStore, compile_filters, parse_expression, parse_filter
+
+EXPRESSIONS = [
+    "population > 10000",
+    "10000 < population",
+    "population >= 5000 and `country code` != 'RU'",
+    "`country code` in ['UA', 'PL'] or population < 100",
+    "`country code` not in ['UA']",
+    "latitude > 45 and latitude <= 50",
+    "45 < latitude <= 50",
+    "not (latitude > 48)",
+    "~(latitude > 48) & (population > 10)",
+    "(latitude < 44) | (latitude > 52)",
+    "latitude == 47.5",
+    "longitude >= 30 and (population > 1000 or `country code` == 'MD')",
+]
+
+
+@pytest.fixture
+def cities():
+    rng = np.random.default_rng(0)
+    size = 2000
+    latitude = rng.uniform(40, 56, size).round(1)
+    latitude[rng.random(size) < 0.05] = np.nan
+    return pd.DataFrame({
+        "name": [f"city {index}" for index in range(size)],
+        "latitude": latitude,
+        "longitude": rng.uniform(20, 40, size),
+        "population": rng.integers(0, 50000, size),
+        "country code": rng.choice(["UA", "PL", "RU", "MD"], size),
+    })
+
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+def test_expressions_keep_the_rows_of_dataframe_query(cities, expression):
+    expected = cities.query(expression)
+    row_filter = compile_filters([expression])
+    mask = row_filter.mask({name: cities[name].to_numpy() for name in cities.columns}, len(cities))
+    assert list(cities.index[mask]) == list(expected.index)
+
+    selected, _ = CityStore(cities, "latitude", "longitude").select(row_filter)
+    assert list(selected.index) == list(expected.index)
+
+
+@pytest.mark.parametrize("expression", EXPRESSIONS)
+def test_latitude_bounds_hold_every_selected_row(cities, expression):
+    row_filter = compile_filters([expression])
+    south, north = row_filter.bounds("latitude")
+    latitudes = cities.query(expression)["latitude"]
+    known = latitudes.dropna()
+    assert ((known >= south) & (known <= north)).all()
+    # rows without a latitude are sorted last, so they can only be selected when there is no northern bound
+    if latitudes.isna().any():
+        assert north == np.inf
+
+
+def test_structured_filters_match_expressions(cities):
+    pairs = [
+        ({"column": "population", "op": ">", "value": 10000}, "population > 10000"),
+        ({"column": "latitude", "op": "between", "value": [45, 50]}, "latitude >= 45 and latitude <= 50"),
+        ({"column": "country code", "value": ["UA", "PL"]}, "`country code` in ['UA', 'PL']"),
+        ({"column": "country code", "op": "!=", "value": ["UA"]}, "`country code` not in ['UA']"),
+        (
+            {"any": [{"column": "latitude", "op": "<", "value": 44}, {"not": {"column": "population", "op": ">", "value": 10}}]},
+            "latitude < 44 or not population > 10",
+        ),
+        (
+            {"all": [{"column": "latitude", "op": ">", "value": 45}, {"column": "latitude", "op": "<", "value": 47}]},
+            "45 < latitude < 47",
+        ),
+    ]
+    store = CityStore(cities, "latitude", "longitude")
+    for spec, expression in pairs:
+        selected, _ = store.select(compile_filters([spec]))
+        assert list(selected.index) == list(cities.query(expression).index), expression
+        assert parse_filter(spec).bounds("latitude") == parse_expression(expression).bounds("latitude")
+
+
+def test_bounds_combine_over_and_or_not():
+    assert compile_filters(["latitude > 45", "latitude <= 50"]).bounds("latitude") == (45, 50)
+    assert parse_expression("latitude < 44 or latitude > 52").bounds("latitude") == (-np.inf, np.inf)
+    assert parse_expression("latitude < 44 or 46 < latitude < 48").bounds("latitude") == (-np.inf, 48)
+    assert parse_expression("not latitude > 48").bounds("latitude") == (-np.inf, np.inf)
+    assert parse_expression("population > 10").bounds("latitude") == (-np.inf, np.inf)
+    assert parse_expression("latitude == 47.5").bounds("latitude") == (47.5, 47.5)
+
+
+def test_derived_columns_are_filtered_and_returned(cities):
+    store = CityStore(cities, "latitude", "longitude")
+    selected, derived = store.select(
+        compile_filters(["latitude > 45", "distance <= 30"]),
+        derived={"distance": lambda columns: columns["longitude"] - 10},
+    )
+    expected = cities[(cities["latitude"] > 45) & (cities["longitude"] - 10 <= 30)]
+    assert list(selected.index) == list(expected.index)
+    np.testing.assert_allclose(derived["distance"], expected["longitude"] - 10)
+
+
+@pytest.mark.parametrize("expression", [
+    "__import__('os').system('true')",
+    "population.max() > 1",
+    "len(name) > 3",
+    "population > other",
+    "population + 1 > 2",
+    "1 < 2",
+    "population >",
+])
+def test_expressions_that_are_not_literal_comparisons_are_rejected(expression):
+    with pytest.raises(ValueError):
+        parse_expression(expression)
+
+
+@pytest.mark.parametrize("spec", [
+    {"column": "population", "op": "like", "value": 1},
+    {"column": "latitude", "op": "between", "value": [1]},
+    {"column": "country code", "op": "in", "value": "UA"},
+    {"columns": "population"},
+    42,
+])
+def test_invalid_structured_filters_are_rejected(spec):
+    with pytest.raises(ValueError):
+        parse_filter(spec)
+
+
+def test_unknown_columns_are_rejected(cities):
+    with pytest.raises(ValueError):
+        CityStore(cities, "latitude", "longitude").select(compile_filters(["elevation > 100"]))
@@ -0,0 +1,40 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from linear_model import COEFFICIENTS_FILE, MODEL_FILE, LinearModel, check_parity, load_results
+
+pytest.importorskip("statsmodels")
+pytestmark = pytest.mark.skipif(not os.path.exists(MODEL_FILE), reason="the pickled model is not there")
+
+
+def test_coefficients_predict_like_the_pickled_model():
+    results = load_results(MODEL_FILE)
+    model = LinearModel.load(COEFFICIENTS_FILE)
+    assert model.feature_names == list(results.model.exog_names)
+
+    features = np.vstack(
+        (results.model.exog, np.random.default_rng(1).uniform(0, 1, (200, len(model.feature_names))))
+    )
+    np.testing.assert_allclose(model.predict(features), np.asarray(results.predict(features)), rtol=0, atol=1e-12)
+
+    frame = pd.DataFrame(features[:5], columns=model.feature_names, index=range(10, 15))
+    predicted = model.predict(frame)
+    assert list(predicted.index) == list(frame.index)
+    np.testing.assert_allclose(predicted, np.asarray(results.predict(frame)), rtol=0, atol=1e-12)
+
+
+def test_check_parity_passes():
+    assert check_parity(MODEL_FILE, COEFFICIENTS_FILE) <= 1e-12
+
+
+def test_check_parity_catches_drifted_coefficients(tmp_path):
+    model = LinearModel.load(COEFFICIENTS_FILE)
+    model.params = model.params + 1e-6
+    drifted = tmp_path / "coefficients.json"
+    drifted.write_text(json.dumps(model.to_dict()))
+    with pytest.raises(ValueError):
+        check_parity(MODEL_FILE, str(drifted))
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from routing_common.polyline_codec import decode_grid, decode_many, lines
+
+polyline = pytest.importorskip("polyline")
+
+
+def decode_scalar(encoded):
+    # the reference algorithm, one character at a time, on the integer grid
+    points = []
+    index = lat = lng = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                chunk = ord(encoded[index]) - 63
+                index += 1
+                result |= (chunk & 0x1f) << shift
+                shift += 5
+                if chunk < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat, lng))
+    return points
+
+
+def random_lines(rng, count):
+    encoded = []
+    for _ in range(count):
+        size = int(rng.integers(0, 30))
+        # large jumps (long chunk runs), tiny steps, repeated points and both signs
+        steps = rng.choice([0, 1e-5, 1e-3, 1.0, 45.0], size=(size, 2)) * rng.choice([-1, 1], size=(size, 2))
+        start = rng.uniform([-80, -179], [80, 179])
+        points = np.clip(start + np.cumsum(steps, axis=0), [-90, -180], [90, 180]).round(5)
+        encoded.append(polyline.encode([tuple(point) for point in points]) if size else "")
+    return encoded
+
+
+def test_decode_grid_matches_the_scalar_decoder():
+    rng = np.random.default_rng(0)
+    encoded = random_lines(rng, 300)
+    grid, offsets = decode_grid(encoded)
+    assert offsets[0] == 0 and offsets[-1] == len(grid)
+    for line, text in zip(lines(grid, offsets), encoded):
+        assert line.tolist() == [list(point) for point in decode_scalar(text)]
+
+
+def test_decode_many_matches_polyline_decode():
+    rng = np.random.default_rng(1)
+    encoded = random_lines(rng, 100)
+    coordinates, offsets = decode_many(encoded)
+    for line, text in zip(lines(coordinates, offsets), encoded):
+        np.testing.assert_array_equal(line.reshape(-1, 2), np.array(polyline.decode(text)).reshape(-1, 2))
+
+
+def test_empty_lines_keep_their_place():
+    encoded = ["", polyline.encode([(1.0, 2.0), (1.5, 2.5)]), "", polyline.encode([(-3.0, 4.0)])]
+    grid, offsets = decode_grid(encoded)
+    assert offsets.tolist() == [0, 0, 2, 2, 3]
+    assert grid.tolist() == [[100000, 200000], [150000, 250000], [-300000, 400000]]
+    grid, offsets = decode_grid([])
+    assert grid.shape == (0, 2) and offsets.tolist() == [0]
+
+
+@pytest.mark.parametrize("encoded", ["_p~i", "_p~iF~ps|U_", "_p~iF", "a b"])
+def test_invalid_polylines_are_rejected(encoded):
+    with pytest.raises(ValueError):
+        decode_grid([encoded])